@@ -1,11 +1,47 @@
-import json
+import base64
+import gzip
 import unittest
+import zlib
+from unittest import mock
+
+from json_encoding import encode_json
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Below this size the compressed body plus its base64 overhead saves too little to be worth the CPU time.
+_COMPRESSION_THRESHOLD = 1024
+_GZIP_LEVEL = 6
+_BROTLI_QUALITY = 5
 
 
 def build_ok_response(body, headers=None):
     return _build_response(200, body, headers)
 
 
+def build_ok_encoded_response(encoded_body, headers=None):
+    return _build_encoded_response(200, encoded_body, headers)
+
+
+def build_ok_streamed_response(chunks, headers=None):
+    # The body stays an iterable of str chunks until compress_response drains it, compressing each chunk as it is
+    # produced, so a large body is never held whole before compression.
+    return _build_encoded_response(200, chunks, headers)
+
+
+def build_not_modified_response(headers):
+    return {
+        'statusCode': 304,
+        'headers': headers,
+        'body': '',
+        'isBase64Encoded': False,
+    }
+
+
 def build_bad_request_response(*messages):
     return _build_error_response(400, messages)
 
@@ -14,21 +50,101 @@ def build_not_found_response(*messages):
     return _build_error_response(404, messages)
 
 
+def build_payload_too_large_response(*messages):
+    return _build_error_response(413, messages)
+
+
+def build_service_unavailable_response(*messages):
+    return _build_error_response(503, messages)
+
+
+def compress_response(response, accept_encoding):
+    if type(response['body']) is not str:
+        return _drain_response(response, _negotiate_encoding(accept_encoding) if accept_encoding is not None else None)
+    if accept_encoding is None or response['isBase64Encoded']:
+        return response
+    data = response['body'].encode()
+    encoding = _negotiate_encoding(accept_encoding)
+    if encoding is None or len(data) < _COMPRESSION_THRESHOLD:
+        return response
+    return {
+        **response,
+        'headers': {**response['headers'], 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+        'body': base64.b64encode(_compress(data, encoding)).decode(),
+        'isBase64Encoded': True,
+    }
+
+
+def _negotiate_encoding(accept_encoding):
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        (name, _, parameters) = coding.partition(';')
+        (key, _, value) = parameters.partition('=')
+        try:
+            quality = float(value) if key.strip() == 'q' else 1.0
+        except ValueError:
+            quality = 0.0
+        qualities[name.strip().lower()] = quality
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    candidates = [(qualities.get(encoding, qualities.get('*', 0.0)), -index, encoding)
+                  for index, encoding in enumerate(supported)]
+    (quality, _, encoding) = max(candidates)
+    return encoding if quality > 0 else None
+
+
+@timed
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=_GZIP_LEVEL, mtime=0)
+
+
+@timed
+def _drain_response(response, encoding):
+    # Streamed bodies are large by construction, so they are compressed regardless of the threshold.
+    if encoding is None:
+        return {**response, 'body': ''.join(response['body'])}
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=_BROTLI_QUALITY)
+        (compress, flush) = (compressor.process, compressor.finish)
+    else:
+        compressor = zlib.compressobj(_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        (compress, flush) = (compressor.compress, compressor.flush)
+    compressed_chunks = [compress(chunk.encode()) for chunk in response['body']]
+    compressed_chunks.append(flush())
+    return {
+        **response,
+        'headers': {**response['headers'], 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+        'body': base64.b64encode(b''.join(compressed_chunks)).decode(),
+        'isBase64Encoded': True,
+    }
+
+
 def _build_response(status_code, body, headers):
+    return _build_encoded_response(status_code, _encode_body(body), headers)
+
+
+def _build_encoded_response(status_code, encoded_body, headers):
     return {
         'statusCode': status_code,
         'headers': (headers if headers is not None else {}),
-        'body': json.dumps(body, ensure_ascii=False),
+        'body': encoded_body,
         'isBase64Encoded': False,
     }
 
 
+@timed
+def _encode_body(body):
+    return encode_json(body)
+
+
 def _build_error_response(status_code, messages):
     return _build_response(status_code, {'messages': messages}, {})
 
 
 class Test(unittest.TestCase):
 
+    @mock.patch('json_encoding.orjson', None)
     def test_build_ok_response(self):
         self.assertEqual({
             'statusCode': 200,
@@ -43,6 +159,15 @@ class Test(unittest.TestCase):
             'isBase64Encoded': False,
         }, build_ok_response(None))
 
+    def test_build_ok_encoded_response(self):
+        self.assertEqual({
+            'statusCode': 200,
+            'headers': {'ETag': 'W/"etag"'},
+            'body': '[{"key":"value"}]',
+            'isBase64Encoded': False,
+        }, build_ok_encoded_response('[{"key":"value"}]', {'ETag': 'W/"etag"'}))
+
+    @mock.patch('json_encoding.orjson', None)
     def test_build_bad_request_response(self):
         self.assertEqual({
             'statusCode': 400,
@@ -50,3 +175,44 @@ class Test(unittest.TestCase):
             'body': '{"messages": ["message"]}',
             'isBase64Encoded': False,
         }, build_bad_request_response('message'))
+
+    def test_compress_response(self):
+        response = build_ok_response({'title': 'クーポン' * 300}, {'ETag': 'W/"etag"'})
+        compressed_response = compress_response(response, 'deflate, gzip;q=0.8')
+        self.assertEqual(200, compressed_response['statusCode'])
+        self.assertEqual({'ETag': 'W/"etag"', 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'},
+                         compressed_response['headers'])
+        self.assertTrue(compressed_response['isBase64Encoded'])
+        self.assertEqual(response['body'],
+                         gzip.decompress(base64.b64decode(compressed_response['body'])).decode())
+
+    def test_compress_response_skipped(self):
+        response = build_ok_response({'title': 'クーポン' * 300})
+        self.assertIs(response, compress_response(response, None))
+        self.assertIs(response, compress_response(response, 'identity'))
+        self.assertIs(response, compress_response(response, 'gzip;q=0'))
+        small_response = build_ok_response({'key': 'value'})
+        self.assertIs(small_response, compress_response(small_response, 'gzip'))
+
+    def test_compress_streamed_response(self):
+        chunks = ('[', '{"title": "クーポン"}', ']')
+        response = compress_response(build_ok_streamed_response(iter(chunks), {'ETag': 'W/"etag"'}), 'gzip')
+        self.assertEqual({'ETag': 'W/"etag"', 'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'},
+                         response['headers'])
+        self.assertTrue(response['isBase64Encoded'])
+        self.assertEqual(''.join(chunks), gzip.decompress(base64.b64decode(response['body'])).decode())
+        self.assertEqual(build_ok_encoded_response(''.join(chunks)),
+                         compress_response(build_ok_streamed_response(iter(chunks)), None))
+        self.assertEqual(build_ok_encoded_response(''.join(chunks)),
+                         compress_response(build_ok_streamed_response(iter(chunks)), 'identity'))
+
+    def test_negotiate_encoding(self):
+        self.assertEqual('gzip', _negotiate_encoding('gzip'))
+        self.assertEqual('gzip', _negotiate_encoding('*'))
+        self.assertIsNone(_negotiate_encoding('deflate'))
+        self.assertIsNone(_negotiate_encoding('gzip;q=invalid'))
+        with mock.patch('api_gateway_response.brotli', mock.MagicMock()):
+            self.assertEqual('br', _negotiate_encoding('gzip, br'))
+            self.assertEqual('gzip', _negotiate_encoding('gzip, br;q=0.5'))
+        with mock.patch('api_gateway_response.brotli', None):
+            self.assertEqual('gzip', _negotiate_encoding('gzip, br'))
@@ -0,0 +1,34 @@
+import functools
+import threading
+
+import boto3
+
+
+# Resources are built on first use only, so a route never pays for the ones it does not touch.
+# boto3's default session is not thread safe and background tasks may race to build them.
+_lock = threading.Lock()
+
+
+def _shared(function):
+    cached_function = functools.lru_cache()(function)
+
+    @functools.wraps(function)
+    def wrapper():
+        with _lock:
+            return cached_function()
+    return wrapper
+
+
+@_shared
+def dynamodb_resource():
+    return boto3.resource('dynamodb')
+
+
+@_shared
+def s3_resource():
+    return boto3.resource('s3')
+
+
+@_shared
+def s3_client():
+    return boto3.client('s3')
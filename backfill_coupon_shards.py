@@ -0,0 +1,5 @@
+from dynamodb_coupons import dynamodb_backfill_coupon_shards
+
+
+if __name__ == '__main__':
+    print(f"moved {dynamodb_backfill_coupon_shards()} coupons")
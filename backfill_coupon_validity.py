@@ -0,0 +1,5 @@
+from dynamodb_coupons import dynamodb_backfill_coupon_validity
+
+
+if __name__ == '__main__':
+    print(f"updated {dynamodb_backfill_coupon_validity()} coupons")
@@ -0,0 +1,55 @@
+import concurrent.futures
+import functools
+import logging
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+
+_MAX_WORKERS = 8
+
+_logger = logging.getLogger(__name__)
+_deferred_futures = []
+_deferred_futures_lock = threading.Lock()
+
+
+def submit_task(function, *args):
+    return _executor().submit(function, *args)
+
+
+def defer_task(function, *args):
+    future = submit_task(function, *args)
+    with _deferred_futures_lock:
+        _deferred_futures.append(future)
+    return future
+
+
+def wait_deferred_tasks():
+    with _deferred_futures_lock:
+        futures = tuple(_deferred_futures)
+        _deferred_futures.clear()
+    for future in concurrent.futures.as_completed(futures):
+        if future.exception() is not None:
+            _logger.error('deferred task failed', exc_info=future.exception())
+
+
+@functools.lru_cache()
+def _executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+
+
+class Test(unittest.TestCase):
+
+    def test_submit_task(self):
+        self.assertEqual(3, submit_task(lambda x, y: x + y, 1, 2).result())
+
+    def test_wait_deferred_tasks(self):
+        task = MagicMock()
+        failing_task = MagicMock(side_effect=Exception('failure'))
+        defer_task(task, 'arg')
+        defer_task(failing_task)
+        with self.assertLogs('background_tasks', level='ERROR'):
+            wait_deferred_tasks()
+        task.assert_called_once_with('arg')
+        failing_task.assert_called_once_with()
+        self.assertEqual([], _deferred_futures)
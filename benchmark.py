@@ -0,0 +1,520 @@
+import argparse
+import base64
+import copy
+import gc
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+import coupon_action
+import coupon_catalog
+import coupon_search
+import dynamodb_atomic_counts
+import dynamodb_coupons_cache
+import s3_coupons
+from lambda_handler import lambda_handler
+
+
+_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# Timings are compared after scaling the baseline by how long the reference workload took before each route, in the
+# baseline run and in this one, so that they carry over between machines and between busy and idle moments.
+_REGRESSION_TOLERANCE = 0.3
+# p99 of a few hundred requests comes down to a couple of them, which a single scheduling hiccup can double.
+_P99_TOLERANCE = 1.0
+# Sub-millisecond latencies jitter by more than the relative tolerance between runs.
+_REGRESSION_LATENCY_SLACK_MS = 0.5
+# Traced peaks do not depend on the machine, but do on how far the image upload threads of a request overlap.
+_PEAK_MEMORY_TOLERANCE = 0.5
+# A reference sample is timed between every so many requests, so that it sees the same moments as the route.
+_REFERENCE_INTERVAL = 10
+_ADMINISTRATOR_API_KEY_ID = 'test-invoke-api-key-id'
+_REFERENCE_COUPONS = [{'id': str(_id).zfill(7), 'title': '全商品 10% OFF！', 'description': 'ご利用一回限り。' * 8}
+                      for _id in range(200)]
+_INDEX_KEYS = {
+    'fixed_key-id-index': ('fixed_key', 'id'),
+    'fixed_key-active_until-index': ('fixed_key', 'active_until'),
+}
+_SET_ASSIGNMENT_PATTERN = re.compile(r'\s*([#\w]+)\s*=\s*(.+?)\s*$')
+_IF_NOT_EXISTS_PATTERN = re.compile(r'if_not_exists\(\s*([#\w]+)\s*,\s*(:\w+)\s*\)\s*\+\s*(:\w+)')
+
+
+class FakeTable:
+
+    def __init__(self, key_name, latency):
+        self._key_name = key_name
+        self._latency = latency
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def put_item(self, Item, ConditionExpression=None, ReturnValues='NONE'):
+        self._wait()
+        with self._lock:
+            old_item = self._items.get(Item[self._key_name])
+            self._check_condition(ConditionExpression, old_item)
+            self._items[Item[self._key_name]] = copy.deepcopy(Item)
+            return {'Attributes': copy.deepcopy(old_item)} if ReturnValues == 'ALL_OLD' and old_item else {}
+
+    def get_item(self, Key, ConsistentRead=False):
+        self._wait()
+        with self._lock:
+            item = self._items.get(Key[self._key_name])
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def delete_item(self, Key, ConditionExpression=None, ReturnValues='NONE'):
+        self._wait()
+        with self._lock:
+            old_item = self._items.get(Key[self._key_name])
+            self._check_condition(ConditionExpression, old_item)
+            self._items.pop(Key[self._key_name], None)
+            return {'Attributes': copy.deepcopy(old_item)} if ReturnValues == 'ALL_OLD' and old_item else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+                    ConditionExpression=None, ReturnValues='NONE', ReturnValuesOnConditionCheckFailure='NONE'):
+        self._wait()
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self._lock:
+            old_item = self._items.get(Key[self._key_name])
+            self._check_condition(ConditionExpression, old_item, ReturnValuesOnConditionCheckFailure)
+            item = copy.deepcopy(old_item) if old_item is not None else dict(Key)
+            updated_names = _apply_update_expression(item, UpdateExpression, values, names)
+            self._items[Key[self._key_name]] = item
+            if ReturnValues == 'ALL_OLD':
+                return {'Attributes': copy.deepcopy(old_item)} if old_item else {}
+            if ReturnValues == 'ALL_NEW':
+                return {'Attributes': copy.deepcopy(item)}
+            if ReturnValues == 'UPDATED_NEW':
+                return {'Attributes': {name: copy.deepcopy(item[name]) for name in updated_names if name in item}}
+            return {}
+
+    def query(self, IndexName, KeyConditionExpression, Limit=None, ExclusiveStartKey=None, FilterExpression=None):
+        self._wait()
+        (partition_key, sort_key) = _INDEX_KEYS[IndexName]
+
+        def position(item):
+            return item[sort_key], item[self._key_name]
+
+        with self._lock:
+            items = sorted((item for item in self._items.values()
+                            if partition_key in item and sort_key in item
+                            and _evaluate_condition(KeyConditionExpression, item)), key=position)
+        if ExclusiveStartKey is not None:
+            items = [item for item in items if position(item) > position(ExclusiveStartKey)]
+        page = items[:Limit] if Limit is not None else items
+        result = {'Items': [copy.deepcopy(item) for item in page
+                            if FilterExpression is None or _evaluate_condition(FilterExpression, item)]}
+        if Limit is not None and len(items) > Limit:
+            result['LastEvaluatedKey'] = {name: page[-1][name] for name in (partition_key, sort_key, self._key_name)}
+        return result
+
+    def scan(self, ProjectionExpression=None, ExclusiveStartKey=None):
+        self._wait()
+        with self._lock:
+            return {'Items': [copy.deepcopy(item) for item in self._items.values()]}
+
+    def batch_get(self, keys):
+        self._wait()
+        with self._lock:
+            return [copy.deepcopy(self._items[key[self._key_name]]) for key in keys
+                    if key[self._key_name] in self._items]
+
+    def _check_condition(self, condition, item, return_values='NONE'):
+        if condition is not None and not _evaluate_condition(condition, item or {}):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'},
+                               **({'Item': copy.deepcopy(item)} if return_values == 'ALL_OLD' and item else {})},
+                              'ConditionalCheck')
+
+    def _wait(self):
+        if self._latency:
+            time.sleep(self._latency)
+
+
+class FakeDynamoDBResource:
+
+    def __init__(self, tables):
+        self._tables = tables
+
+    def Table(self, name):
+        return self._tables[name]
+
+    def batch_get_item(self, RequestItems):
+        return {
+            'Responses': {name: self._tables[name].batch_get(request['Keys'])
+                          for name, request in RequestItems.items()},
+            'UnprocessedKeys': {},
+        }
+
+    def batch_write_item(self, RequestItems):
+        for name, requests in RequestItems.items():
+            for request in requests:
+                self._tables[name].put_item(Item=request['PutRequest']['Item'])
+        return {'UnprocessedItems': {}}
+
+
+class FakeS3Object:
+
+    def __init__(self, key):
+        self.key = key
+
+
+class FakeBucket:
+
+    def __init__(self, latency):
+        self._latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Key, Body, ContentType, **_):
+        self.wait()
+        with self.lock:
+            self.objects[Key] = (bytes(Body), ContentType)
+        return FakeS3Object(Key)
+
+    def delete_objects(self, Delete):
+        self.wait()
+        with self.lock:
+            for deleted_object in Delete['Objects']:
+                self.objects.pop(deleted_object['Key'], None)
+        return {}
+
+    def wait(self):
+        if self._latency:
+            time.sleep(self._latency)
+
+
+class FakeS3Client:
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self._bucket.wait()
+        with self._bucket.lock:
+            stored_object = self._bucket.objects.get(Key)
+        if stored_object is None:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        etag = _etag(stored_object[0])
+        if etag == IfNoneMatch:
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        return {'ETag': etag, 'Body': io.BytesIO(stored_object[0])}
+
+    def put_object(self, Bucket, Key, Body, ContentType, IfMatch=None, IfNoneMatch=None, **_):
+        self._bucket.wait()
+        with self._bucket.lock:
+            stored_object = self._bucket.objects.get(Key)
+            if (IfNoneMatch == '*' and stored_object is not None) or (
+                    IfMatch is not None and (stored_object is None or _etag(stored_object[0]) != IfMatch)):
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+            self._bucket.objects[Key] = (bytes(Body), ContentType)
+        return {'ETag': _etag(Body)}
+
+    def generate_presigned_url(self, ClientMethod, HttpMethod, ExpiresIn, Params):
+        # SigV4 presigning is pure CPU work: a canonical request hash and a chain of HMACs.
+        timestamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        canonical_request = f"{HttpMethod}\n/{Params['Key']}\nX-Amz-Expires={ExpiresIn}&X-Amz-Date={timestamp}"
+        signing_key = b'secret'
+        for part in (timestamp[:8], 'ap-northeast-1', 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, hashlib.sha256(canonical_request.encode()).hexdigest().encode(),
+                             hashlib.sha256).hexdigest()
+        return (f"https://s3.ap-northeast-1.amazonaws.com/{Params['Bucket']}/{Params['Key']}"
+                f"?X-Amz-Date={timestamp}&X-Amz-Expires={ExpiresIn}&X-Amz-Signature={signature}")
+
+
+def fake_aws(dynamodb_latency=0.0, s3_latency=0.0):
+    tables = {
+        'coupons': FakeTable('id', dynamodb_latency),
+        'atomic_counts': FakeTable('key', dynamodb_latency),
+    }
+    resource = FakeDynamoDBResource(tables)
+    bucket = FakeBucket(s3_latency)
+    client = FakeS3Client(bucket)
+    return _FakeAwsPatch(mock.patch.multiple(
+        'dynamodb_coupons',
+        _dynamodb_coupons_table=lambda: tables['coupons'],
+        _dynamodb_resource=lambda: resource,
+    ), mock.patch.multiple(
+        'dynamodb_atomic_counts',
+        _dynamodb_atomic_counts_table=lambda: tables['atomic_counts'],
+    ), mock.patch.multiple(
+        's3_coupons',
+        _s3_coupons_bucket=lambda: bucket,
+        _s3_client=lambda: client,
+    ))
+
+
+class _FakeAwsPatch:
+
+    def __init__(self, *patches):
+        self._patches = patches
+
+    def __enter__(self):
+        _reset_container_state()
+        for patch in self._patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *_):
+        for patch in reversed(self._patches):
+            patch.stop()
+        _reset_container_state()
+        return False
+
+
+def run_benchmark(iterations, image_size, dynamodb_latency, s3_latency, cold_caches=False):
+    results = {}
+    with fake_aws(dynamodb_latency, s3_latency):
+        create_body = json.dumps(_coupon_body(image_size))
+        ids = [json.loads(lambda_handler(_event('POST', body=create_body), {})['body'])['id']
+               for _ in range(max(iterations, 40))]
+        # Only an existing catalog and search index are kept up to date, so they are built up front as a
+        # deployment would.
+        coupon_catalog.rebuild_coupon_catalog()
+        coupon_search.rebuild_coupon_search_index()
+        routes = (
+            ('create', lambda i: _event('POST', body=create_body)),
+            ('read', lambda i: _event('GET', _id=ids[i % len(ids)])),
+            ('query', lambda i: _event('GET', headers={})),
+            ('query_active', lambda i: {**_event('GET', headers={}), 'queryStringParameters': {'active': 'true'}}),
+            ('catalog', lambda i: _event('GET', _id='catalog')),
+            ('search', lambda i: {**_event('GET', _id='search'), 'queryStringParameters': {'q': '10% OFF'}}),
+            ('update', lambda i: _event('PUT', _id=ids[i % len(ids)], body=create_body)),
+            ('patch', lambda i: _event('PATCH', _id=ids[i % len(ids)], body=json.dumps({'title': f"10% OFF {i}"}))),
+            ('delete', lambda i: _event('DELETE', _id=ids[i])),
+        )
+        for route, make_event in routes:
+            results[route] = _measure(route, make_event, iterations, cold_caches)
+    return results
+
+
+def compare_with_baseline(results, baseline):
+    regressions = []
+    for route, metrics in results.items():
+        if route not in baseline:
+            continue
+        expected = baseline[route]
+        # Above 1 when this run is slower than the baseline run at the same work.
+        slowdown = metrics['reference_ms'] / expected['reference_ms']
+        for metric, scale, tolerance, slack in (
+                ('p50_ms', slowdown, _REGRESSION_TOLERANCE, _REGRESSION_LATENCY_SLACK_MS),
+                ('p99_ms', slowdown, _P99_TOLERANCE, _REGRESSION_LATENCY_SLACK_MS),
+                ('peak_traced_kib', 1, _PEAK_MEMORY_TOLERANCE, 0),
+        ):
+            if metrics[metric] > expected[metric] * scale * (1 + tolerance) + slack:
+                regressions.append(f"{route} {metric}: {expected[metric] * scale:.3f} -> {metrics[metric]}")
+        if metrics['throughput'] < expected['throughput'] / slowdown * (1 - _REGRESSION_TOLERANCE):
+            regressions.append(
+                f"{route} throughput: {expected['throughput'] / slowdown:.1f} -> {metrics['throughput']}")
+    return regressions
+
+
+def _measure(route, make_event, iterations, cold_caches):
+    # Otherwise a full collection of the garbage earlier routes left behind lands on whichever route comes next.
+    gc.collect()
+    latencies = []
+    reference_timings = []
+    started_at = time.perf_counter()
+    for i in range(iterations):
+        if i % _REFERENCE_INTERVAL == 0:
+            reference_timings.append(_time_reference())
+        if cold_caches:
+            _reset_container_state()
+        event = make_event(i)
+        request_started_at = time.perf_counter()
+        response = lambda_handler(event, {})
+        latencies.append(time.perf_counter() - request_started_at)
+        if response['statusCode'] != 200:
+            raise RuntimeError(f"{route} failed: {response}")
+    elapsed = time.perf_counter() - started_at - sum(reference_timings)
+    return {
+        'throughput': round(iterations / elapsed, 1),
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+        'peak_traced_kib': round(_peak_memory(make_event, route) / 1024, 1),
+        'reference_ms': round(statistics.median(reference_timings) * 1000, 3),
+    }
+
+
+def _time_reference():
+    # Encoding and compressing coupons, the kind of work the routes spend their CPU time on.
+    started_at = time.perf_counter()
+    json.loads(gzip.decompress(gzip.compress(json.dumps(_REFERENCE_COUPONS).encode(), 1)))
+    return time.perf_counter() - started_at
+
+
+def _peak_memory(make_event, route):
+    # The delete route is measured on an ID that has already been deleted, which still walks the whole path.
+    event = make_event(0)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        (current_before, _) = tracemalloc.get_traced_memory()
+        lambda_handler(event, {})
+        (_, peak) = tracemalloc.get_traced_memory()
+        return peak - current_before
+    finally:
+        tracemalloc.stop()
+
+
+def _etag(body):
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+def _percentile(values, percent):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def _event(http_method, _id=None, body=None, headers=None):
+    return {
+        'httpMethod': http_method,
+        'pathParameters': {'id': _id} if _id is not None else None,
+        'queryStringParameters': None,
+        'headers': headers if headers is not None else {},
+        'body': body,
+        'requestContext': {'identity': {'apiKeyId': _ADMINISTRATOR_API_KEY_ID}},
+    }
+
+
+def _coupon_body(image_size):
+    image = b'\x89PNG\r\n\x1a\n' + os.urandom(image_size)
+    return {
+        'title': '全商品 10% OFF！',
+        'description': ('ご利用一回限り。他のクーポンとの併用はできません。'
+                        'クーポンをご利用いただいた場合、ポイントはつきません。'),
+        'image': f"data:image/png;base64,{base64.b64encode(image).decode()}",
+        'qr_code_image': f"data:image/png;base64,{base64.b64encode(image[:image_size // 10]).decode()}",
+    }
+
+
+def _reset_container_state():
+    for cache in (s3_coupons._url_cache, dynamodb_coupons_cache._catalog_version_cache,
+                  dynamodb_coupons_cache._item_cache, dynamodb_coupons_cache._page_cache,
+                  coupon_action._fragment_cache):
+        cache.clear()
+    dynamodb_atomic_counts._reserved_blocks.clear()
+    coupon_catalog._snapshot = None
+    coupon_search._snapshot = None
+    coupon_search._encoded_documents = {}
+
+
+def _evaluate_condition(condition, item):
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+    if operator in ('AND', 'OR'):
+        results = (_evaluate_condition(value, item) for value in values)
+        return all(results) if operator == 'AND' else any(results)
+    if operator == 'NOT':
+        return not _evaluate_condition(values[0], item)
+    if operator == 'attribute_exists':
+        return values[0].name in item
+    if operator == 'attribute_not_exists':
+        return values[0].name not in item
+    if values[0].name not in item:
+        return False
+    actual = item[values[0].name]
+    if operator == 'begins_with':
+        return actual.startswith(values[1])
+    if operator == 'BETWEEN':
+        return values[1] <= actual <= values[2]
+    return {
+        '=': lambda: actual == values[1],
+        '<>': lambda: actual != values[1],
+        '<': lambda: actual < values[1],
+        '<=': lambda: actual <= values[1],
+        '>': lambda: actual > values[1],
+        '>=': lambda: actual >= values[1],
+    }[operator]()
+
+
+def _apply_update_expression(item, update_expression, values, names):
+    updated_names = []
+    for (action, clauses) in re.findall(r'(set|remove|SET|REMOVE)\s+(.+?)(?=\s+(?:set|remove|SET|REMOVE)\s+|$)',
+                                        update_expression):
+        for clause in re.split(r',(?![^(]*\))', clauses):
+            if action.lower() == 'remove':
+                name = names.get(clause.strip(), clause.strip())
+                item.pop(name, None)
+                updated_names.append(name)
+                continue
+            (target, value_expression) = _SET_ASSIGNMENT_PATTERN.match(clause).groups()
+            name = names.get(target, target)
+            counter_match = _IF_NOT_EXISTS_PATTERN.fullmatch(value_expression)
+            if counter_match is not None:
+                item[name] = item.get(name, values[counter_match.group(2)]) + values[counter_match.group(3)]
+            else:
+                item[name] = values[value_expression]
+            updated_names.append(name)
+    return updated_names
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Benchmark lambda_handler against in-memory DynamoDB and S3.')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--image-size', type=int, default=100 * 1024, help='bytes of the coupon image')
+    parser.add_argument('--dynamodb-latency-ms', type=float, default=0.0)
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0)
+    parser.add_argument('--cold-caches', action='store_true', help='clear in-container caches before each request')
+    parser.add_argument('--save-baseline', action='store_true')
+    arguments = parser.parse_args()
+    results = run_benchmark(arguments.iterations, arguments.image_size, arguments.dynamodb_latency_ms / 1000,
+                            arguments.s3_latency_ms / 1000, arguments.cold_caches)
+    print(f"{'route':<14}{'req/s':>10}{'p50 [ms]':>12}{'p99 [ms]':>12}{'peak traced [KiB]':>19}{'ref [ms]':>10}")
+    for route, metrics in results.items():
+        print(f"{route:<14}{metrics['throughput']:>10}{metrics['p50_ms']:>12}{metrics['p99_ms']:>12}"
+              f"{metrics['peak_traced_kib']:>19}{metrics['reference_ms']:>10}")
+    if arguments.save_baseline:
+        with open(_BASELINE_PATH, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+            baseline_file.write('\n')
+        return 0
+    if not os.path.exists(_BASELINE_PATH):
+        return 0
+    with open(_BASELINE_PATH) as baseline_file:
+        regressions = compare_with_baseline(results, json.load(baseline_file))
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+class Test(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        results = run_benchmark(2, 1024, 0.0, 0.0)
+        self.assertEqual(['create', 'read', 'query', 'query_active', 'catalog', 'search', 'update', 'patch', 'delete'],
+                         list(results))
+
+    def test_compare_with_baseline(self):
+        baseline = {'read': {'throughput': 100.0, 'p50_ms': 1.0, 'p99_ms': 2.0, 'peak_traced_kib': 10.0,
+                             'reference_ms': 2.0}}
+        self.assertEqual([], compare_with_baseline({'read': {
+            'throughput': 80.0, 'p50_ms': 1.2, 'p99_ms': 2.4, 'peak_traced_kib': 14.0, 'reference_ms': 2.0,
+        }}, baseline))
+        # Half as fast at the reference workload, so half the throughput is expected.
+        self.assertEqual([], compare_with_baseline({'read': {
+            'throughput': 50.0, 'p50_ms': 2.0, 'p99_ms': 4.0, 'peak_traced_kib': 10.0, 'reference_ms': 4.0,
+        }}, baseline))
+        self.assertEqual([
+            'read p50_ms: 1.000 -> 2.0', 'read peak_traced_kib: 10.000 -> 16.0', 'read throughput: 100.0 -> 50.0',
+        ], compare_with_baseline({'read': {
+            'throughput': 50.0, 'p50_ms': 2.0, 'p99_ms': 4.0, 'peak_traced_kib': 16.0, 'reference_ms': 2.0,
+        }}, baseline))
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,168 @@
+import argparse
+import ast
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+
+_ENTRY_MODULE = 'lambda_handler'
+_TEST_NAMES = frozenset(('unittest', 'mock', 'MagicMock'))
+_IMPORT_TIME_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def build(output, source_directory='.'):
+    modules = _collect_modules(source_directory)
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for module in modules:
+            with open(os.path.join(source_directory, f"{module}.py"), encoding='utf-8') as source_file:
+                archive.writestr(f"{module}.py", _strip_test_code(source_file.read(), module))
+    return modules
+
+
+def report_import_time(artifact):
+    with tempfile.TemporaryDirectory() as directory:
+        with zipfile.ZipFile(artifact) as archive:
+            archive.extractall(directory)
+        modules = frozenset(name[:-len('.py')] for name in os.listdir(directory))
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {_ENTRY_MODULE}"],
+                                   cwd=directory, capture_output=True, text=True, check=True)
+    return _summarize_import_time(completed.stderr, modules)
+
+
+def _collect_modules(source_directory):
+    modules = []
+    pending = [_ENTRY_MODULE]
+    while pending:
+        module = pending.pop()
+        if module in modules:
+            continue
+        modules.append(module)
+        with open(os.path.join(source_directory, f"{module}.py"), encoding='utf-8') as source_file:
+            tree = ast.parse(_strip_test_code(source_file.read(), module))
+        pending.extend(name for name in _imported_names(tree)
+                       if os.path.exists(os.path.join(source_directory, f"{name}.py")))
+    return sorted(modules)
+
+
+def _imported_names(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            yield from (alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            yield node.module.split('.')[0]
+
+
+def _strip_test_code(source, module):
+    # Removed lines are blanked rather than dropped so that tracebacks keep their line numbers.
+    lines = source.splitlines()
+    tree = ast.parse(source)
+    for node in tree.body:
+        if _is_test_import(node) or _is_test_case(node):
+            for line_number in range(node.lineno - 1, node.end_lineno):
+                lines[line_number] = ''
+    stripped_source = '\n'.join(lines).rstrip('\n') + '\n'
+    leaked_names = {node.id for node in ast.walk(ast.parse(stripped_source))
+                    if isinstance(node, ast.Name) and node.id in _TEST_NAMES}
+    if leaked_names:
+        raise ValueError(f"{module} uses test code outside of its test case: {', '.join(sorted(leaked_names))}")
+    return stripped_source
+
+
+def _is_test_import(node):
+    return (
+            (isinstance(node, ast.Import) and all(alias.name.split('.')[0] == 'unittest' for alias in node.names))
+            or (isinstance(node, ast.ImportFrom) and node.module is not None
+                and node.module.split('.')[0] == 'unittest')
+    )
+
+
+def _is_test_case(node):
+    return isinstance(node, ast.ClassDef) and any(ast.unparse(base) == 'unittest.TestCase' for base in node.bases)
+
+
+def _summarize_import_time(importtime_output, modules):
+    # -X importtime prints children before their parent, so the lines are walked from the end to know
+    # which module triggered each import. Local modules and whatever they import directly are reported.
+    rows = []
+    parents = []
+    for line in reversed(importtime_output.splitlines()):
+        match = _IMPORT_TIME_PATTERN.match(line)
+        if match is None:
+            continue
+        (self_time, cumulative_time, indent, name) = match.groups()
+        while parents and parents[-1][0] >= len(indent):
+            parents.pop()
+        if name in modules or not parents or parents[-1][1] in modules:
+            rows.append((name, int(self_time), int(cumulative_time)))
+        parents.append((len(indent), name))
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Build the Lambda deployment artifact without test code.')
+    parser.add_argument('--output', default='lambda.zip')
+    parser.add_argument('--report', action='store_true', help='report the import time of each module')
+    arguments = parser.parse_args()
+    modules = build(arguments.output)
+    print(f"{arguments.output}: {', '.join(modules)}")
+    if arguments.report:
+        print(f"{'module':<40}{'self [ms]':>12}{'cumulative [ms]':>18}")
+        for name, self_time, cumulative_time in report_import_time(arguments.output):
+            print(f"{name:<40}{self_time / 1000:>12.1f}{cumulative_time / 1000:>18.1f}")
+
+
+class Test(unittest.TestCase):
+
+    def test_strip_test_code(self):
+        source = '\n'.join((
+            'import json',
+            'import unittest',
+            'from unittest import mock',
+            '',
+            '',
+            'def f():',
+            '    return json.dumps(None)',
+            '',
+            '',
+            'class Test(unittest.TestCase):',
+            '',
+            '    @mock.patch("json.dumps")',
+            '    def test_f(self, mock_dumps):',
+            '        f()',
+            '',
+        ))
+        self.assertEqual('\n'.join((
+            'import json',
+            '',
+            '',
+            '',
+            '',
+            'def f():',
+            '    return json.dumps(None)',
+            '',
+        )), _strip_test_code(source, 'module'))
+
+    def test_strip_test_code_leaked_names(self):
+        with self.assertRaises(ValueError):
+            _strip_test_code('from unittest import mock\n\n\ndef f():\n    return mock.MagicMock()\n', 'module')
+
+    def test_summarize_import_time(self):
+        self.assertEqual([('lambda_handler', 30, 500), ('coupon_action', 5, 400), ('boto3', 60, 350),
+                          ('json', 10, 20)],
+                         _summarize_import_time('\n'.join((
+                             'import time: self [us] | cumulative | imported package',
+                             'import time:        10 |         20 | json',
+                             'import time:        40 |         40 |       botocore.model',
+                             'import time:        50 |        290 |     botocore',
+                             'import time:        60 |        350 |   boto3',
+                             'import time:         5 |        400 |   coupon_action',
+                             'import time:        30 |        500 | lambda_handler',
+                         )), frozenset(('lambda_handler', 'coupon_action'))))
+
+
+if __name__ == '__main__':
+    _main()
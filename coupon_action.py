@@ -1,149 +1,639 @@
+import base64
+import concurrent.futures
+import decimal
+import hashlib
 import json
+import logging
+import re
 import uuid
 import unittest
 from unittest import mock
-from unittest.mock import MagicMock
 
-from dynamodb_atomic_counts import dynamodb_increment_atomic_count
-from dynamodb_coupons import dynamodb_put_coupon, dynamodb_get_coupon, dynamodb_query_coupons, dynamodb_delete_coupon
-from s3_coupons import s3_put_coupon_image, s3_delete_coupon_image, s3_generate_coupon_url
+from dynamodb_atomic_counts import dynamodb_allocate_atomic_count, dynamodb_increment_atomic_count
+from dynamodb_coupons_cache import (dynamodb_put_coupon, dynamodb_batch_put_coupons, dynamodb_replace_coupon,
+                                     dynamodb_update_coupon, dynamodb_get_coupon, dynamodb_batch_get_coupons,
+                                     dynamodb_query_coupons, dynamodb_prefetch_coupons, dynamodb_delete_coupon)
+from dynamodb_coupons import dynamodb_strip_index_attributes
+from s3_coupons import (s3_generate_coupon_image_upload, s3_generate_coupon_url, s3_coupon_url_epoch,
+                        s3_coupon_url_epoch_end)
+from coupon_images import (put_coupon_image, put_generated_qr_code_image, put_uploaded_coupon_image,
+                           release_coupon_images, release_expired_coupon_images, coupon_image_thumbnail_key,
+                           is_coupon_image_within_pixel_limit)
+from background_tasks import submit_task, defer_task, wait_deferred_tasks
+from coupon_catalog import load_coupon_catalog, update_coupon_catalog
+from coupon_search import is_searchable, search_coupon_ids, update_coupon_search_index
 from coupon_validation import validate_coupon
-from api_gateway_response import build_ok_response, build_bad_request_response, build_not_found_response
+from image_validation import is_supported_image_type, decode_image_data_url
+from qr_codes import qr_code_generation_enabled, make_coupon_qr_code_content
+from api_gateway_response import (build_ok_response, build_ok_encoded_response, build_ok_streamed_response,
+                                  build_not_modified_response, build_bad_request_response, build_not_found_response,
+                                  build_service_unavailable_response)
+from expiring_cache import ExpiringLruCache
+from json_encoding import encode_json, encode_json_array, iter_json_array
+from metrics import timed, set_metric_property
 
 
 _PAGINATION_COUNT = 20
+_SEARCH_QUERY_MAX_LENGTH = 100
+_COUPON_ID_BLOCK_SIZE = 10
+_FRAGMENT_CACHE_SIZE = 1024
+# Listings of more coupons are encoded while the response is compressed instead of up front.
+_STREAMING_MIN_COUNT = 50
+# Larger images go through presigned POST uploads.
+_INLINE_IMAGE_MAX_BYTES = 1024 * 1024
+_IMAGE_DIRECTORIES = ('image', 'qr_code_image')
+# Expired by a bucket lifecycle rule, so uploads that no write used do not pile up.
+_UPLOAD_DIRECTORY = 'uploads'
+_VALIDITY_NAMES = ('valid_from', 'valid_until')
+_UUID_PATTERN = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
 
+_logger = logging.getLogger(__name__)
+# Encoded coupons including their presigned URLs, so they live no longer than the URL epoch.
+_fragment_cache = ExpiringLruCache(_FRAGMENT_CACHE_SIZE)
 
-def create_coupon(title, description, image, qr_code_image):
-    return _write_coupon(title, description, image, qr_code_image,
-                         lambda: str(dynamodb_increment_atomic_count('coupon_id')).zfill(7))
 
+def create_coupon(title, description, image, qr_code_image=None, valid_from=None, valid_until=None):
+    return _write_coupon(title, description, image, qr_code_image, valid_from, valid_until,
+                         lambda: str(dynamodb_allocate_atomic_count('coupon_id', _COUPON_ID_BLOCK_SIZE)).zfill(7),
+                         _put_coupon)
 
-def read_coupon(_id):
+
+def issue_coupon_image_uploads(image_content_type, qr_code_image_content_type):
+    messages = tuple(message for content_type, message in (
+        (image_content_type, 'invalid.image_content_type'),
+        (qr_code_image_content_type, 'invalid.qr_code_image_content_type'),
+    ) if not is_supported_image_type(content_type))
+    if messages:
+        return build_bad_request_response(*messages)
+    (image_upload, qr_code_image_upload) = tuple(
+        submit_task(s3_generate_coupon_image_upload, _make_upload_key(directory), content_type)
+        for directory, content_type in (('image', image_content_type), ('qr_code_image', qr_code_image_content_type))
+    )
+    return build_ok_response({
+        'image': image_upload.result(),
+        'qr_code_image': qr_code_image_upload.result(),
+    })
+
+
+def bulk_create_coupons(coupons):
+    prepared_coupons = tuple(
+        _prepare_coupon(coupon['title'], coupon['description'], coupon['image'], coupon.get('qr_code_image'),
+                        coupon.get('valid_from'), coupon.get('valid_until'))
+        for coupon in coupons
+    )
+    upload_futures = tuple(_submit_coupon_image_uploads(images) if not messages else ()
+                           for messages, _, images in prepared_coupons)
+    valid_count = sum(1 for messages, _, _ in prepared_coupons if not messages)
+    last_id = dynamodb_increment_atomic_count('coupon_id', valid_count) if valid_count else 0
+    ids = iter(range(last_id - valid_count + 1, last_id + 1))
+    coupon_ids = tuple(str(next(ids)).zfill(7) if not messages else None for messages, _, _ in prepared_coupons)
+    upload_futures = tuple(_submit_generated_qr_code_image(futures, _id) if _id is not None else futures
+                           for futures, _id in zip(upload_futures, coupon_ids))
+    results = []
+    result_coupons = []
+    for (messages, coupon, _), futures, _id in zip(prepared_coupons, upload_futures, coupon_ids):
+        if messages:
+            results.append({'messages': messages})
+            continue
+        if any(future.exception() is not None or future.result() is None for future in futures):
+            defer_task(release_coupon_images, tuple(future.result() for future in futures
+                                                    if future.exception() is None and future.result() is not None))
+            results.append({'messages': ('upload_failed',)})
+            continue
+        (image_s3_key, qr_code_image_s3_key) = (future.result() for future in futures)
+        result_coupon = {
+            'id': _id,
+            **coupon,
+            'image_s3_key': image_s3_key,
+            **_thumbnail_s3_key(image_s3_key),
+            'qr_code_image_s3_key': qr_code_image_s3_key,
+        }
+        result_coupons.append(result_coupon)
+        results.append({'coupon': result_coupon})
+    unwritten_ids = frozenset()
+    if result_coupons:
+        unwritten_coupons = dynamodb_batch_put_coupons(result_coupons)
+        if unwritten_coupons:
+            defer_task(release_coupon_images, tuple(coupon[f"{directory}_s3_key"] for coupon in unwritten_coupons
+                                                    for directory in _IMAGE_DIRECTORIES))
+        unwritten_ids = frozenset(coupon['id'] for coupon in unwritten_coupons)
+        result_coupons = tuple(coupon for coupon in result_coupons if coupon['id'] not in unwritten_ids)
+    set_metric_property('item_count', len(result_coupons))
+    return build_ok_response(tuple({'messages': ('write_failed',)}
+                                   if 'coupon' in result and result['coupon']['id'] in unwritten_ids else result
+                                   for result in results))
+
+
+def read_coupon(_id, if_none_match=None):
     get_coupon_result = dynamodb_get_coupon(_id)
     if 'Item' not in get_coupon_result:
         return build_not_found_response('coupon_not_found')
     coupon = get_coupon_result['Item']
-    return build_ok_response({**_delete_fixed_key(coupon), **_with_s3_urls(coupon)})
+    set_metric_property('item_count', 1)
+    etag = _make_etag(coupon)
+    if _matches_etag(if_none_match, etag):
+        return build_not_modified_response({'ETag': etag})
+    return build_ok_encoded_response(_encode_coupon(coupon), {'ETag': etag})
 
 
-def update_coupon(_id, title, description, image, qr_code_image):
-    get_coupon_result = dynamodb_get_coupon(_id)
-    if 'Item' not in get_coupon_result:
+def batch_read_coupons(ids):
+    batch_get_result = dynamodb_batch_get_coupons(tuple(dict.fromkeys(ids)))
+    coupons = {coupon['id']: coupon for coupon in batch_get_result['Items']}
+    unprocessed_ids = frozenset(batch_get_result.get('UnprocessedIds', ()))
+    set_metric_property('item_count', len(coupons))
+    return _build_coupons_response(len(ids), (
+        _encode_coupon(coupons[_id]) if _id in coupons else encode_json({'id': _id, 'messages': (
+            'coupon_unavailable' if _id in unprocessed_ids else 'coupon_not_found',
+        )})
+        for _id in ids
+    ))
+
+
+def update_coupon(_id, title, description, image, qr_code_image=None, valid_from=None, valid_until=None):
+    return _write_coupon(title, description, image, qr_code_image, valid_from, valid_until, lambda: _id,
+                         _replace_coupon)
+
+
+def patch_coupon(_id, fields):
+    # An empty valid_from or valid_until removes that end of the validity period.
+    coupon = {key: fields[key] for key in ('title', 'description', *_VALIDITY_NAMES)
+              if key in fields and not (key in _VALIDITY_NAMES and fields[key] == '')}
+    messages = validate_coupon(coupon)
+    if messages:
+        return build_bad_request_response(*messages)
+    images = {}
+    for directory in (directory for directory in _IMAGE_DIRECTORIES if directory in fields):
+        (messages, images[directory]) = _prepare_image(directory, fields[directory])
+        if messages:
+            return build_bad_request_response(*messages)
+    futures = {directory: _submit_coupon_image_upload(directory, image) for directory, image in images.items()}
+    image_s3_keys = dict(zip(futures, _wait_for_coupon_image_uploads(tuple(futures.values()))))
+    if None in image_s3_keys.values():
+        defer_task(release_coupon_images, tuple(key for key in image_s3_keys.values() if key is not None))
+        return build_bad_request_response(*(f"invalid.{directory}_upload_key"
+                                             for directory, key in image_s3_keys.items() if key is None))
+    attributes = {**coupon, **{f"{directory}_s3_key": key for directory, key in image_s3_keys.items()}}
+    # The old thumbnail goes with the old image, so a new image without one must not keep pointing at it.
+    removed_names = tuple(key for key in _VALIDITY_NAMES if fields.get(key) == '')
+    if 'image' in image_s3_keys:
+        attributes |= _thumbnail_s3_key(image_s3_keys['image'])
+        removed_names += ('thumbnail_s3_key',) if 'thumbnail_s3_key' not in attributes else ()
+    update_coupon_result = dynamodb_update_coupon(_id, attributes, removed_names)
+    if 'Attributes' not in update_coupon_result:
+        defer_task(release_coupon_images, tuple(image_s3_keys.values()))
+        if 'Item' in update_coupon_result:
+            return build_bad_request_response('invalid.coupon_validity_period')
         return build_not_found_response('coupon_not_found')
-    old_coupon = get_coupon_result['Item']
-    response = _write_coupon(title, description, image, qr_code_image, lambda: _id)
-    if response['statusCode'] == 200:
-        s3_delete_coupon_image(old_coupon['image_s3_key'])
-        s3_delete_coupon_image(old_coupon['qr_code_image_s3_key'])
-    return response
+    old_coupon = update_coupon_result['Attributes']
+    if image_s3_keys:
+        defer_task(release_coupon_images, tuple(old_coupon[f"{directory}_s3_key"] for directory in image_s3_keys))
+    result_coupon = {key: value for key, value in dynamodb_strip_index_attributes({**old_coupon, **attributes}).items()
+                     if key not in removed_names}
+    return build_ok_response(result_coupon)
 
 
 def delete_coupon(_id):
-    get_coupon_result = dynamodb_get_coupon(_id)
-    if 'Item' not in get_coupon_result:
+    delete_coupon_result = dynamodb_delete_coupon(_id)
+    if 'Attributes' not in delete_coupon_result:
         return build_not_found_response('coupon_not_found')
-    coupon = get_coupon_result['Item']
-    dynamodb_delete_coupon(coupon['id'])
-    s3_delete_coupon_image(coupon['image_s3_key'])
-    s3_delete_coupon_image(coupon['qr_code_image_s3_key'])
+    coupon = delete_coupon_result['Attributes']
+    defer_task(release_coupon_images, (coupon['image_s3_key'], coupon['qr_code_image_s3_key']))
     return build_ok_response(None)
 
 
-def query_coupons(last_evaluated_key):
-    query_coupons_result = dynamodb_query_coupons(last_evaluated_key)
-    return build_ok_response(
-        tuple({**_delete_fixed_key(coupon), **_with_s3_urls(coupon)}
-              for coupon in query_coupons_result['Items']),
-        {
-            **({'Last-Evaluated-Key': json.dumps(query_coupons_result['LastEvaluatedKey'])}
-               if 'LastEvaluatedKey' in query_coupons_result else {})
-        },
+@timed
+def expire_coupons(expired_coupons):
+    # Cleans up after coupons TTL has already deleted from the table, in stream order. Returns the sequence number of
+    # the first one that failed, from which the stream is to deliver the records again, or None.
+    for sequence_number, coupon in expired_coupons:
+        try:
+            release_expired_coupon_images(coupon['id'], tuple(coupon[f"{directory}_s3_key"]
+                                                              for directory in _IMAGE_DIRECTORIES))
+        except Exception:
+            _logger.exception('expiring coupon %s failed', coupon['id'])
+            return sequence_number
+    return None
+
+
+@timed
+def apply_coupon_changes(changes):
+    # Brings the catalog and the search index up to date with the changes the table's stream reported, so that
+    # writes never wait for them. A failure of either propagates for the stream to retry the records.
+    if not changes:
+        return
+    futures = (submit_task(update_coupon_catalog, changes), submit_task(update_coupon_search_index, changes))
+    concurrent.futures.wait(futures)
+    for future in futures:
+        future.result()
+
+
+def read_coupon_catalog(if_none_match=None):
+    catalog = load_coupon_catalog()
+    if catalog is None:
+        return build_not_found_response('catalog_not_found')
+    (version, coupons) = catalog
+    set_metric_property('item_count', len(coupons))
+    etag = _make_etag(version)
+    if _matches_etag(if_none_match, etag):
+        return build_not_modified_response({'ETag': etag})
+    return _build_coupons_response(len(coupons), (_encode_coupon(coupon) for coupon in coupons), {'ETag': etag})
+
+
+def search_coupons(query, offset=0, if_none_match=None, limit=_PAGINATION_COUNT):
+    if len(query) > _SEARCH_QUERY_MAX_LENGTH or not is_searchable(query):
+        return build_bad_request_response('invalid.query')
+    ids = search_coupon_ids(query)
+    if ids is None:
+        return build_not_found_response('search_index_not_found')
+    page_ids = ids[offset:offset + limit]
+    batch_get_result = dynamodb_batch_get_coupons(tuple(page_ids)) if page_ids else {'Items': []}
+    if 'UnprocessedIds' in batch_get_result:
+        return build_service_unavailable_response('coupon_unavailable')
+    coupons = {coupon['id']: coupon for coupon in batch_get_result['Items']}
+    # The index can run ahead of the table for a coupon being deleted.
+    items = [coupons[_id] for _id in page_ids if _id in coupons]
+    next_offset = offset + limit if offset + limit < len(ids) else None
+    set_metric_property('item_count', len(items))
+    etag = _make_etag([items, next_offset])
+    headers = {
+        'ETag': etag,
+        **({'Last-Evaluated-Key': json.dumps({'offset': next_offset})} if next_offset is not None else {}),
+    }
+    if _matches_etag(if_none_match, etag):
+        return build_not_modified_response(headers)
+    return _build_coupons_response(len(items), (_encode_coupon(coupon) for coupon in items), headers)
+
+
+def query_coupons(last_evaluated_key, if_none_match=None, limit=_PAGINATION_COUNT, active=False):
+    query_coupons_result = dynamodb_query_coupons(last_evaluated_key, limit, active)
+    # Clients scroll on, so the next page is fetched while this one is encoded and sent.
+    if 'LastEvaluatedKey' in query_coupons_result:
+        dynamodb_prefetch_coupons(query_coupons_result['LastEvaluatedKey'], limit, active)
+    set_metric_property('item_count', len(query_coupons_result['Items']))
+    etag = _make_etag([query_coupons_result['Items'], query_coupons_result.get('LastEvaluatedKey')])
+    headers = {
+        'ETag': etag,
+        # active_until in keys of the active listing comes back from DynamoDB as a whole Decimal.
+        **({'Last-Evaluated-Key': json.dumps(query_coupons_result['LastEvaluatedKey'], default=int)}
+           if 'LastEvaluatedKey' in query_coupons_result else {})
+    }
+    if _matches_etag(if_none_match, etag):
+        return build_not_modified_response(headers)
+    return _build_coupons_response(
+        len(query_coupons_result['Items']),
+        (_encode_coupon(coupon) for coupon in query_coupons_result['Items']),
+        headers,
     )
 
 
-def _write_coupon(title, description, image, qr_code_image, id_provider):
+def _write_coupon(title, description, image, qr_code_image, valid_from, valid_until, id_provider, writer):
+    (messages, coupon, images) = _prepare_coupon(title, description, image, qr_code_image, valid_from, valid_until)
+    if messages:
+        return build_bad_request_response(*messages)
+    futures = _submit_coupon_image_uploads(images)
+    try:
+        _id = id_provider()
+    except Exception:
+        _release_coupon_image_uploads(futures)
+        raise
+    futures = _submit_generated_qr_code_image(futures, _id)
+    (image_s3_key, qr_code_image_s3_key) = _wait_for_coupon_image_uploads(futures)
+    if image_s3_key is None or qr_code_image_s3_key is None:
+        defer_task(release_coupon_images, tuple(key for key in (image_s3_key, qr_code_image_s3_key) if key is not None))
+        return build_bad_request_response(*(message for key, message in (
+            (image_s3_key, 'invalid.image_upload_key'),
+            (qr_code_image_s3_key, 'invalid.qr_code_image_upload_key'),
+        ) if key is None))
+    result_coupon = writer({
+        'id': _id,
+        **coupon,
+        'image_s3_key': image_s3_key,
+        **_thumbnail_s3_key(image_s3_key),
+        'qr_code_image_s3_key': qr_code_image_s3_key,
+    })
+    if result_coupon is None:
+        defer_task(release_coupon_images, (image_s3_key, qr_code_image_s3_key))
+        return build_not_found_response('coupon_not_found')
+    return build_ok_response(result_coupon)
+
+
+def _prepare_coupon(title, description, image, qr_code_image, valid_from=None, valid_until=None):
     coupon = {
         'title': title,
         'description': description,
+        **{key: value for key, value in zip(_VALIDITY_NAMES, (valid_from, valid_until)) if value is not None},
     }
     validation_result = validate_coupon(coupon)
     if validation_result:
-        return build_bad_request_response(*validation_result)
-    (image_mime_type, image_body) = _extract_data_url(image)
-    if image_mime_type is None or image_body is None:
-        return build_bad_request_response('invalid.image')
-    (qr_code_image_mime_type, qr_code_image_body) = _extract_data_url(qr_code_image)
-    if qr_code_image_mime_type is None or qr_code_image_body is None:
-        return build_bad_request_response('invalid.qr_code_image')
-    image_object = s3_put_coupon_image(_make_s3_key('image'), image_body, image_mime_type)
-    qr_code_image_object = s3_put_coupon_image(_make_s3_key('qr_code_image'), qr_code_image_body,
-                                               qr_code_image_mime_type)
-    _id = id_provider()
-    dynamodb_put_coupon({
-        **coupon,
-        'id': _id,
-        'image_s3_key': image_object.key,
-        'qr_code_image_s3_key': qr_code_image_object.key,
-    })
-    result_coupon = dynamodb_get_coupon(_id)['Item']
-    return build_ok_response(_delete_fixed_key(result_coupon))
+        return validation_result, None, None
+    images = []
+    for directory, source in zip(_IMAGE_DIRECTORIES, (image, qr_code_image)):
+        (messages, prepared_image) = _prepare_image(directory, source)
+        if messages:
+            return messages, None, None
+        images.append(prepared_image)
+    return (), coupon, tuple(images)
+
+
+def _prepare_image(directory, source):
+    # An image is either a data URI or {'upload_key': key} for an object uploaded with a presigned POST.
+    # An omitted QR code is generated once the coupon ID is known, and is prepared as None.
+    if source is None:
+        if directory != 'qr_code_image' or not qr_code_generation_enabled():
+            return (f"invalid.{directory}",), None
+        return (), None
+    if type(source) is dict:
+        if not _is_upload_key(directory, source['upload_key']):
+            return (f"invalid.{directory}",), None
+        return (), (None, None, source['upload_key'])
+    (messages, mime_type, body) = decode_image_data_url(directory, source, _INLINE_IMAGE_MAX_BYTES)
+    if not messages and not is_coupon_image_within_pixel_limit(directory, body):
+        messages = (f"invalid.{directory}",)
+    return messages, (mime_type, body, None) if not messages else None
+
+
+def _is_upload_key(directory, key):
+    return re.fullmatch(f"{_UPLOAD_DIRECTORY}/{directory}/{_UUID_PATTERN}", key) is not None
+
+
+def _submit_coupon_image_uploads(images):
+    return tuple(_submit_coupon_image_upload(directory, image) for directory, image in zip(_IMAGE_DIRECTORIES, images))
+
+
+def _submit_coupon_image_upload(directory, image):
+    if image is None:
+        return None
+    (mime_type, body, upload_key) = image
+    if upload_key is not None:
+        return submit_task(put_uploaded_coupon_image, directory, upload_key)
+    return submit_task(put_coupon_image, directory, body, mime_type)
+
+
+def _wait_for_coupon_image_uploads(futures):
+    # Returns the keys, None for an upload key that was not found. When an upload fails, the references the others
+    # took are released before its exception is raised.
+    concurrent.futures.wait(tuple(future for future in futures if future is not None))
+    failed_future = next((future for future in futures if future is not None and future.exception() is not None),
+                         None)
+    if failed_future is not None:
+        _release_coupon_image_uploads(futures)
+        failed_future.result()
+    return tuple(future.result() if future is not None else None for future in futures)
+
+
+def _release_coupon_image_uploads(futures):
+    concurrent.futures.wait(tuple(future for future in futures if future is not None))
+    defer_task(release_coupon_images, tuple(future.result() for future in futures
+                                            if future is not None and future.exception() is None
+                                            and future.result() is not None))
+
+
+def _submit_generated_qr_code_image(futures, _id):
+    (image_future, qr_code_image_future) = futures
+    if qr_code_image_future is None:
+        qr_code_image_future = submit_task(put_generated_qr_code_image, make_coupon_qr_code_content(_id))
+    return image_future, qr_code_image_future
+
+
+def _put_coupon(coupon):
+    dynamodb_put_coupon(coupon)
+    return coupon
+
+
+def _replace_coupon(coupon):
+    replace_coupon_result = dynamodb_replace_coupon(coupon)
+    if 'Attributes' not in replace_coupon_result:
+        return None
+    old_coupon = replace_coupon_result['Attributes']
+    defer_task(release_coupon_images, (old_coupon['image_s3_key'], old_coupon['qr_code_image_s3_key']))
+    return coupon
 
 
-def _extract_data_url(source):
-    colon_index = source.find(':')
-    semicolon_index = source.find(';')
-    comma_index = source.find(',')
-    mime_type = source[(colon_index + 1):semicolon_index] if colon_index != -1 and semicolon_index != -1 else None
-    encoded_image = source[(comma_index + 1):] if comma_index != -1 else None
-    return mime_type, encoded_image
+def _make_upload_key(directory):
+    return f"{_UPLOAD_DIRECTORY}/{directory}/{str(uuid.uuid4())}"
 
 
-def _make_s3_key(directory):
-    return f"{directory}/{str(uuid.uuid4())}"
+def _thumbnail_s3_key(image_s3_key):
+    thumbnail_s3_key = coupon_image_thumbnail_key(image_s3_key)
+    return {'thumbnail_s3_key': thumbnail_s3_key} if thumbnail_s3_key is not None else {}
 
 
 def _with_s3_urls(coupon):
     return {
         'image_url': s3_generate_coupon_url(coupon['image_s3_key']),
+        **({'thumbnail_url': s3_generate_coupon_url(coupon['thumbnail_s3_key'])}
+           if 'thumbnail_s3_key' in coupon else {}),
         'qr_code_image_url': s3_generate_coupon_url(coupon['qr_code_image_s3_key']),
     }
 
 
-def _delete_fixed_key(coupon):
-    del coupon['fixed_key']
-    return coupon
+def _build_coupons_response(count, fragments, headers=None):
+    if count < _STREAMING_MIN_COUNT:
+        return build_ok_encoded_response(encode_json_array(fragments), headers)
+    return build_ok_streamed_response(iter_json_array(fragments), headers)
+
+
+@timed
+def _encode_coupon(coupon):
+    # A coupon version is identified by its attributes, which are all scalars.
+    key = (s3_coupon_url_epoch(), frozenset(coupon.items()))
+    fragment = _fragment_cache.get(key)
+    if fragment is None:
+        fields = dynamodb_strip_index_attributes(coupon)
+        fields.update(_with_s3_urls(coupon))
+        fragment = encode_json(fields)
+        _fragment_cache.put(key, fragment, s3_coupon_url_epoch_end())
+    return fragment
+
+
+def _make_etag(content):
+    # The presigned URLs in the body only change when their epoch does, so the epoch stands in for them.
+    # The ETag is weak because containers sign the same epoch with different, equally valid URLs.
+    digest = hashlib.sha256(json.dumps([content, s3_coupon_url_epoch()], sort_keys=True, ensure_ascii=False,
+                                       default=str).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def _matches_etag(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    candidates = tuple(candidate.strip() for candidate in if_none_match.split(','))
+    return '*' in candidates or etag in candidates or etag[len('W/'):] in candidates
 
 
 class Test(unittest.TestCase):
 
+    def setUp(self):
+        _fragment_cache.clear()
+
+    _PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    @classmethod
+    def _put_coupon_image(cls, directory, body, content_type):
+        name = body[len(cls._PNG_SIGNATURE):].decode()
+        return f"{directory}/{name}_hash"
+
     @mock.patch('coupon_action.dynamodb_put_coupon')
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    @mock.patch('coupon_action.dynamodb_increment_atomic_count')
-    @mock.patch('coupon_action.s3_put_coupon_image')
-    @mock.patch('coupon_action.uuid.uuid4')
-    def test_create_coupon(self, mock_uuid4, mock_s3_put_coupon_image, mock_dynamodb_increment_atomic_count,
-                           mock_dynamodb_get_coupon, mock_dynamodb_put_coupon):
-        mock_uuid4.return_value = 'fixed_uuid'
-        mock_s3_put_coupon_image.side_effect = [MagicMock(key='image_s3_key'), MagicMock(key='qr_code_image_s3_key')]
-        mock_dynamodb_increment_atomic_count.return_value = 1
-        mock_dynamodb_get_coupon.return_value = {'Item': {'id': '0000001', 'fixed_key': ''}}
-        response = create_coupon('title', 'description', 'data:image/png;base64,image',
-                                 'data:image/png;base64,qr_code_image')
-        self.assertEqual(build_ok_response({'id': '0000001'}), response)
-        mock_s3_put_coupon_image.assert_has_calls([
-            mock.call('image/fixed_uuid', 'image', 'image/png'),
-            mock.call('qr_code_image/fixed_uuid', 'qr_code_image', 'image/png'),
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    def test_create_coupon(self, mock_put_coupon_image, mock_dynamodb_allocate_atomic_count,
+                           mock_dynamodb_put_coupon):
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_allocate_atomic_count.return_value = 1
+        response = create_coupon('title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                                 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        self.assertEqual(build_ok_response({
+            'id': '0000001',
+            'title': 'title',
+            'description': 'description',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
+        }), response)
+        mock_put_coupon_image.assert_has_calls([
+            mock.call('image', self._PNG_SIGNATURE + b'image', 'image/png'),
+            mock.call('qr_code_image', self._PNG_SIGNATURE + b'qr_code_image', 'image/png'),
         ])
-        mock_dynamodb_increment_atomic_count.assert_called_once_with('coupon_id')
+        mock_dynamodb_allocate_atomic_count.assert_called_once_with('coupon_id', 10)
         mock_dynamodb_put_coupon.assert_called_once_with({
             'id': '0000001',
             'title': 'title',
             'description': 'description',
-            'image_s3_key': 'image_s3_key',
-            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
         })
-        mock_dynamodb_get_coupon.assert_called_once_with('0000001')
+
+    @mock.patch('coupon_action.dynamodb_put_coupon')
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_create_coupon_upload_failed(self, mock_release_coupon_images, mock_put_coupon_image,
+                                         mock_dynamodb_allocate_atomic_count, mock_dynamodb_put_coupon):
+        def put_coupon_image(directory, body, content_type):
+            if directory == 'qr_code_image':
+                raise RuntimeError('upload failed')
+            return self._put_coupon_image(directory, body, content_type)
+
+        mock_put_coupon_image.side_effect = put_coupon_image
+        mock_dynamodb_allocate_atomic_count.return_value = 1
+        with self.assertRaises(RuntimeError):
+            create_coupon('title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                          'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('image/image_hash',))
+        mock_dynamodb_put_coupon.assert_not_called()
+        # Both uploads are released when no ID could be allocated for them.
+        mock_release_coupon_images.reset_mock()
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_allocate_atomic_count.side_effect = RuntimeError('allocation failed')
+        with self.assertRaises(RuntimeError):
+            create_coupon('title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                          'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('image/image_hash', 'qr_code_image/qr_code_image_hash'))
+
+    @mock.patch('coupon_action.dynamodb_put_coupon')
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count', mock.MagicMock(return_value=1))
+    @mock.patch('coupon_action.put_coupon_image')
+    def test_create_coupon_validity(self, mock_put_coupon_image, mock_dynamodb_put_coupon):
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        images = ('data:image/png;base64,iVBORw0KGgppbWFnZQ==', 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        response = create_coupon('title', 'description', *images, valid_until='2026-02-01T00:00:00+09:00')
+        self.assertEqual('2026-02-01T00:00:00+09:00', json.loads(response['body'])['valid_until'])
+        self.assertEqual('2026-02-01T00:00:00+09:00', mock_dynamodb_put_coupon.call_args.args[0]['valid_until'])
+        self.assertNotIn('valid_from', mock_dynamodb_put_coupon.call_args.args[0])
+        self.assertEqual(build_bad_request_response('invalid.coupon_valid_from'),
+                         create_coupon('title', 'description', *images, valid_from='2026-02-01'))
+
+    @mock.patch('coupon_action.dynamodb_put_coupon')
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.coupon_image_thumbnail_key')
+    def test_create_coupon_thumbnail(self, mock_coupon_image_thumbnail_key, mock_put_coupon_image,
+                                     mock_dynamodb_allocate_atomic_count, mock_dynamodb_put_coupon):
+        mock_coupon_image_thumbnail_key.return_value = 'thumbnail/image_hash'
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_allocate_atomic_count.return_value = 1
+        response = create_coupon('title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                                 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        self.assertEqual(build_ok_response({
+            'id': '0000001',
+            'title': 'title',
+            'description': 'description',
+            'image_s3_key': 'image/image_hash',
+            'thumbnail_s3_key': 'thumbnail/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
+        }), response)
+        mock_coupon_image_thumbnail_key.assert_called_once_with('image/image_hash')
+
+    @mock.patch('coupon_action.dynamodb_put_coupon')
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.put_uploaded_coupon_image')
+    def test_create_coupon_uploaded_image(self, mock_put_uploaded_coupon_image, mock_put_coupon_image,
+                                          mock_dynamodb_allocate_atomic_count, mock_dynamodb_put_coupon):
+        upload_key = 'uploads/image/0b0e5b8a-4c3e-4a8e-9d64-2f7c2f9e1a10'
+        mock_put_uploaded_coupon_image.return_value = 'image/image_hash'
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_allocate_atomic_count.return_value = 1
+        response = create_coupon('title', 'description', {'upload_key': upload_key},
+                                 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        self.assertEqual(build_ok_response({
+            'id': '0000001',
+            'title': 'title',
+            'description': 'description',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
+        }), response)
+        mock_put_uploaded_coupon_image.assert_called_once_with('image', upload_key)
+        mock_put_coupon_image.assert_called_once_with('qr_code_image', self._PNG_SIGNATURE + b'qr_code_image',
+                                                      'image/png')
+        mock_dynamodb_put_coupon.assert_called_once()
+
+    @mock.patch('coupon_action.dynamodb_put_coupon')
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.put_uploaded_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_create_coupon_upload_not_found(self, mock_release_coupon_images, mock_put_uploaded_coupon_image,
+                                            mock_put_coupon_image, mock_dynamodb_allocate_atomic_count,
+                                            mock_dynamodb_put_coupon):
+        mock_put_uploaded_coupon_image.return_value = None
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_allocate_atomic_count.return_value = 1
+        response = create_coupon('title', 'description',
+                                 {'upload_key': 'uploads/image/0b0e5b8a-4c3e-4a8e-9d64-2f7c2f9e1a10'},
+                                 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
+        self.assertEqual(build_bad_request_response('invalid.image_upload_key'), response)
+        mock_dynamodb_put_coupon.assert_not_called()
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('qr_code_image/qr_code_image_hash',))
+
+    def test_create_coupon_invalid_upload_key(self):
+        for upload_key in ('uploads/qr_code_image/0b0e5b8a-4c3e-4a8e-9d64-2f7c2f9e1a10',
+                           'image/0b0e5b8a-4c3e-4a8e-9d64-2f7c2f9e1a10'):
+            self.assertEqual(build_bad_request_response('invalid.image'),
+                             create_coupon('title', 'description', {'upload_key': upload_key},
+                                           'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'))
+
+    @mock.patch('coupon_action.s3_generate_coupon_image_upload')
+    @mock.patch('coupon_action.uuid.uuid4')
+    def test_issue_coupon_image_uploads(self, mock_uuid4, mock_s3_generate_coupon_image_upload):
+        mock_uuid4.return_value = 'fixed_uuid'
+        mock_s3_generate_coupon_image_upload.side_effect = lambda key, content_type: {
+            'url': 'url', 'fields': {'key': key, 'Content-Type': content_type},
+        }
+        response = issue_coupon_image_uploads('image/png', 'image/webp')
+        self.assertEqual(build_ok_response({
+            'image': {'url': 'url', 'fields': {'key': 'uploads/image/fixed_uuid', 'Content-Type': 'image/png'}},
+            'qr_code_image': {
+                'url': 'url',
+                'fields': {'key': 'uploads/qr_code_image/fixed_uuid', 'Content-Type': 'image/webp'},
+            },
+        }), response)
+
+    def test_issue_coupon_image_uploads_invalid_content_type(self):
+        self.assertEqual(build_bad_request_response('invalid.image_content_type', 'invalid.qr_code_image_content_type'),
+                         issue_coupon_image_uploads('text/html', 'image/svg+xml'))
 
     def test_create_coupon_validation(self):
         self.assertEqual(
@@ -154,29 +644,161 @@ class Test(unittest.TestCase):
     def test_create_coupon_invalid_image(self):
         self.assertEqual(
             build_bad_request_response('invalid.image'),
-            create_coupon('title', '', 'invalid', 'data:image/png;base64,qr_code_image'),
+            create_coupon('title', '', 'invalid', 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'),
+        )
+        with mock.patch('coupon_action.is_coupon_image_within_pixel_limit', return_value=False):
+            self.assertEqual(
+                build_bad_request_response('invalid.image'),
+                create_coupon('title', '', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                              'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'),
+            )
+        self.assertEqual(
+            build_bad_request_response('invalid.image_type'),
+            create_coupon('title', '', 'data:image/jpeg;base64,iVBORw0KGgppbWFnZQ==',
+                          'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'),
         )
         self.assertEqual(
             build_bad_request_response('invalid.qr_code_image'),
-            create_coupon('title', '', 'data:image/png;base64,qr_code_image', ''),
+            create_coupon('title', '', 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl', ''),
         )
 
+    @mock.patch('coupon_action.dynamodb_batch_put_coupons')
+    @mock.patch('coupon_action.dynamodb_increment_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_bulk_create_coupons(self, mock_release_coupon_images, mock_put_coupon_image,
+                                 mock_dynamodb_increment_atomic_count, mock_dynamodb_batch_put_coupons):
+        def put_coupon_image(directory, body, content_type):
+            if body == self._PNG_SIGNATURE + b'failure':
+                raise Exception('failure')
+            return self._put_coupon_image(directory, body, content_type)
+
+        mock_put_coupon_image.side_effect = put_coupon_image
+        mock_dynamodb_increment_atomic_count.return_value = 12
+        mock_dynamodb_batch_put_coupons.return_value = []
+        response = bulk_create_coupons((
+            {'title': 'title_0', 'description': '', 'image': 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+             'qr_code_image': 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'},
+            {'title': '', 'description': '', 'image': '', 'qr_code_image': ''},
+            {'title': 'title_2', 'description': '', 'image': 'data:image/png;base64,iVBORw0KGgpmYWlsdXJl',
+             'qr_code_image': 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'},
+        ))
+        coupon = {
+            'id': '0000011',
+            'title': 'title_0',
+            'description': '',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
+        }
+        self.assertEqual(build_ok_response((
+            {'coupon': coupon},
+            {'messages': ('invalid.coupon_title_length',)},
+            {'messages': ('upload_failed',)},
+        )), response)
+        mock_dynamodb_increment_atomic_count.assert_called_once_with('coupon_id', 2)
+        mock_dynamodb_batch_put_coupons.assert_called_once_with([coupon])
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('qr_code_image/qr_code_image_hash',))
+
+    @mock.patch('coupon_action.dynamodb_batch_put_coupons')
+    @mock.patch('coupon_action.dynamodb_increment_atomic_count', mock.MagicMock(return_value=12))
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_bulk_create_coupons_write_failed(self, mock_release_coupon_images, mock_put_coupon_image,
+                                              mock_dynamodb_batch_put_coupons):
+        mock_put_coupon_image.side_effect = lambda directory, body, content_type: f"{directory}/{body[-1]}_hash"
+        mock_dynamodb_batch_put_coupons.side_effect = lambda coupons: [coupons[1]]
+        response = bulk_create_coupons(tuple(
+            {'title': f"title_{index}", 'description': '',
+             'image': f"data:image/png;base64,{base64.b64encode(self._PNG_SIGNATURE + bytes((index,))).decode()}",
+             'qr_code_image': f"data:image/png;base64,{base64.b64encode(self._PNG_SIGNATURE + b'q').decode()}"}
+            for index in range(2)
+        ))
+        results = json.loads(response['body'])
+        self.assertEqual('0000011', results[0]['coupon']['id'])
+        self.assertEqual({'messages': ['write_failed']}, results[1])
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('image/1_hash', 'qr_code_image/113_hash'))
+
+    @mock.patch('coupon_action.qr_code_generation_enabled', mock.MagicMock(return_value=True))
+    @mock.patch('coupon_action.dynamodb_batch_put_coupons')
+    @mock.patch('coupon_action.dynamodb_increment_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.put_generated_qr_code_image')
+    def test_bulk_create_coupons_generated_qr_code_image(self, mock_put_generated_qr_code_image, mock_put_coupon_image,
+                                                         mock_dynamodb_increment_atomic_count,
+                                                         mock_dynamodb_batch_put_coupons):
+        mock_put_generated_qr_code_image.side_effect = lambda content: f"qr_code_image/{content}_hash"
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_increment_atomic_count.return_value = 12
+        mock_dynamodb_batch_put_coupons.return_value = []
+        response = bulk_create_coupons((
+            {'title': 'title_0', 'description': '', 'image': 'data:image/png;base64,iVBORw0KGgppbWFnZQ=='},
+            {'title': 'title_1', 'description': '', 'image': 'data:image/png;base64,iVBORw0KGgppbWFnZQ=='},
+        ))
+        self.assertEqual(build_ok_response(tuple({'coupon': {
+            'id': _id,
+            'title': title,
+            'description': '',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': f"qr_code_image/{_id}_hash",
+        }} for _id, title in (('0000011', 'title_0'), ('0000012', 'title_1')))), response)
+        mock_put_generated_qr_code_image.assert_has_calls([mock.call('0000011'), mock.call('0000012')])
+
+    @mock.patch('coupon_action.qr_code_generation_enabled')
+    @mock.patch('coupon_action.dynamodb_put_coupon')
+    @mock.patch('coupon_action.dynamodb_allocate_atomic_count')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.put_generated_qr_code_image')
+    def test_create_coupon_generated_qr_code_image(self, mock_put_generated_qr_code_image, mock_put_coupon_image,
+                                                   mock_dynamodb_allocate_atomic_count, mock_dynamodb_put_coupon,
+                                                   mock_qr_code_generation_enabled):
+        mock_qr_code_generation_enabled.return_value = True
+        mock_put_generated_qr_code_image.return_value = 'qr_code_image/generated_hash'
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_allocate_atomic_count.return_value = 1
+        response = create_coupon('title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==')
+        self.assertEqual(build_ok_response({
+            'id': '0000001',
+            'title': 'title',
+            'description': 'description',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/generated_hash',
+        }), response)
+        mock_put_generated_qr_code_image.assert_called_once_with('0000001')
+        mock_put_coupon_image.assert_called_once_with('image', self._PNG_SIGNATURE + b'image', 'image/png')
+        mock_qr_code_generation_enabled.return_value = False
+        self.assertEqual(build_bad_request_response('invalid.qr_code_image'),
+                         create_coupon('title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ=='))
+
     @mock.patch('coupon_action.dynamodb_get_coupon')
     @mock.patch('coupon_action.s3_generate_coupon_url')
-    def test_read_coupon(self, mock_s3_generate_coupon_url, mock_dynamodb_get_coupon):
-        mock_dynamodb_get_coupon.return_value = {
-            'Item': {'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key', 'fixed_key': ''}
-        }
+    @mock.patch('coupon_action._make_etag')
+    def test_read_coupon(self, mock_make_etag, mock_s3_generate_coupon_url, mock_dynamodb_get_coupon):
+        coupon = {'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key', 'fixed_key': ''}
+        mock_dynamodb_get_coupon.return_value = {'Item': coupon}
         mock_s3_generate_coupon_url.side_effect = ['image_url', 'qr_code_image_url']
+        mock_make_etag.return_value = 'W/"etag"'
         response = read_coupon('id')
         self.assertEqual(build_ok_response({
             'image_s3_key': 'image_s3_key',
             'qr_code_image_s3_key': 'qr_code_image_s3_key',
             'image_url': 'image_url',
             'qr_code_image_url': 'qr_code_image_url',
-        }), response)
+        }, {'ETag': 'W/"etag"'}), response)
         mock_dynamodb_get_coupon.assert_called_once_with('id')
         mock_s3_generate_coupon_url.assert_has_calls([mock.call('image_s3_key'), mock.call('qr_code_image_s3_key')])
+        mock_make_etag.assert_called_once_with(coupon)
+
+    @mock.patch('coupon_action.dynamodb_get_coupon')
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    @mock.patch('coupon_action._make_etag')
+    def test_read_coupon_not_modified(self, mock_make_etag, mock_s3_generate_coupon_url, mock_dynamodb_get_coupon):
+        mock_dynamodb_get_coupon.return_value = {'Item': {'image_s3_key': 'image_s3_key', 'fixed_key': ''}}
+        mock_make_etag.return_value = 'W/"etag"'
+        response = read_coupon('id', 'W/"other", W/"etag"')
+        self.assertEqual(build_not_modified_response({'ETag': 'W/"etag"'}), response)
+        mock_s3_generate_coupon_url.assert_not_called()
 
     @mock.patch('coupon_action.dynamodb_get_coupon')
     def test_read_coupon_not_found(self, mock_dynamodb_get_coupon):
@@ -185,91 +807,313 @@ class Test(unittest.TestCase):
         self.assertEqual(build_not_found_response('coupon_not_found'), response)
         mock_dynamodb_get_coupon.assert_called_once_with('0000001')
 
-    @mock.patch('coupon_action.dynamodb_put_coupon')
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    @mock.patch('coupon_action.s3_put_coupon_image')
-    @mock.patch('coupon_action.s3_delete_coupon_image')
-    @mock.patch('coupon_action.uuid.uuid4')
-    def test_update_coupon(self, mock_uuid4, mock_s3_delete_coupon_image, mock_s3_put_coupon_image,
-                           mock_dynamodb_get_coupon, mock_dynamodb_put_coupon):
-        mock_uuid4.return_value = 'fixed_uuid'
-        mock_s3_put_coupon_image.side_effect = [MagicMock(key='image_s3_key'), MagicMock(key='qr_code_image_s3_key')]
-        mock_dynamodb_get_coupon.return_value = {'Item': {
+    @mock.patch('coupon_action.dynamodb_batch_get_coupons')
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    def test_batch_read_coupons(self, mock_s3_generate_coupon_url, mock_dynamodb_batch_get_coupons):
+        mock_dynamodb_batch_get_coupons.return_value = {'Items': [
+            {'id': '0000002', 'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key',
+             'fixed_key': ''},
+        ], 'UnprocessedIds': ('0000003',)}
+        mock_s3_generate_coupon_url.side_effect = ['image_url', 'qr_code_image_url']
+        response = batch_read_coupons(('0000001', '0000002', '0000001', '0000003'))
+        self.assertEqual(build_ok_response((
+            {'id': '0000001', 'messages': ('coupon_not_found',)},
+            {
+                'id': '0000002',
+                'image_s3_key': 'image_s3_key',
+                'qr_code_image_s3_key': 'qr_code_image_s3_key',
+                'image_url': 'image_url',
+                'qr_code_image_url': 'qr_code_image_url',
+            },
+            {'id': '0000001', 'messages': ('coupon_not_found',)},
+            {'id': '0000003', 'messages': ('coupon_unavailable',)},
+        )), response)
+        mock_dynamodb_batch_get_coupons.assert_called_once_with(('0000001', '0000002', '0000003'))
+
+    @mock.patch('coupon_action.dynamodb_replace_coupon')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_update_coupon(self, mock_release_coupon_images, mock_put_coupon_image, mock_dynamodb_replace_coupon):
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_replace_coupon.return_value = {'Attributes': {
             'id': '0000001',
-            'image_s3_key': 'image_s3_key',
-            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'image_s3_key': 'old_image_s3_key',
+            'qr_code_image_s3_key': 'old_qr_code_image_s3_key',
             'fixed_key': '',
         }}
-        response = update_coupon('0000001', 'title', 'description', 'data:image/png;base64,image',
-                                 'data:image/png;base64,qr_code_image')
+        response = update_coupon('0000001', 'title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                                 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
         self.assertEqual(build_ok_response({
             'id': '0000001',
-            'image_s3_key': 'image_s3_key',
-            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'title': 'title',
+            'description': 'description',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
         }), response)
-        mock_s3_put_coupon_image.assert_has_calls([
-            mock.call('image/fixed_uuid', 'image', 'image/png'),
-            mock.call('qr_code_image/fixed_uuid', 'qr_code_image', 'image/png'),
+        mock_put_coupon_image.assert_has_calls([
+            mock.call('image', self._PNG_SIGNATURE + b'image', 'image/png'),
+            mock.call('qr_code_image', self._PNG_SIGNATURE + b'qr_code_image', 'image/png'),
         ])
-        mock_dynamodb_put_coupon.assert_called_once_with({
+        mock_dynamodb_replace_coupon.assert_called_once_with({
             'id': '0000001',
             'title': 'title',
             'description': 'description',
-            'image_s3_key': 'image_s3_key',
-            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image/qr_code_image_hash',
         })
-        mock_dynamodb_get_coupon.assert_has_calls([mock.call('0000001'), mock.call('0000001')])
-        mock_s3_delete_coupon_image.assert_has_calls([mock.call('image_s3_key'), mock.call('qr_code_image_s3_key')])
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('old_image_s3_key', 'old_qr_code_image_s3_key'))
 
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    def test_update_coupon_validation(self, mock_dynamodb_get_coupon):
-        mock_dynamodb_get_coupon.return_value = {'Item': 'coupon'}
+    def test_update_coupon_validation(self):
         response = update_coupon('', '', '', '', '')
         self.assertEqual(build_bad_request_response('invalid.coupon_title_length'), response)
-        mock_dynamodb_get_coupon.assert_called_once_with('')
 
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    def test_update_coupon_invalid_image(self, mock_dynamodb_get_coupon):
-        mock_dynamodb_get_coupon.return_value = {'Item': 'coupon'}
+    def test_update_coupon_invalid_image(self):
         self.assertEqual(
             build_bad_request_response('invalid.image'),
-            create_coupon('title', '', 'invalid', 'data:image/png;base64,qr_code_image'),
+            update_coupon('0000001', 'title', '', 'invalid', 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'),
         )
         self.assertEqual(
             build_bad_request_response('invalid.qr_code_image'),
-            create_coupon('title', '', 'data:image/png;base64,qr_code_image', ''),
+            update_coupon('0000001', 'title', '', 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl', ''),
         )
 
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    def test_update_coupon_not_found(self, mock_dynamodb_get_coupon):
-        mock_dynamodb_get_coupon.return_value = {}
-        response = update_coupon('0000001', '', '', '', '')
+    @mock.patch('coupon_action.dynamodb_replace_coupon')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_update_coupon_not_found(self, mock_release_coupon_images, mock_put_coupon_image,
+                                     mock_dynamodb_replace_coupon):
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_replace_coupon.return_value = {}
+        response = update_coupon('0000001', 'title', 'description', 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                                 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl')
         self.assertEqual(build_not_found_response('coupon_not_found'), response)
-        mock_dynamodb_get_coupon.assert_called_once_with('0000001')
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('image/image_hash', 'qr_code_image/qr_code_image_hash'))
+
+    @mock.patch('coupon_action.dynamodb_update_coupon')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_patch_coupon(self, mock_release_coupon_images, mock_put_coupon_image, mock_dynamodb_update_coupon):
+        mock_dynamodb_update_coupon.return_value = {'Attributes': {
+            'id': '0000001',
+            'title': 'old_title',
+            'description': 'description',
+            'image_s3_key': 'old_image_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'fixed_key': '',
+        }}
+        response = patch_coupon('0000001', {'title': 'title'})
+        self.assertEqual(build_ok_response({
+            'id': '0000001',
+            'title': 'title',
+            'description': 'description',
+            'image_s3_key': 'old_image_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+        }), response)
+        mock_dynamodb_update_coupon.assert_called_once_with('0000001', {'title': 'title'}, ())
+        mock_put_coupon_image.assert_not_called()
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_not_called()
+
+    @mock.patch('coupon_action.dynamodb_update_coupon')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_patch_coupon_image(self, mock_release_coupon_images, mock_put_coupon_image,
+                                mock_dynamodb_update_coupon):
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_update_coupon.return_value = {'Attributes': {
+            'id': '0000001',
+            'image_s3_key': 'old_image_s3_key',
+            'thumbnail_s3_key': 'old_thumbnail_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+        }}
+        response = patch_coupon('0000001', {'image': 'data:image/png;base64,iVBORw0KGgppbWFnZQ=='})
+        self.assertEqual(build_ok_response({
+            'id': '0000001',
+            'image_s3_key': 'image/image_hash',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+        }), response)
+        mock_put_coupon_image.assert_called_once_with('image', self._PNG_SIGNATURE + b'image', 'image/png')
+        mock_dynamodb_update_coupon.assert_called_once_with('0000001', {'image_s3_key': 'image/image_hash'},
+                                                            ('thumbnail_s3_key',))
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('old_image_s3_key',))
+
+    @mock.patch('coupon_action.dynamodb_update_coupon')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_patch_coupon_upload_failed(self, mock_release_coupon_images, mock_put_coupon_image,
+                                        mock_dynamodb_update_coupon):
+        def put_coupon_image(directory, body, content_type):
+            if directory == 'image':
+                raise RuntimeError('upload failed')
+            return self._put_coupon_image(directory, body, content_type)
+
+        mock_put_coupon_image.side_effect = put_coupon_image
+        with self.assertRaises(RuntimeError):
+            patch_coupon('0000001', {'image': 'data:image/png;base64,iVBORw0KGgppbWFnZQ==',
+                                     'qr_code_image': 'data:image/png;base64,iVBORw0KGgpxcl9jb2RlX2ltYWdl'})
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('qr_code_image/qr_code_image_hash',))
+        mock_dynamodb_update_coupon.assert_not_called()
+
+    @mock.patch('coupon_action.dynamodb_update_coupon')
+    def test_patch_coupon_validity(self, mock_dynamodb_update_coupon):
+        mock_dynamodb_update_coupon.return_value = {'Attributes': {
+            'id': '0000001',
+            'valid_until': '2026-02-01T00:00:00Z',
+            'fixed_key': 'fixed_key',
+            'active_until': 1769904000,
+            'expires_at': 1772496000,
+        }}
+        response = patch_coupon('0000001', {'valid_from': '2026-01-01T00:00:00Z', 'valid_until': ''})
+        self.assertEqual(build_ok_response({'id': '0000001', 'valid_from': '2026-01-01T00:00:00Z'}), response)
+        mock_dynamodb_update_coupon.assert_called_once_with('0000001', {'valid_from': '2026-01-01T00:00:00Z'},
+                                                            ('valid_until',))
+        self.assertEqual(build_bad_request_response('invalid.coupon_validity_period'), patch_coupon('0000001', {
+            'valid_from': '2026-01-01T00:00:00Z', 'valid_until': '2025-12-31T00:00:00Z',
+        }))
+        mock_dynamodb_update_coupon.reset_mock()
+        self.assertEqual(build_ok_response({'id': '0000001'}), patch_coupon('0000001', {'valid_until': ''}))
+        mock_dynamodb_update_coupon.assert_called_once_with('0000001', {}, ('valid_until',))
+        # Only the stored coupon knows whether a single end still comes on the right side of the other.
+        mock_dynamodb_update_coupon.return_value = {'Item': {'id': {'S': '0000001'}}}
+        self.assertEqual(build_bad_request_response('invalid.coupon_validity_period'),
+                         patch_coupon('0000001', {'valid_from': '2026-03-01T00:00:00Z'}))
+
+    def test_patch_coupon_validation(self):
+        self.assertEqual(build_bad_request_response('invalid.coupon_description_length'),
+                         patch_coupon('0000001', {'description': 'x' * 101}))
+        self.assertEqual(build_bad_request_response('invalid.qr_code_image'),
+                         patch_coupon('0000001', {'qr_code_image': 'invalid'}))
+
+    @mock.patch('coupon_action.dynamodb_update_coupon')
+    @mock.patch('coupon_action.put_coupon_image')
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_patch_coupon_not_found(self, mock_release_coupon_images, mock_put_coupon_image,
+                                    mock_dynamodb_update_coupon):
+        mock_put_coupon_image.side_effect = self._put_coupon_image
+        mock_dynamodb_update_coupon.return_value = {}
+        response = patch_coupon('0000001', {'title': 'title', 'image': 'data:image/png;base64,iVBORw0KGgppbWFnZQ=='})
+        self.assertEqual(build_not_found_response('coupon_not_found'), response)
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('image/image_hash',))
 
     @mock.patch('coupon_action.dynamodb_delete_coupon')
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    @mock.patch('coupon_action.s3_delete_coupon_image')
-    def test_delete_coupon(self, mock_s3_delete_coupon_image, mock_dynamodb_get_coupon, mock_dynamodb_delete_coupon):
-        mock_dynamodb_get_coupon.return_value = {
-            'Item': {'id': '0000001', 'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key'}
-        }
+    @mock.patch('coupon_action.release_coupon_images')
+    def test_delete_coupon(self, mock_release_coupon_images, mock_dynamodb_delete_coupon):
+        mock_dynamodb_delete_coupon.return_value = {'Attributes': {
+            'id': '0000001',
+            'image_s3_key': 'image_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+        }}
         response = delete_coupon('0000001')
         self.assertEqual(build_ok_response(None), response)
-        mock_dynamodb_get_coupon.assert_called_once_with('0000001')
         mock_dynamodb_delete_coupon.assert_called_once_with('0000001')
-        mock_s3_delete_coupon_image.assert_has_calls([mock.call('image_s3_key'), mock.call('qr_code_image_s3_key')])
+        wait_deferred_tasks()
+        mock_release_coupon_images.assert_called_once_with(('image_s3_key', 'qr_code_image_s3_key'))
 
-    @mock.patch('coupon_action.dynamodb_get_coupon')
-    def test_delete_coupon_not_found(self, mock_dynamodb_get_coupon):
-        mock_dynamodb_get_coupon.return_value = {}
+    @mock.patch('coupon_action.release_expired_coupon_images')
+    def test_expire_coupons(self, mock_release_expired_coupon_images):
+        self.assertIsNone(expire_coupons([]))
+        mock_release_expired_coupon_images.assert_not_called()
+        expired_coupons = [
+            ('100', {'id': '0000001', 'image_s3_key': 'image/key1', 'qr_code_image_s3_key': 'qr_code_image/key1'}),
+            ('200', {'id': '0000002', 'image_s3_key': 'image/key2', 'qr_code_image_s3_key': 'qr_code_image/key2'}),
+            ('300', {'id': '0000003', 'image_s3_key': 'image/key3', 'qr_code_image_s3_key': 'qr_code_image/key3'}),
+        ]
+        self.assertIsNone(expire_coupons(expired_coupons))
+        mock_release_expired_coupon_images.assert_has_calls([
+            mock.call('0000001', ('image/key1', 'qr_code_image/key1')),
+            mock.call('0000002', ('image/key2', 'qr_code_image/key2')),
+            mock.call('0000003', ('image/key3', 'qr_code_image/key3')),
+        ])
+        mock_release_expired_coupon_images.reset_mock()
+        mock_release_expired_coupon_images.side_effect = [None, RuntimeError('failed')]
+        with self.assertLogs('coupon_action', 'ERROR'):
+            self.assertEqual('200', expire_coupons(expired_coupons))
+        self.assertEqual(2, mock_release_expired_coupon_images.call_count)
+
+    @mock.patch('coupon_action.update_coupon_catalog')
+    @mock.patch('coupon_action.update_coupon_search_index')
+    def test_apply_coupon_changes(self, mock_update_coupon_search_index, mock_update_coupon_catalog):
+        apply_coupon_changes({})
+        mock_update_coupon_catalog.assert_not_called()
+        mock_update_coupon_search_index.assert_not_called()
+        apply_coupon_changes({'0000001': ('100', None)})
+        mock_update_coupon_catalog.assert_called_once_with({'0000001': ('100', None)})
+        mock_update_coupon_search_index.assert_called_once_with({'0000001': ('100', None)})
+        mock_update_coupon_search_index.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            apply_coupon_changes({'0000001': ('100', None)})
+        self.assertEqual(2, mock_update_coupon_catalog.call_count)
+
+    @mock.patch('coupon_action.search_coupon_ids')
+    @mock.patch('coupon_action.dynamodb_batch_get_coupons')
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    @mock.patch('coupon_action._make_etag')
+    def test_search_coupons(self, mock_make_etag, mock_s3_generate_coupon_url, mock_dynamodb_batch_get_coupons,
+                            mock_search_coupon_ids):
+        self.assertEqual(build_bad_request_response('invalid.query'), search_coupons('a'))
+        self.assertEqual(build_bad_request_response('invalid.query'), search_coupons('x' * 101))
+        mock_search_coupon_ids.return_value = None
+        self.assertEqual(build_not_found_response('search_index_not_found'), search_coupons('query'))
+        mock_search_coupon_ids.return_value = ['0000003', '0000001', '0000002']
+        mock_dynamodb_batch_get_coupons.return_value = {'Items': [
+            {'id': '0000001', 'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key'},
+        ]}
+        mock_s3_generate_coupon_url.side_effect = lambda key: f"{key}_url"
+        mock_make_etag.return_value = 'W/"etag"'
+        self.assertEqual(build_ok_response([{
+            'id': '0000001',
+            'image_s3_key': 'image_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'image_url': 'image_s3_key_url',
+            'qr_code_image_url': 'qr_code_image_s3_key_url',
+        }], {'ETag': 'W/"etag"', 'Last-Evaluated-Key': '{"offset": 2}'}), search_coupons('query', limit=2))
+        mock_dynamodb_batch_get_coupons.assert_called_once_with(('0000003', '0000001'))
+        mock_search_coupon_ids.assert_called_with('query')
+        mock_dynamodb_batch_get_coupons.reset_mock()
+        self.assertEqual(build_ok_response([], {'ETag': 'W/"etag"'}), search_coupons('query', 4))
+        mock_dynamodb_batch_get_coupons.assert_not_called()
+        mock_dynamodb_batch_get_coupons.return_value = {'Items': [], 'UnprocessedIds': ('0000003',)}
+        self.assertEqual(build_service_unavailable_response('coupon_unavailable'), search_coupons('query'))
+
+    @mock.patch('coupon_action.load_coupon_catalog')
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    @mock.patch('coupon_action._make_etag')
+    def test_read_coupon_catalog(self, mock_make_etag, mock_s3_generate_coupon_url, mock_load_coupon_catalog):
+        mock_load_coupon_catalog.return_value = None
+        self.assertEqual(build_not_found_response('catalog_not_found'), read_coupon_catalog())
+        mock_load_coupon_catalog.return_value = ('"version"', [
+            {'id': '0000001', 'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key'},
+        ])
+        mock_s3_generate_coupon_url.side_effect = lambda key: f"{key}_url"
+        mock_make_etag.return_value = 'W/"etag"'
+        self.assertEqual(build_ok_response([{
+            'id': '0000001',
+            'image_s3_key': 'image_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'image_url': 'image_s3_key_url',
+            'qr_code_image_url': 'qr_code_image_s3_key_url',
+        }], {'ETag': 'W/"etag"'}), read_coupon_catalog())
+        mock_make_etag.assert_called_with('"version"')
+        self.assertEqual(build_not_modified_response({'ETag': 'W/"etag"'}), read_coupon_catalog('W/"etag"'))
+
+    @mock.patch('coupon_action.dynamodb_delete_coupon')
+    def test_delete_coupon_not_found(self, mock_dynamodb_delete_coupon):
+        mock_dynamodb_delete_coupon.return_value = {}
         response = delete_coupon('0000001')
         self.assertEqual(build_not_found_response('coupon_not_found'), response)
-        mock_dynamodb_get_coupon.assert_called_once_with('0000001')
+        mock_dynamodb_delete_coupon.assert_called_once_with('0000001')
 
     @mock.patch('coupon_action.dynamodb_query_coupons')
+    @mock.patch('coupon_action.dynamodb_prefetch_coupons')
     @mock.patch('coupon_action.s3_generate_coupon_url')
-    def test_query_coupons(self, mock_s3_generate_coupon_url, mock_dynamodb_query_coupons):
+    @mock.patch('coupon_action._make_etag', mock.MagicMock(return_value='W/"etag"'))
+    def test_query_coupons(self, mock_s3_generate_coupon_url, mock_dynamodb_prefetch_coupons,
+                           mock_dynamodb_query_coupons):
         mock_dynamodb_query_coupons.return_value = {
             'Items': [
                 {
@@ -303,22 +1147,102 @@ class Test(unittest.TestCase):
                     'qr_code_image_url': 'qr_code_image_url_1',
                 },
             ),
-            {'Last-Evaluated-Key': '{"key": "value"}'},
+            {'ETag': 'W/"etag"', 'Last-Evaluated-Key': '{"key": "value"}'},
         ), response)
-        mock_dynamodb_query_coupons.assert_called_once_with('lastKey')
+        mock_dynamodb_query_coupons.assert_called_once_with('lastKey', 20, False)
+        mock_dynamodb_prefetch_coupons.assert_called_once_with({'key': 'value'}, 20, False)
         mock_s3_generate_coupon_url.assert_has_calls([mock.call('image_s3_key_0'), mock.call('qr_code_image_s3_key_0'),
                                                       mock.call('image_s3_key_1'), mock.call('qr_code_image_s3_key_1')])
 
     @mock.patch('coupon_action.dynamodb_query_coupons')
-    def test_query_coupons_no_last_evaluated_key(self, mock_dynamodb_query_coupons):
+    @mock.patch('coupon_action.dynamodb_prefetch_coupons')
+    @mock.patch('coupon_action._make_etag', mock.MagicMock(return_value='W/"etag"'))
+    def test_query_coupons_no_last_evaluated_key(self, mock_dynamodb_prefetch_coupons, mock_dynamodb_query_coupons):
         mock_dynamodb_query_coupons.return_value = {'Items': []}
-        response = query_coupons(None)
-        self.assertEqual(build_ok_response(()), response)
-        mock_dynamodb_query_coupons.assert_called_once_with(None)
-
-    def test_extract_data_url(self):
-        self.assertEqual(('image/png', 'foo'), _extract_data_url('data:image/png;base64,foo'))
-        self.assertEqual((None, 'foo'), _extract_data_url('image/png;base64,foo'))
-        self.assertEqual((None, 'foo'), _extract_data_url('data:base64,foo'))
-        self.assertEqual(('image/png', None), _extract_data_url('data:image/png;foo'))
-        self.assertEqual((None, None), _extract_data_url('foo'))
+        response = query_coupons(None, limit=50)
+        self.assertEqual(build_ok_response((), {'ETag': 'W/"etag"'}), response)
+        mock_dynamodb_query_coupons.assert_called_once_with(None, 50, False)
+        mock_dynamodb_prefetch_coupons.assert_not_called()
+
+    @mock.patch('coupon_action.dynamodb_query_coupons')
+    @mock.patch('coupon_action.dynamodb_prefetch_coupons')
+    @mock.patch('coupon_action._make_etag', mock.MagicMock(return_value='W/"etag"'))
+    def test_query_coupons_active(self, mock_dynamodb_prefetch_coupons, mock_dynamodb_query_coupons):
+        last_evaluated_key = {'fixed_key': 'fixed_key', 'active_until': decimal.Decimal('1769904000'), 'id': '0000001'}
+        mock_dynamodb_query_coupons.return_value = {'Items': [], 'LastEvaluatedKey': last_evaluated_key}
+        response = query_coupons(None, limit=20, active=True)
+        self.assertEqual('{"fixed_key": "fixed_key", "active_until": 1769904000, "id": "0000001"}',
+                         response['headers']['Last-Evaluated-Key'])
+        mock_dynamodb_query_coupons.assert_called_once_with(None, 20, True)
+        mock_dynamodb_prefetch_coupons.assert_called_once_with(last_evaluated_key, 20, True)
+
+    @mock.patch('coupon_action.dynamodb_query_coupons')
+    @mock.patch('coupon_action.dynamodb_prefetch_coupons', mock.MagicMock())
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    @mock.patch('coupon_action._make_etag', mock.MagicMock(return_value='W/"etag"'))
+    def test_query_coupons_not_modified(self, mock_s3_generate_coupon_url, mock_dynamodb_query_coupons):
+        mock_dynamodb_query_coupons.return_value = {'Items': [{'image_s3_key': 'image_s3_key'}],
+                                                    'LastEvaluatedKey': {'id': '0000001'}}
+        response = query_coupons(None, '*')
+        self.assertEqual(build_not_modified_response({'ETag': 'W/"etag"', 'Last-Evaluated-Key': '{"id": "0000001"}'}),
+                         response)
+        mock_s3_generate_coupon_url.assert_not_called()
+
+    @mock.patch('coupon_action.dynamodb_query_coupons')
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    @mock.patch('coupon_action._make_etag', mock.MagicMock(return_value='W/"etag"'))
+    def test_query_coupons_streamed(self, mock_s3_generate_coupon_url, mock_dynamodb_query_coupons):
+        items = [{'id': str(i).zfill(7), 'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key',
+                  'fixed_key': ''} for i in range(_STREAMING_MIN_COUNT)]
+        mock_dynamodb_query_coupons.return_value = {'Items': items}
+        mock_s3_generate_coupon_url.side_effect = lambda key: f"{key}_url"
+        response = query_coupons(None, limit=_STREAMING_MIN_COUNT)
+        mock_s3_generate_coupon_url.assert_not_called()
+        self.assertEqual(build_ok_response(
+            [{**dynamodb_strip_index_attributes(item), 'image_url': 'image_s3_key_url',
+              'qr_code_image_url': 'qr_code_image_s3_key_url'} for item in items],
+            {'ETag': 'W/"etag"'},
+        ), {**response, 'body': ''.join(response['body'])})
+
+    @mock.patch('coupon_action.s3_generate_coupon_url')
+    @mock.patch('coupon_action.s3_coupon_url_epoch')
+    def test_encode_coupon(self, mock_s3_coupon_url_epoch, mock_s3_generate_coupon_url):
+        coupon = {'id': '0000001', 'image_s3_key': 'image_s3_key', 'qr_code_image_s3_key': 'qr_code_image_s3_key',
+                  'fixed_key': ''}
+        mock_s3_coupon_url_epoch.return_value = 1
+        mock_s3_generate_coupon_url.side_effect = lambda key: f"{key}_url"
+        fragment = _encode_coupon(coupon)
+        self.assertEqual({
+            'id': '0000001',
+            'image_s3_key': 'image_s3_key',
+            'qr_code_image_s3_key': 'qr_code_image_s3_key',
+            'image_url': 'image_s3_key_url',
+            'qr_code_image_url': 'qr_code_image_s3_key_url',
+        }, json.loads(fragment))
+        self.assertIs(fragment, _encode_coupon(dict(coupon)))
+        self.assertEqual(2, mock_s3_generate_coupon_url.call_count)
+        _encode_coupon({**coupon, 'title': 'title'})
+        mock_s3_coupon_url_epoch.return_value = 2
+        _encode_coupon(coupon)
+        self.assertEqual(6, mock_s3_generate_coupon_url.call_count)
+        self.assertEqual('thumbnail_s3_key_url', json.loads(_encode_coupon({
+            **coupon, 'thumbnail_s3_key': 'thumbnail_s3_key',
+        }))['thumbnail_url'])
+
+    @mock.patch('coupon_action.s3_coupon_url_epoch')
+    def test_make_etag(self, mock_s3_coupon_url_epoch):
+        mock_s3_coupon_url_epoch.return_value = 1
+        etag = _make_etag({'id': '0000001', 'title': 'title'})
+        self.assertRegex(etag, r'^W/"[0-9a-f]{32}"$')
+        self.assertEqual(etag, _make_etag({'title': 'title', 'id': '0000001'}))
+        self.assertNotEqual(etag, _make_etag({'id': '0000001', 'title': 'other'}))
+        mock_s3_coupon_url_epoch.return_value = 2
+        self.assertNotEqual(etag, _make_etag({'id': '0000001', 'title': 'title'}))
+
+    def test_matches_etag(self):
+        self.assertFalse(_matches_etag(None, 'W/"etag"'))
+        self.assertTrue(_matches_etag('W/"etag"', 'W/"etag"'))
+        self.assertTrue(_matches_etag('"etag"', 'W/"etag"'))
+        self.assertTrue(_matches_etag('"other" ,W/"etag"', 'W/"etag"'))
+        self.assertTrue(_matches_etag('*', 'W/"etag"'))
+        self.assertFalse(_matches_etag('W/"other"', 'W/"etag"'))
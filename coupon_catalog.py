@@ -0,0 +1,182 @@
+import gzip
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from dynamodb_coupons import dynamodb_scan_coupons, dynamodb_strip_index_attributes, is_newer_coupon_version
+from s3_coupons import s3_get_coupon_catalog, s3_put_coupon_catalog
+from json_encoding import encode_json
+from metrics import timed
+
+
+# The whole catalog is one gzipped JSON object holding the coupons sorted by id, so that clients can take it in one
+# request. The table's stream applies changes to it off the write path, with a conditional put that starts over
+# when another invocation got there first, and leaves it alone until rebuild_coupon_catalog has created it.
+# Each coupon's version is the sequence number of the record last applied to it, so a replayed record is skipped.
+_CHECK_SECONDS = 10
+_UPDATE_MAX_ATTEMPTS = 5
+_UPDATE_BACKOFF_SECONDS = 0.05
+# Every update pays for compressing the catalog, while it only ever travels between S3 and Lambda.
+_COMPRESS_LEVEL = 1
+
+# (etag, coupons, versions, checked_at) of the version last seen by this container.
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+@timed
+def load_coupon_catalog():
+    # Returns (etag, coupons), or None before the catalog is built. Revalidated at most every _CHECK_SECONDS.
+    with _snapshot_lock:
+        snapshot = _snapshot
+    if snapshot is None or snapshot[3] + _CHECK_SECONDS <= time.time():
+        snapshot = _fetch()
+    return snapshot[:2] if snapshot is not None else None
+
+
+@timed
+def update_coupon_catalog(changes):
+    # changes is {id: (version, coupon)} as dynamodb_coupon_changes returns it.
+    for attempt in range(_UPDATE_MAX_ATTEMPTS):
+        current = _fetch()
+        if current is None:
+            return
+        (etag, coupons, versions) = current[:3]
+        changes = {_id: change for _id, change in changes.items()
+                   if is_newer_coupon_version(change[0], versions.get(_id))}
+        if not changes:
+            return
+        catalog = {coupon['id']: coupon for coupon in coupons}
+        versions = dict(versions)
+        for _id, (version, coupon) in changes.items():
+            if coupon is None:
+                catalog.pop(_id, None)
+                versions.pop(_id, None)
+            else:
+                catalog[_id] = coupon
+                versions[_id] = version
+        if _put(catalog, versions, etag):
+            return
+        time.sleep(_UPDATE_BACKOFF_SECONDS * 2 ** attempt)
+    raise RuntimeError(f"catalog update conflicted {_UPDATE_MAX_ATTEMPTS} times")
+
+
+@timed
+def rebuild_coupon_catalog():
+    for attempt in range(_UPDATE_MAX_ATTEMPTS):
+        current = _fetch()
+        catalog = {coupon['id']: dynamodb_strip_index_attributes(coupon) for coupon in dynamodb_scan_coupons()}
+        # The scan knows no sequence numbers, so any record the stream delivers afterwards applies.
+        if _put(catalog, {}, current[0] if current is not None else None):
+            return len(catalog)
+        time.sleep(_UPDATE_BACKOFF_SECONDS * 2 ** attempt)
+    raise RuntimeError(f"catalog rebuild conflicted {_UPDATE_MAX_ATTEMPTS} times")
+
+
+def _fetch():
+    # A conditional GET, so an unchanged catalog is neither downloaded nor decoded again.
+    with _snapshot_lock:
+        snapshot = _snapshot
+    result = s3_get_coupon_catalog(snapshot[0] if snapshot is not None else None)
+    if result is None:
+        return None
+    if 'Body' not in result:
+        return _remember(result['ETag'], *snapshot[1:3])
+    body = json.loads(gzip.decompress(result['Body']))
+    return _remember(result['ETag'], body['coupons'], body['versions'])
+
+
+def _put(catalog, versions, if_match):
+    coupons = sorted(catalog.values(), key=lambda coupon: coupon['id'])
+    body = encode_json({'coupons': coupons, 'versions': versions})
+    etag = s3_put_coupon_catalog(gzip.compress(body.encode(), _COMPRESS_LEVEL, mtime=0), if_match)
+    if etag is None:
+        return False
+    _remember(etag, coupons, versions)
+    return True
+
+
+def _remember(etag, coupons, versions):
+    global _snapshot
+    snapshot = (etag, coupons, versions, time.time())
+    with _snapshot_lock:
+        _snapshot = snapshot
+    return snapshot
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        global _snapshot
+        _snapshot = None
+        self._objects = []
+        self._conflicts = 0
+        patches = (
+            mock.patch('coupon_catalog.s3_get_coupon_catalog', side_effect=self._get),
+            mock.patch('coupon_catalog.s3_put_coupon_catalog', side_effect=self._put),
+            mock.patch('coupon_catalog.time.sleep'),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _get(self, if_none_match=None):
+        if not self._objects:
+            return None
+        etag = f'"{len(self._objects)}"'
+        return {'ETag': etag} if etag == if_none_match else {'ETag': etag, 'Body': self._objects[-1]}
+
+    def _put(self, body, if_match):
+        if self._conflicts or if_match != (f'"{len(self._objects)}"' if self._objects else None):
+            self._conflicts = max(self._conflicts - 1, 0)
+            return None
+        self._objects.append(body)
+        return f'"{len(self._objects)}"'
+
+    def _catalog(self):
+        return json.loads(gzip.decompress(self._objects[-1]))['coupons']
+
+    @mock.patch('coupon_catalog.dynamodb_scan_coupons')
+    def test_rebuild_coupon_catalog(self, mock_dynamodb_scan_coupons):
+        mock_dynamodb_scan_coupons.return_value = [
+            {'id': '0000002', 'fixed_key': 'fixed_key', 'active_until': 1769904000}, {'id': '0000001'},
+        ]
+        self._conflicts = 1
+        self.assertEqual(2, rebuild_coupon_catalog())
+        self.assertEqual([{'id': '0000001'}, {'id': '0000002'}], self._catalog())
+        self.assertEqual(('"1"', [{'id': '0000001'}, {'id': '0000002'}]), load_coupon_catalog())
+
+    def test_update_coupon_catalog(self):
+        update_coupon_catalog({'0000001': ('100', {'id': '0000001'})})
+        self.assertEqual([], self._objects)
+        self._objects.append(gzip.compress(b'{"coupons": [{"id": "0000001"}, {"id": "0000002"}], "versions": {}}'))
+        self._conflicts = 2
+        update_coupon_catalog({
+            '0000003': ('300', {'id': '0000003'}),
+            '0000001': ('100', {'id': '0000001', 'title': 'title'}),
+            '0000002': ('200', None),
+        })
+        self.assertEqual([{'id': '0000001', 'title': 'title'}, {'id': '0000003'}], self._catalog())
+        self.assertEqual({'0000001': '100', '0000003': '300'},
+                         json.loads(gzip.decompress(self._objects[-1]))['versions'])
+        # A replayed record is no newer than the one already applied.
+        update_coupon_catalog({'0000001': ('100', {'id': '0000001', 'title': 'replayed'}), '0000003': ('90', None)})
+        self.assertEqual(2, len(self._objects))
+        update_coupon_catalog({'0000001': ('1000', {'id': '0000001', 'title': 'newer'})})
+        self.assertEqual([{'id': '0000001', 'title': 'newer'}, {'id': '0000003'}], self._catalog())
+        self._conflicts = _UPDATE_MAX_ATTEMPTS
+        with self.assertRaises(RuntimeError):
+            update_coupon_catalog({'0000001': ('2000', None)})
+
+    @mock.patch('coupon_catalog.time.time')
+    def test_load_coupon_catalog(self, mock_time):
+        mock_time.return_value = 100
+        self.assertIsNone(load_coupon_catalog())
+        self._objects.append(gzip.compress(b'{"coupons": [{"id": "0000001"}], "versions": {}}'))
+        self.assertEqual(('"1"', [{'id': '0000001'}]), load_coupon_catalog())
+        self._objects.append(gzip.compress(b'{"coupons": [], "versions": {}}'))
+        self.assertEqual(('"1"', [{'id': '0000001'}]), load_coupon_catalog())
+        mock_time.return_value = 110
+        self.assertEqual(('"2"', []), load_coupon_catalog())
@@ -0,0 +1,359 @@
+import hashlib
+import re
+import time
+import unittest
+from unittest import mock
+
+from dynamodb_atomic_counts import (dynamodb_increment_atomic_count, dynamodb_add_reference, dynamodb_get_reference,
+                                    dynamodb_mark_reference_stored, dynamodb_claim_reference_deletion,
+                                    dynamodb_clear_reference_deletion, dynamodb_put_marker)
+from s3_coupons import s3_put_coupon_image, s3_get_uploaded_coupon_image, s3_delete_coupon_images
+from image_processing import image_pipeline_id, thumbnails_enabled, is_within_pixel_limit, process_image
+from image_validation import matches_image_type
+from qr_codes import generate_qr_code_png
+from metrics import timed
+
+
+_PROCESSED_DIRECTORY = 'image'
+_THUMBNAIL_DIRECTORY = 'thumbnail'
+_QR_CODE_DIRECTORY = 'qr_code_image'
+_GENERATED_QR_CODE_NAMESPACE = 'generated'
+_PROCESSED_KEY_PATTERN = f"{_PROCESSED_DIRECTORY}/([0-9a-f]{{64}})"
+_DELETION_WAIT_SECONDS = 0.05
+_DELETION_WAIT_ATTEMPTS = 20
+# Longer than a Lambda invocation can run, so a claim this old was left by a release that died holding it.
+_DELETION_CLAIM_TIMEOUT_MILLISECONDS = 15 * 60 * 1000
+
+
+@timed
+def put_coupon_image(directory, body, content_type):
+    pipeline_id = image_pipeline_id() if directory == _PROCESSED_DIRECTORY else None
+    key = f"{directory}/{_hash_image(body, content_type, pipeline_id)}"
+    if pipeline_id is None:
+        _acquire_reference(key, lambda: s3_put_coupon_image(key, body, content_type))
+    else:
+        _acquire_reference(key, lambda: _put_processed_coupon_image(key, body, content_type))
+    return key
+
+
+@timed
+def put_generated_qr_code_image(content):
+    key = f"{_QR_CODE_DIRECTORY}/{_hash_image(content.encode(), 'image/png', _GENERATED_QR_CODE_NAMESPACE)}"
+    _acquire_reference(key, lambda: s3_put_coupon_image(key, generate_qr_code_png(content), 'image/png'))
+    return key
+
+
+def coupon_image_thumbnail_key(key):
+    # Only meaningful for a key just returned by put_coupon_image, whose thumbnail follows the current settings.
+    match = re.fullmatch(_PROCESSED_KEY_PATTERN, key)
+    if match is None or not thumbnails_enabled():
+        return None
+    return f"{_THUMBNAIL_DIRECTORY}/{match.group(1)}"
+
+
+def is_coupon_image_within_pixel_limit(directory, body):
+    # Only processed images are decoded.
+    return directory != _PROCESSED_DIRECTORY or is_within_pixel_limit(body)
+
+
+@timed
+def put_uploaded_coupon_image(directory, upload_key):
+    uploaded = s3_get_uploaded_coupon_image(upload_key)
+    if (uploaded is None or not matches_image_type(uploaded[1], uploaded[0])
+            or not is_coupon_image_within_pixel_limit(directory, uploaded[0])):
+        return None
+    return put_coupon_image(directory, *uploaded)
+
+
+@timed
+def release_coupon_images(keys):
+    _delete_unreferenced_coupon_images(tuple(key for key in keys
+                                             if dynamodb_increment_atomic_count(_reference_count_key(key), -1) <= 0))
+
+
+@timed
+def release_expired_coupon_images(coupon_id, keys):
+    # The stream delivers a TTL deletion again after a failure, so the references are released only the first time,
+    # and a failure between the marker and the releases leaves the objects behind rather than deleting shared ones.
+    # Deleting what is unreferenced is safe to repeat, as the claims are only taken on counts at zero.
+    if not dynamodb_put_marker(f"expired:{coupon_id}"):
+        _delete_unreferenced_coupon_images(keys)
+        return
+    release_coupon_images(keys)
+
+
+def _delete_unreferenced_coupon_images(keys):
+    claims = {}
+    for key in keys:
+        claimed_at = int(time.time() * 1000)
+        if dynamodb_claim_reference_deletion(_reference_count_key(key), claimed_at):
+            claims[key] = claimed_at
+    if claims:
+        s3_delete_coupon_images(tuple(claims) + tuple(
+            f"{_THUMBNAIL_DIRECTORY}/{match.group(1)}" for match in (
+                re.fullmatch(_PROCESSED_KEY_PATTERN, key) for key in claims
+            ) if match is not None
+        ))
+        for key, claimed_at in claims.items():
+            dynamodb_clear_reference_deletion(_reference_count_key(key), claimed_at)
+
+
+def _put_processed_coupon_image(key, body, content_type):
+    ((body, content_type), thumbnail) = process_image(body, content_type)
+    s3_put_coupon_image(key, body, content_type)
+    if thumbnail is not None:
+        (thumbnail_body, thumbnail_content_type) = thumbnail
+        s3_put_coupon_image(coupon_image_thumbnail_key(key), thumbnail_body, thumbnail_content_type)
+
+
+def _hash_image(body, content_type, pipeline_id):
+    # Covers the processing settings, so that an image is never shared with one processed differently.
+    digest = hashlib.sha256()
+    if pipeline_id is not None:
+        digest.update(f"{pipeline_id}\n".encode())
+    digest.update(f"{content_type}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _acquire_reference(key, put):
+    # Whoever finds the objects unmarked puts them itself, which is harmless as the key decides their content.
+    reference = dynamodb_add_reference(_reference_count_key(key))
+    try:
+        reference = _wait_for_deletion(key, reference)
+        if not reference.get('object_stored'):
+            put()
+            dynamodb_mark_reference_stored(_reference_count_key(key))
+    except Exception:
+        release_coupon_images((key,))
+        raise
+
+
+def _wait_for_deletion(key, reference):
+    # No deletion can be claimed once this reference is counted, so only one claimed before it is waited out.
+    for _ in range(_DELETION_WAIT_ATTEMPTS):
+        if 'deletion_claimed_at' not in reference:
+            return reference
+        claimed_at = reference['deletion_claimed_at']
+        if time.time() * 1000 - claimed_at > _DELETION_CLAIM_TIMEOUT_MILLISECONDS:
+            dynamodb_clear_reference_deletion(_reference_count_key(key), claimed_at)
+        else:
+            time.sleep(_DELETION_WAIT_SECONDS)
+        reference = dynamodb_get_reference(_reference_count_key(key))
+    if 'deletion_claimed_at' in reference:
+        raise RuntimeError(f"{key} is still being deleted")
+    return reference
+
+
+def _reference_count_key(key):
+    return f"references:{key}"
+
+
+class Test(unittest.TestCase):
+
+    @staticmethod
+    def _digest(*lines):
+        return hashlib.sha256(b'\n'.join(lines)).hexdigest()
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value=None))
+    @mock.patch('coupon_images.dynamodb_mark_reference_stored')
+    @mock.patch('coupon_images.dynamodb_add_reference')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    def test_put_coupon_image(self, mock_s3_put_coupon_image, mock_dynamodb_add_reference,
+                              mock_dynamodb_mark_reference_stored):
+        key = f"image/{self._digest(b'image/png', b'image')}"
+        mock_dynamodb_add_reference.side_effect = [{'current_number': 1}, {'current_number': 2, 'object_stored': True}]
+        self.assertEqual(key, put_coupon_image('image', b'image', 'image/png'))
+        self.assertEqual(key, put_coupon_image('image', b'image', 'image/png'))
+        mock_s3_put_coupon_image.assert_called_once_with(key, b'image', 'image/png')
+        mock_dynamodb_add_reference.assert_has_calls([mock.call(f"references:{key}")] * 2)
+        mock_dynamodb_mark_reference_stored.assert_called_once_with(f"references:{key}")
+        self.assertNotEqual(_hash_image(b'image', 'image/png', None), _hash_image(b'image', 'image/webp', None))
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value=None))
+    @mock.patch('coupon_images.dynamodb_mark_reference_stored')
+    @mock.patch('coupon_images.dynamodb_add_reference')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    def test_put_coupon_image_not_stored_yet(self, mock_s3_put_coupon_image, mock_dynamodb_add_reference,
+                                             mock_dynamodb_mark_reference_stored):
+        # The writer that added the first reference may still be putting the object, or may fail to.
+        key = f"image/{self._digest(b'image/png', b'image')}"
+        mock_dynamodb_add_reference.return_value = {'current_number': 2}
+        self.assertEqual(key, put_coupon_image('image', b'image', 'image/png'))
+        mock_s3_put_coupon_image.assert_called_once_with(key, b'image', 'image/png')
+        mock_dynamodb_mark_reference_stored.assert_called_once_with(f"references:{key}")
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value=None))
+    @mock.patch('coupon_images.dynamodb_add_reference', mock.MagicMock(return_value={'current_number': 1}))
+    @mock.patch('coupon_images.dynamodb_clear_reference_deletion')
+    @mock.patch('coupon_images.dynamodb_claim_reference_deletion')
+    @mock.patch('coupon_images.dynamodb_increment_atomic_count')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    @mock.patch('coupon_images.s3_delete_coupon_images')
+    def test_put_coupon_image_failed(self, mock_s3_delete_coupon_images, mock_s3_put_coupon_image,
+                                     mock_dynamodb_increment_atomic_count, mock_dynamodb_claim_reference_deletion,
+                                     mock_dynamodb_clear_reference_deletion):
+        digest = self._digest(b'image/png', b'image')
+        mock_dynamodb_increment_atomic_count.return_value = 0
+        mock_dynamodb_claim_reference_deletion.return_value = True
+        mock_s3_put_coupon_image.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            put_coupon_image('image', b'image', 'image/png')
+        mock_dynamodb_increment_atomic_count.assert_called_once_with(f"references:image/{digest}", -1)
+        mock_s3_delete_coupon_images.assert_called_once_with((f"image/{digest}", f"thumbnail/{digest}"))
+        mock_dynamodb_clear_reference_deletion.assert_called_once_with(
+            f"references:image/{digest}", mock_dynamodb_claim_reference_deletion.call_args.args[1])
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value=None))
+    @mock.patch('coupon_images.dynamodb_mark_reference_stored', mock.MagicMock())
+    @mock.patch('coupon_images.time.sleep')
+    @mock.patch('coupon_images.time.time')
+    @mock.patch('coupon_images.dynamodb_clear_reference_deletion')
+    @mock.patch('coupon_images.dynamodb_get_reference')
+    @mock.patch('coupon_images.dynamodb_add_reference')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    def test_put_coupon_image_being_deleted(self, mock_s3_put_coupon_image, mock_dynamodb_add_reference,
+                                           mock_dynamodb_get_reference, mock_dynamodb_clear_reference_deletion,
+                                           mock_time, mock_sleep):
+        key = f"image/{self._digest(b'image/png', b'image')}"
+        mock_time.return_value = 1000
+        mock_dynamodb_add_reference.return_value = {'current_number': 1, 'deletion_claimed_at': 999000}
+        mock_dynamodb_get_reference.side_effect = [{'current_number': 1, 'deletion_claimed_at': 999000},
+                                                   {'current_number': 1}]
+        self.assertEqual(key, put_coupon_image('image', b'image', 'image/png'))
+        self.assertEqual(2, mock_sleep.call_count)
+        mock_s3_put_coupon_image.assert_called_once_with(key, b'image', 'image/png')
+        mock_dynamodb_clear_reference_deletion.assert_not_called()
+        mock_s3_put_coupon_image.reset_mock()
+        mock_dynamodb_add_reference.return_value = {'current_number': 1, 'deletion_claimed_at': 1000}
+        mock_dynamodb_get_reference.side_effect = [{'current_number': 1}]
+        self.assertEqual(key, put_coupon_image('image', b'image', 'image/png'))
+        mock_dynamodb_clear_reference_deletion.assert_called_once_with(f"references:{key}", 1000)
+        mock_s3_put_coupon_image.assert_called_once_with(key, b'image', 'image/png')
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value=None))
+    @mock.patch('coupon_images.time.sleep', mock.MagicMock())
+    @mock.patch('coupon_images.time.time', mock.MagicMock(return_value=1000))
+    @mock.patch('coupon_images.dynamodb_get_reference')
+    @mock.patch('coupon_images.dynamodb_add_reference')
+    @mock.patch('coupon_images.release_coupon_images')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    def test_put_coupon_image_deletion_timeout(self, mock_s3_put_coupon_image, mock_release_coupon_images,
+                                               mock_dynamodb_add_reference, mock_dynamodb_get_reference):
+        key = f"image/{self._digest(b'image/png', b'image')}"
+        mock_dynamodb_add_reference.return_value = {'current_number': 1, 'deletion_claimed_at': 999000}
+        mock_dynamodb_get_reference.return_value = {'current_number': 1, 'deletion_claimed_at': 999000}
+        with self.assertRaises(RuntimeError):
+            put_coupon_image('image', b'image', 'image/png')
+        mock_s3_put_coupon_image.assert_not_called()
+        mock_release_coupon_images.assert_called_once_with((key,))
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value='pipeline'))
+    @mock.patch('coupon_images.thumbnails_enabled', mock.MagicMock(return_value=True))
+    @mock.patch('coupon_images.dynamodb_add_reference', mock.MagicMock(return_value={'current_number': 1}))
+    @mock.patch('coupon_images.dynamodb_mark_reference_stored')
+    @mock.patch('coupon_images.process_image')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    def test_put_coupon_image_processed(self, mock_s3_put_coupon_image, mock_process_image,
+                                        mock_dynamodb_mark_reference_stored):
+        digest = self._digest(b'pipeline', b'image/png', b'image')
+        mock_process_image.return_value = ((b'optimized', 'image/webp'), (b'thumbnail', 'image/webp'))
+        # The thumbnail is put before the key is marked stored, so no coupon can get the image without it.
+        mock_dynamodb_mark_reference_stored.side_effect = (
+            lambda key: self.assertEqual(2, mock_s3_put_coupon_image.call_count))
+        self.assertEqual(f"image/{digest}", put_coupon_image('image', b'image', 'image/png'))
+        self.assertEqual(f"thumbnail/{digest}", coupon_image_thumbnail_key(f"image/{digest}"))
+        mock_process_image.assert_called_once_with(b'image', 'image/png')
+        mock_s3_put_coupon_image.assert_has_calls([
+            mock.call(f"image/{digest}", b'optimized', 'image/webp'),
+            mock.call(f"thumbnail/{digest}", b'thumbnail', 'image/webp'),
+        ])
+        mock_dynamodb_mark_reference_stored.assert_called_once_with(f"references:image/{digest}")
+        mock_process_image.reset_mock()
+        mock_s3_put_coupon_image.reset_mock()
+        mock_dynamodb_mark_reference_stored.side_effect = None
+        digest = self._digest(b'image/png', b'qr_code_image')
+        self.assertEqual(f"qr_code_image/{digest}", put_coupon_image('qr_code_image', b'qr_code_image', 'image/png'))
+        self.assertIsNone(coupon_image_thumbnail_key(f"qr_code_image/{digest}"))
+        self.assertIsNone(coupon_image_thumbnail_key('image/0b0e5b8a-4c3e-4a8e-9d64-2f7c2f9e1a10'))
+        mock_process_image.assert_not_called()
+        mock_s3_put_coupon_image.assert_called_once_with(f"qr_code_image/{digest}", b'qr_code_image', 'image/png')
+
+    @mock.patch('coupon_images.dynamodb_mark_reference_stored', mock.MagicMock())
+    @mock.patch('coupon_images.generate_qr_code_png')
+    @mock.patch('coupon_images.dynamodb_add_reference')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    def test_put_generated_qr_code_image(self, mock_s3_put_coupon_image, mock_dynamodb_add_reference,
+                                         mock_generate_qr_code_png):
+        key = f"qr_code_image/{self._digest(b'generated', b'image/png', b'0000001')}"
+        mock_dynamodb_add_reference.side_effect = [{'current_number': 1}, {'current_number': 2, 'object_stored': True}]
+        mock_generate_qr_code_png.return_value = b'qr_code_image'
+        self.assertEqual(key, put_generated_qr_code_image('0000001'))
+        self.assertEqual(key, put_generated_qr_code_image('0000001'))
+        mock_generate_qr_code_png.assert_called_once_with('0000001')
+        mock_s3_put_coupon_image.assert_called_once_with(key, b'qr_code_image', 'image/png')
+
+    @mock.patch('coupon_images.image_pipeline_id', mock.MagicMock(return_value=None))
+    @mock.patch('coupon_images.dynamodb_mark_reference_stored', mock.MagicMock())
+    @mock.patch('coupon_images.dynamodb_add_reference')
+    @mock.patch('coupon_images.s3_put_coupon_image')
+    @mock.patch('coupon_images.s3_get_uploaded_coupon_image')
+    def test_put_uploaded_coupon_image(self, mock_s3_get_uploaded_coupon_image, mock_s3_put_coupon_image,
+                                       mock_dynamodb_add_reference):
+        png = b'\x89PNG\r\n\x1a\nimage'
+        mock_s3_get_uploaded_coupon_image.side_effect = [None, (png, 'image/jpeg'), (png, 'image/png'),
+                                                         (png, 'image/png')]
+        mock_dynamodb_add_reference.return_value = {'current_number': 1}
+        self.assertIsNone(put_uploaded_coupon_image('image', 'uploads/image/key'))
+        self.assertIsNone(put_uploaded_coupon_image('image', 'uploads/image/key'))
+        with mock.patch('coupon_images.is_within_pixel_limit', return_value=False):
+            self.assertIsNone(put_uploaded_coupon_image('image', 'uploads/image/key'))
+        mock_dynamodb_add_reference.assert_not_called()
+        key = f"image/{self._digest(b'image/png', png)}"
+        self.assertEqual(key, put_uploaded_coupon_image('image', 'uploads/image/key'))
+        mock_s3_get_uploaded_coupon_image.assert_called_with('uploads/image/key')
+        mock_s3_put_coupon_image.assert_called_once_with(key, png, 'image/png')
+
+    @mock.patch('coupon_images.dynamodb_clear_reference_deletion')
+    @mock.patch('coupon_images.dynamodb_claim_reference_deletion')
+    @mock.patch('coupon_images.dynamodb_increment_atomic_count')
+    @mock.patch('coupon_images.s3_delete_coupon_images')
+    def test_release_coupon_images(self, mock_s3_delete_coupon_images, mock_dynamodb_increment_atomic_count,
+                                   mock_dynamodb_claim_reference_deletion, mock_dynamodb_clear_reference_deletion):
+        digest = hashlib.sha256(b'image').hexdigest()
+        mock_dynamodb_increment_atomic_count.side_effect = [1, 0, -1, 0, 0]
+        # The last key was acquired again, or is being deleted by another release, before it could be claimed.
+        mock_dynamodb_claim_reference_deletion.side_effect = [True, True, True, False]
+        release_coupon_images(('image/shared', 'image/last', 'image/legacy', f"image/{digest}", 'image/acquired'))
+        mock_s3_delete_coupon_images.assert_called_once_with(
+            ('image/last', 'image/legacy', f"image/{digest}", f"thumbnail/{digest}"))
+        self.assertEqual(['references:image/last', 'references:image/legacy', f"references:image/{digest}"],
+                         [call.args[0] for call in mock_dynamodb_clear_reference_deletion.call_args_list])
+        mock_dynamodb_increment_atomic_count.reset_mock(side_effect=True)
+        mock_s3_delete_coupon_images.reset_mock()
+        mock_dynamodb_increment_atomic_count.return_value = 1
+        release_coupon_images(('image/shared',))
+        mock_s3_delete_coupon_images.assert_not_called()
+
+    @mock.patch('coupon_images.dynamodb_clear_reference_deletion', mock.MagicMock())
+    @mock.patch('coupon_images.dynamodb_claim_reference_deletion')
+    @mock.patch('coupon_images.dynamodb_increment_atomic_count')
+    @mock.patch('coupon_images.dynamodb_put_marker')
+    @mock.patch('coupon_images.s3_delete_coupon_images')
+    def test_release_expired_coupon_images(self, mock_s3_delete_coupon_images, mock_dynamodb_put_marker,
+                                           mock_dynamodb_increment_atomic_count,
+                                           mock_dynamodb_claim_reference_deletion):
+        mock_dynamodb_put_marker.return_value = True
+        mock_dynamodb_increment_atomic_count.side_effect = [0, 1]
+        mock_dynamodb_claim_reference_deletion.return_value = True
+        release_expired_coupon_images('0000001', ('qr_code_image/last', 'qr_code_image/shared'))
+        mock_dynamodb_put_marker.assert_called_once_with('expired:0000001')
+        mock_s3_delete_coupon_images.assert_called_once_with(('qr_code_image/last',))
+        # Delivered again, the references are not released twice but what is left unreferenced is still deleted.
+        mock_dynamodb_put_marker.return_value = False
+        mock_dynamodb_increment_atomic_count.reset_mock(side_effect=True)
+        mock_s3_delete_coupon_images.reset_mock()
+        mock_dynamodb_claim_reference_deletion.side_effect = [True, False]
+        release_expired_coupon_images('0000001', ('qr_code_image/last', 'qr_code_image/shared'))
+        mock_dynamodb_increment_atomic_count.assert_not_called()
+        mock_s3_delete_coupon_images.assert_called_once_with(('qr_code_image/last',))
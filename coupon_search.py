@@ -0,0 +1,279 @@
+import gzip
+import json
+import math
+import re
+import threading
+import time
+import unicodedata
+import unittest
+from unittest import mock
+
+from dynamodb_coupons import dynamodb_scan_coupons, is_newer_coupon_version
+from s3_coupons import s3_get_coupon_search_index, s3_put_coupon_search_index
+from json_encoding import encode_json
+from metrics import timed
+
+
+# Titles and descriptions are split into overlapping character bigrams, so that Japanese text without word
+# boundaries can be searched. S3 keeps the weighted bigrams of each coupon, which the table's stream replaces one
+# coupon at a time and versions in the same way as the catalog, and each container inverts them once per version
+# it searches.
+_NGRAM_LENGTH = 2
+_FIELD_WEIGHTS = (('title', 3), ('description', 1))
+_SEPARATOR_PATTERN = re.compile(r'[\W_]+')
+_CHECK_SECONDS = 10
+_UPDATE_MAX_ATTEMPTS = 5
+_UPDATE_BACKOFF_SECONDS = 0.05
+_COMPRESS_LEVEL = 1
+
+# (etag, documents, versions, postings, checked_at) of the version last seen by this container. postings is None
+# until a search needs it.
+_snapshot = None
+_snapshot_lock = threading.Lock()
+# id -> (terms, encoded "id":terms member) as last written, so a write encodes only the coupons it changed.
+_encoded_documents = {}
+
+
+def is_searchable(query):
+    return bool(_make_terms(query))
+
+
+@timed
+def search_coupon_ids(query):
+    # Returns the ids of the coupons containing every bigram of query, best match first, or None before the
+    # index is built.
+    index = _load()
+    if index is None:
+        return None
+    (documents, postings) = index
+    matches = sorted((postings.get(term, {}) for term in _make_terms(query)), key=len)
+    candidates = set(matches[0]) if matches else set()
+    for match in matches[1:]:
+        candidates.intersection_update(match)
+    # Rare bigrams say more about a match than common ones.
+    weights = tuple((match, math.log(1 + len(documents) / len(match))) for match in matches if match)
+    scores = {_id: sum(match[_id] * weight for match, weight in weights) for _id in candidates}
+    return sorted(candidates, key=lambda _id: (-scores[_id], _id))
+
+
+@timed
+def update_coupon_search_index(changes):
+    # changes is {id: (version, coupon)} as dynamodb_coupon_changes returns it.
+    for attempt in range(_UPDATE_MAX_ATTEMPTS):
+        current = _fetch()
+        if current is None:
+            return
+        (etag, documents, versions) = current
+        changes = {_id: change for _id, change in changes.items()
+                   if is_newer_coupon_version(change[0], versions.get(_id))}
+        if not changes:
+            return
+        (documents, versions) = (dict(documents), dict(versions))
+        for _id, (version, coupon) in changes.items():
+            if coupon is None:
+                documents.pop(_id, None)
+                versions.pop(_id, None)
+                continue
+            terms = _index_coupon(coupon)
+            # Keeping the indexed terms of a coupon whose text did not change spares encoding them again.
+            documents[_id] = documents[_id] if documents.get(_id) == terms else terms
+            versions[_id] = version
+        if _put(documents, versions, etag):
+            return
+        time.sleep(_UPDATE_BACKOFF_SECONDS * 2 ** attempt)
+    raise RuntimeError(f"search index update conflicted {_UPDATE_MAX_ATTEMPTS} times")
+
+
+@timed
+def rebuild_coupon_search_index():
+    for attempt in range(_UPDATE_MAX_ATTEMPTS):
+        current = _fetch()
+        documents = {coupon['id']: _index_coupon(coupon) for coupon in dynamodb_scan_coupons()}
+        if _put(documents, {}, current[0] if current is not None else None):
+            return len(documents)
+        time.sleep(_UPDATE_BACKOFF_SECONDS * 2 ** attempt)
+    raise RuntimeError(f"search index rebuild conflicted {_UPDATE_MAX_ATTEMPTS} times")
+
+
+def _load():
+    with _snapshot_lock:
+        snapshot = _snapshot
+    if snapshot is None or snapshot[4] + _CHECK_SECONDS <= time.time():
+        if _fetch() is None:
+            return None
+        with _snapshot_lock:
+            snapshot = _snapshot
+    (etag, documents, versions, postings, _) = snapshot
+    if postings is None:
+        postings = _invert(documents)
+        _remember(etag, documents, versions, postings)
+    return documents, postings
+
+
+def _fetch():
+    # A conditional GET, so an unchanged index is neither downloaded nor inverted again.
+    with _snapshot_lock:
+        snapshot = _snapshot
+    result = s3_get_coupon_search_index(snapshot[0] if snapshot is not None else None)
+    if result is None:
+        return None
+    if 'Body' not in result:
+        (documents, versions, postings) = snapshot[1:4]
+    else:
+        body = json.loads(gzip.decompress(result['Body']))
+        (documents, versions, postings) = (body['documents'], body['versions'], None)
+    _remember(result['ETag'], documents, versions, postings)
+    return result['ETag'], documents, versions
+
+
+def _put(documents, versions, if_match):
+    global _encoded_documents
+    with _snapshot_lock:
+        encoded_documents = _encoded_documents
+    encoded_documents = {
+        _id: encoded_documents[_id] if _id in encoded_documents and encoded_documents[_id][0] is terms
+        else (terms, f"{encode_json(_id)}:{encode_json(terms)}")
+        for _id, terms in documents.items()
+    }
+    with _snapshot_lock:
+        _encoded_documents = encoded_documents
+    body = ''.join((
+        '{"versions":', encode_json(versions), ',"documents":{',
+        ','.join(member for _, member in encoded_documents.values()), '}}',
+    ))
+    etag = s3_put_coupon_search_index(gzip.compress(body.encode(), _COMPRESS_LEVEL, mtime=0), if_match)
+    if etag is None:
+        return False
+    _remember(etag, documents, versions, None)
+    return True
+
+
+def _remember(etag, documents, versions, postings):
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = (etag, documents, versions, postings, time.time())
+
+
+def _invert(documents):
+    postings = {}
+    for _id, terms in documents.items():
+        for term, weight in terms.items():
+            postings.setdefault(term, {})[_id] = weight
+    return postings
+
+
+def _index_coupon(coupon):
+    terms = {}
+    for field, field_weight in _FIELD_WEIGHTS:
+        for term, count in _make_terms(coupon.get(field, '')).items():
+            terms[term] = terms.get(term, 0) + count * field_weight
+    return terms
+
+
+def _make_terms(text):
+    # NFKC folds full-width and half-width forms together. Runs shorter than a bigram are left out.
+    terms = {}
+    for run in _SEPARATOR_PATTERN.split(unicodedata.normalize('NFKC', text).casefold()):
+        for index in range(len(run) - _NGRAM_LENGTH + 1):
+            term = run[index:index + _NGRAM_LENGTH]
+            terms[term] = terms.get(term, 0) + 1
+    return terms
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        global _snapshot, _encoded_documents
+        _snapshot = None
+        _encoded_documents = {}
+        self._objects = []
+        self._conflicts = 0
+        patches = (
+            mock.patch('coupon_search.s3_get_coupon_search_index', side_effect=self._get),
+            mock.patch('coupon_search.s3_put_coupon_search_index', side_effect=self._put),
+            mock.patch('coupon_search.time.sleep'),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _get(self, if_none_match=None):
+        if not self._objects:
+            return None
+        etag = f'"{len(self._objects)}"'
+        return {'ETag': etag} if etag == if_none_match else {'ETag': etag, 'Body': self._objects[-1]}
+
+    def _put(self, body, if_match):
+        if self._conflicts or if_match != (f'"{len(self._objects)}"' if self._objects else None):
+            self._conflicts = max(self._conflicts - 1, 0)
+            return None
+        self._objects.append(body)
+        return f'"{len(self._objects)}"'
+
+    def _documents(self):
+        return json.loads(gzip.decompress(self._objects[-1]))['documents']
+
+    def test_make_terms(self):
+        self.assertEqual({'全商': 1, '商品': 1, '10': 1, 'of': 1, 'ff': 1}, _make_terms('全商品 １０% OFF'))
+        self.assertEqual({}, _make_terms('a 1 。'))
+        self.assertFalse(is_searchable('a'))
+        self.assertTrue(is_searchable('ＯＦＦ'))
+
+    @mock.patch('coupon_search.dynamodb_scan_coupons')
+    def test_search_coupon_ids(self, mock_dynamodb_scan_coupons):
+        self.assertIsNone(search_coupon_ids('商品'))
+        mock_dynamodb_scan_coupons.return_value = [
+            {'id': '0000001', 'title': '全商品 10% OFF', 'description': '一回限り'},
+            {'id': '0000002', 'title': '送料無料', 'description': '全商品が対象'},
+            {'id': '0000003', 'title': '食品 5% OFF', 'description': '食品のみ OFF'},
+        ]
+        self.assertEqual(3, rebuild_coupon_search_index())
+        self.assertEqual(['0000001', '0000002'], search_coupon_ids('全商品'))
+        self.assertEqual(['0000003', '0000001'], search_coupon_ids('off'))
+        self.assertEqual([], search_coupon_ids('送料 off'))
+        self.assertEqual([], search_coupon_ids('存在しない'))
+
+    def test_update_coupon_search_index(self):
+        update_coupon_search_index({'0000001': ('100', {'id': '0000001', 'title': '送料無料', 'description': ''})})
+        self.assertEqual([], self._objects)
+        self._objects.append(gzip.compress(
+            b'{"versions": {}, "documents": {"0000001": {"xx": 1}, "0000002": {"yy": 1}}}'))
+        self._conflicts = 2
+        update_coupon_search_index({
+            '0000003': ('300', {'id': '0000003', 'title': '送料', 'description': '無料'}),
+            '0000002': ('200', None),
+        })
+        self.assertEqual({'0000001': {'xx': 1}, '0000003': {'送料': 3, '無料': 1}}, self._documents())
+        self.assertEqual({'0000003': '300'}, json.loads(gzip.decompress(self._objects[-1]))['versions'])
+        self.assertEqual(['0000003'], search_coupon_ids('送料'))
+        # A replayed record is no newer than the one already applied.
+        update_coupon_search_index({'0000003': ('300', {'id': '0000003', 'title': '全商品'})})
+        self.assertEqual(2, len(self._objects))
+        self._conflicts = _UPDATE_MAX_ATTEMPTS
+        with self.assertRaises(RuntimeError):
+            update_coupon_search_index({'0000001': ('1000', None)})
+
+    @mock.patch('coupon_search.dynamodb_scan_coupons')
+    def test_update_coupon_search_index_encoded(self, mock_dynamodb_scan_coupons):
+        mock_dynamodb_scan_coupons.return_value = [{'id': '0000001', 'title': '送料無料'}, {'id': '0000002'}]
+        rebuild_coupon_search_index()
+        with mock.patch('coupon_search.encode_json', wraps=encode_json) as mock_encode_json:
+            update_coupon_search_index({
+                '0000001': ('100', {'id': '0000001', 'title': '送料無料', 'description': ''}),
+                '0000002': ('200', {'id': '0000002', 'title': '全商品'}),
+            })
+        mock_encode_json.assert_has_calls([mock.call('0000002'), mock.call({'全商': 3, '商品': 3}),
+                                           mock.call({'0000001': '100', '0000002': '200'})])
+        self.assertEqual(3, mock_encode_json.call_count)
+        self.assertEqual({'0000001': {'送料': 3, '料無': 3, '無料': 3}, '0000002': {'全商': 3, '商品': 3}},
+                         self._documents())
+
+    @mock.patch('coupon_search.time.time')
+    def test_search_coupon_ids_reloaded(self, mock_time):
+        mock_time.return_value = 100
+        self._objects.append(gzip.compress(b'{"versions": {}, "documents": {"0000001": {"xx": 1}}}'))
+        self.assertEqual(['0000001'], search_coupon_ids('xx'))
+        self._objects.append(gzip.compress(b'{"versions": {}, "documents": {"0000002": {"xx": 1}}}'))
+        self.assertEqual(['0000001'], search_coupon_ids('xx'))
+        mock_time.return_value = 110
+        self.assertEqual(['0000002'], search_coupon_ids('xx'))
@@ -1,11 +1,25 @@
+import datetime
 import unittest
 
 
 def validate_coupon(coupon):
-    return tuple(message for cond, message in (
-        (_check_title_length, 'invalid.coupon_title_length'),
-        (_check_description_length, 'invalid.coupon_description_length'),
-    ) if not cond(coupon))
+    # Only the attributes present are checked, so a partial update validates just what it changes.
+    return tuple(message for keys, cond, message in (
+        (('title',), _check_title_length, 'invalid.coupon_title_length'),
+        (('description',), _check_description_length, 'invalid.coupon_description_length'),
+        (('valid_from',), _check_valid_from, 'invalid.coupon_valid_from'),
+        (('valid_until',), _check_valid_until, 'invalid.coupon_valid_until'),
+        (('valid_from', 'valid_until'), _check_validity_period, 'invalid.coupon_validity_period'),
+    ) if all(key in coupon for key in keys) and not cond(coupon))
+
+
+def parse_coupon_time(value):
+    # Returns the epoch seconds of an ISO 8601 date and time with its UTC offset, or None if it is not one.
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return int(parsed.timestamp()) if parsed.tzinfo is not None else None
 
 
 def _check_title_length(coupon):
@@ -16,6 +30,19 @@ def _check_description_length(coupon):
     return len(coupon['description']) <= 100
 
 
+def _check_valid_from(coupon):
+    return parse_coupon_time(coupon['valid_from']) is not None
+
+
+def _check_valid_until(coupon):
+    return parse_coupon_time(coupon['valid_until']) is not None
+
+
+def _check_validity_period(coupon):
+    (valid_from, valid_until) = (parse_coupon_time(coupon[key]) for key in ('valid_from', 'valid_until'))
+    return valid_from is None or valid_until is None or valid_from < valid_until
+
+
 class Test(unittest.TestCase):
 
     def test_validate_coupon(self):
@@ -30,3 +57,20 @@ class Test(unittest.TestCase):
         self.assertEqual(('invalid.coupon_title_length',), validate_coupon({**valid_coupon, 'title': 'x' * 21}))
         self.assertEqual((), validate_coupon({**valid_coupon, 'description': 'x' * 100}))
         self.assertEqual(('invalid.coupon_description_length',), validate_coupon({**valid_coupon, 'description': 'x' * 101}))
+        self.assertEqual((), validate_coupon({'description': 'description'}))
+        self.assertEqual(('invalid.coupon_title_length',), validate_coupon({'title': ''}))
+
+    def test_validate_coupon_validity(self):
+        self.assertEqual((), validate_coupon({'valid_from': '2026-01-01T00:00:00+09:00',
+                                              'valid_until': '2026-01-31T23:59:59Z'}))
+        self.assertEqual(('invalid.coupon_valid_from',), validate_coupon({'valid_from': '2026-01-01T00:00:00'}))
+        self.assertEqual(('invalid.coupon_valid_until',), validate_coupon({'valid_until': 'tomorrow'}))
+        self.assertEqual(('invalid.coupon_validity_period',), validate_coupon({
+            'valid_from': '2026-01-01T09:00:00+09:00', 'valid_until': '2026-01-01T00:00:00Z',
+        }))
+
+    def test_parse_coupon_time(self):
+        self.assertEqual(1767225600, parse_coupon_time('2026-01-01T09:00:00+09:00'))
+        self.assertEqual(1767225600, parse_coupon_time('2026-01-01T00:00:00Z'))
+        self.assertIsNone(parse_coupon_time('2026-01-01'))
+        self.assertIsNone(parse_coupon_time(''))
@@ -1,2 +1,2 @@
-git archive HEAD --output=lambda.zip
+python build_lambda.py --output=lambda.zip
 aws lambda update-function-code --function-name=shop-coupon-deliverer --zip-file=fileb://lambda.zip
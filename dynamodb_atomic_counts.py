@@ -1,17 +1,171 @@
 import functools
+import threading
+import unittest
+from unittest import mock
 
-import boto3
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
 
+from aws_resources import dynamodb_resource
+from metrics import timed
 
-def dynamodb_increment_atomic_count(key):
+
+# Numbers reserved by dynamodb_allocate_atomic_count are held by the container, so the ones it has
+# not handed out yet are lost when the container is recycled.
+_reserved_blocks = {}
+_reserved_blocks_lock = threading.Lock()
+
+
+@timed
+def dynamodb_increment_atomic_count(key, increment=1):
     return int(_dynamodb_atomic_counts_table().update_item(
         Key={'key': key},
-        UpdateExpression='set current_number = current_number + :increment',
-        ExpressionAttributeValues={':increment': 1},
+        UpdateExpression='set current_number = if_not_exists(current_number, :zero) + :increment',
+        ExpressionAttributeValues={':zero': 0, ':increment': increment},
         ReturnValues='UPDATED_NEW',
     )['Attributes']['current_number'])
 
 
+@timed
+def dynamodb_allocate_atomic_count(key, block_size):
+    with _reserved_blocks_lock:
+        (next_number, last_number) = _reserved_blocks.get(key, (1, 0))
+        if next_number > last_number:
+            last_number = dynamodb_increment_atomic_count(key, block_size)
+            next_number = last_number - block_size + 1
+        _reserved_blocks[key] = (next_number + 1, last_number)
+        return next_number
+
+
+@timed
+def dynamodb_get_atomic_count(key):
+    get_atomic_count_result = _dynamodb_atomic_counts_table().get_item(Key={'key': key})
+    return int(get_atomic_count_result['Item']['current_number']) if 'Item' in get_atomic_count_result else 0
+
+
+@timed
+def dynamodb_add_reference(key):
+    return _dynamodb_atomic_counts_table().update_item(
+        Key={'key': key},
+        UpdateExpression='set current_number = if_not_exists(current_number, :zero) + :one',
+        ExpressionAttributeValues={':zero': 0, ':one': 1},
+        ReturnValues='ALL_NEW',
+    )['Attributes']
+
+
+@timed
+def dynamodb_get_reference(key):
+    return _dynamodb_atomic_counts_table().get_item(Key={'key': key}, ConsistentRead=True).get('Item', {})
+
+
+@timed
+def dynamodb_mark_reference_stored(key):
+    # Set once the S3 objects the count references have been put.
+    _dynamodb_atomic_counts_table().update_item(
+        Key={'key': key},
+        UpdateExpression='set object_stored = :true',
+        ExpressionAttributeValues={':true': True},
+    )
+
+
+@timed
+def dynamodb_claim_reference_deletion(key, claimed_at):
+    # Succeeds only while nothing references the key and no other release holds a claim on it.
+    return _update_if(key, 'set deletion_claimed_at = :claimed_at', {':claimed_at': claimed_at},
+                      Attr('current_number').lte(0) & Attr('deletion_claimed_at').not_exists())
+
+
+@timed
+def dynamodb_clear_reference_deletion(key, claimed_at):
+    # Drops the count of a key still unreferenced. One referenced again meanwhile keeps its count but loses
+    # object_stored, so that the writes holding it put the objects again.
+    try:
+        _dynamodb_atomic_counts_table().delete_item(
+            Key={'key': key},
+            ConditionExpression=Attr('current_number').lte(0) & Attr('deletion_claimed_at').eq(claimed_at),
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    return _update_if(key, 'remove deletion_claimed_at, object_stored', None,
+                      Attr('deletion_claimed_at').eq(claimed_at))
+
+
+@timed
+def dynamodb_put_marker(key):
+    # Returns whether the marker is new, so that what it marks is done only once.
+    try:
+        _dynamodb_atomic_counts_table().put_item(Item={'key': key}, ConditionExpression=Attr('key').not_exists())
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+
+def _update_if(key, update_expression, values, condition):
+    try:
+        _dynamodb_atomic_counts_table().update_item(
+            Key={'key': key},
+            UpdateExpression=update_expression,
+            **({'ExpressionAttributeValues': values} if values else {}),
+            ConditionExpression=condition,
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+
 @functools.lru_cache()
 def _dynamodb_atomic_counts_table():
-    return boto3.resource('dynamodb').Table('atomic_counts')
+    return dynamodb_resource().Table('atomic_counts')
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        _reserved_blocks.clear()
+
+    @mock.patch('dynamodb_atomic_counts.dynamodb_increment_atomic_count')
+    def test_dynamodb_allocate_atomic_count(self, mock_dynamodb_increment_atomic_count):
+        mock_dynamodb_increment_atomic_count.side_effect = [3, 6]
+        self.assertEqual([1, 2, 3, 4], [dynamodb_allocate_atomic_count('key', 3) for _ in range(4)])
+        mock_dynamodb_increment_atomic_count.assert_has_calls([mock.call('key', 3), mock.call('key', 3)])
+
+    @mock.patch('dynamodb_atomic_counts._dynamodb_atomic_counts_table')
+    def test_dynamodb_claim_reference_deletion(self, mock_dynamodb_atomic_counts_table):
+        self.assertTrue(dynamodb_claim_reference_deletion('references:image/key', 1000))
+        mock_dynamodb_atomic_counts_table().update_item.assert_called_once_with(
+            Key={'key': 'references:image/key'},
+            UpdateExpression='set deletion_claimed_at = :claimed_at',
+            ExpressionAttributeValues={':claimed_at': 1000},
+            ConditionExpression=Attr('current_number').lte(0) & Attr('deletion_claimed_at').not_exists(),
+        )
+        mock_dynamodb_atomic_counts_table().update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self.assertFalse(dynamodb_claim_reference_deletion('references:image/key', 1000))
+
+    @mock.patch('dynamodb_atomic_counts._dynamodb_atomic_counts_table')
+    def test_dynamodb_clear_reference_deletion(self, mock_dynamodb_atomic_counts_table):
+        self.assertTrue(dynamodb_clear_reference_deletion('references:image/key', 1000))
+        mock_dynamodb_atomic_counts_table().update_item.assert_not_called()
+        mock_dynamodb_atomic_counts_table().delete_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'DeleteItem')
+        self.assertTrue(dynamodb_clear_reference_deletion('references:image/key', 1000))
+        mock_dynamodb_atomic_counts_table().update_item.assert_called_once_with(
+            Key={'key': 'references:image/key'},
+            UpdateExpression='remove deletion_claimed_at, object_stored',
+            ConditionExpression=Attr('deletion_claimed_at').eq(1000),
+        )
+
+    @mock.patch('dynamodb_atomic_counts._dynamodb_atomic_counts_table')
+    def test_dynamodb_put_marker(self, mock_dynamodb_atomic_counts_table):
+        self.assertTrue(dynamodb_put_marker('expired:0000001'))
+        mock_dynamodb_atomic_counts_table().put_item.assert_called_once_with(
+            Item={'key': 'expired:0000001'}, ConditionExpression=Attr('key').not_exists())
+        mock_dynamodb_atomic_counts_table().put_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        self.assertFalse(dynamodb_put_marker('expired:0000001'))
@@ -1,40 +1,332 @@
 import functools
+import heapq
+import itertools
+import os
+import time
 import unittest
 from unittest import mock
 from unittest.mock import MagicMock
 
-import boto3
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+from aws_resources import dynamodb_resource
+from background_tasks import submit_task
+from coupon_validation import parse_coupon_time
+from metrics import timed
 
 
 _FIXED_KEY_VALUE = 'fixed_key'
-_QUERY_LIMIT = 20
+# With more than one shard, items are spread over 'fixed_key#<n>' partitions of fixed_key-id-index.
+# Existing items have to be moved with dynamodb_backfill_coupon_shards after changing the count.
+_FIXED_KEY_SHARD_COUNT = int(os.environ.get('COUPONS_FIXED_KEY_SHARD_COUNT', '1'))
+# Coupons are listed as active from active_from (inclusive) to active_until (exclusive) by
+# fixed_key-active_until-index, and deleted by TTL once expires_at, _EXPIRED_RETENTION_SECONDS after their end,
+# has passed. Coupons without an end are active until 9999-12-31T23:59:59Z and never expire.
+_OPEN_ENDED_ACTIVE_UNTIL = 253402300799
+_EXPIRED_RETENTION_SECONDS = int(os.environ.get('COUPONS_EXPIRED_RETENTION_DAYS', '30')) * 24 * 60 * 60
+_INDEX_ATTRIBUTE_NAMES = frozenset(('fixed_key', 'active_from', 'active_until', 'expires_at'))
+# Deletions made by TTL rather than by a request, as they appear in the table's stream.
+_TTL_PRINCIPAL_ID = 'dynamodb.amazonaws.com'
+_BATCH_GET_MAX_ATTEMPTS = 5
+_BATCH_WRITE_SIZE = 25
+_BATCH_WRITE_MAX_ATTEMPTS = 5
+_BATCH_WRITE_BACKOFF_SECONDS = 0.05
+_BATCH_GET_BACKOFF_SECONDS = 0.05
 
 
+@timed
 def dynamodb_put_coupon(item):
-    return _dynamodb_coupons_table().put_item(Item={**item, **{'fixed_key': _FIXED_KEY_VALUE}})
+    return _dynamodb_coupons_table().put_item(Item=_with_index_attributes(item))
+
+
+@timed
+def dynamodb_batch_put_coupons(items):
+    # Returns the items that could not be written, so that the caller can report them and undo their side effects.
+    unwritten_items = []
+    for start in range(0, len(items), _BATCH_WRITE_SIZE):
+        chunk = {item['id']: item for item in items[start:start + _BATCH_WRITE_SIZE]}
+        request_items = {'coupons': [{'PutRequest': {'Item': _with_index_attributes(item)}} for item in chunk.values()]}
+        for attempt in range(_BATCH_WRITE_MAX_ATTEMPTS):
+            try:
+                batch_write_result = _dynamodb_resource().batch_write_item(RequestItems=request_items)
+            except ClientError:
+                # A rejected request wrote none of its items.
+                break
+            request_items = batch_write_result.get('UnprocessedItems')
+            if not request_items:
+                break
+            time.sleep(_BATCH_WRITE_BACKOFF_SECONDS * 2 ** attempt)
+        if request_items:
+            unwritten_items.extend(chunk[request['PutRequest']['Item']['id']] for request in request_items['coupons'])
+    return unwritten_items
+
+
+@timed
+def dynamodb_replace_coupon(item):
+    try:
+        return _dynamodb_coupons_table().put_item(
+            Item=_with_index_attributes(item),
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return {}
+
+
+@timed
+def dynamodb_update_coupon(_id, attributes, removed_names=()):
+    # Returns the stored coupon as Item, in DynamoDB JSON, instead of Attributes when the change would end its validity
+    # period before it starts, and {} when there is no coupon.
+    (attributes, removed_names) = _with_validity_updates(attributes, removed_names)
+    validity_condition = _validity_condition(attributes, removed_names)
+    try:
+        return _dynamodb_coupons_table().update_item(
+            Key={'id': _id},
+            UpdateExpression=' '.join(clause for clause in (
+                'set ' + ', '.join(f"#a{i} = :a{i}" for i in range(len(attributes))) if attributes else '',
+                'remove ' + ', '.join(f"#r{i}" for i in range(len(removed_names))) if removed_names else '',
+            ) if clause),
+            ExpressionAttributeNames={
+                **{f"#a{i}": name for i, name in enumerate(attributes)},
+                **{f"#r{i}": name for i, name in enumerate(removed_names)},
+            },
+            # DynamoDB rejects an empty map, which a change that only removes attributes would send.
+            **({'ExpressionAttributeValues': {f":a{i}": value for i, value in enumerate(attributes.values())}}
+               if attributes else {}),
+            ConditionExpression=(Attr('id').exists() & validity_condition if validity_condition is not None
+                                 else Attr('id').exists()),
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return {'Item': e.response['Item']} if 'Item' in e.response else {}
 
 
+@timed
 def dynamodb_get_coupon(_id):
     return _dynamodb_coupons_table().get_item(Key={'id': _id})
 
 
-def dynamodb_query_coupons(exclusive_start_key):
-    return _dynamodb_coupons_table().query(
-        IndexName='fixed_key-id-index',
-        KeyConditionExpression=Key('fixed_key').eq(_FIXED_KEY_VALUE),
-        Limit=_QUERY_LIMIT,
-        **({'ExclusiveStartKey': exclusive_start_key} if exclusive_start_key is not None else {}),
-    )
+@timed
+def dynamodb_batch_get_coupons(ids):
+    # Keys still unprocessed after the last attempt come back as UnprocessedIds, neither found nor missing.
+    items = []
+    request_items = {'coupons': {'Keys': [{'id': _id} for _id in ids]}}
+    for attempt in range(_BATCH_GET_MAX_ATTEMPTS):
+        batch_get_result = _dynamodb_resource().batch_get_item(RequestItems=request_items)
+        items.extend(batch_get_result['Responses'].get('coupons', ()))
+        request_items = batch_get_result.get('UnprocessedKeys')
+        if not request_items:
+            return {'Items': items}
+        if attempt + 1 < _BATCH_GET_MAX_ATTEMPTS:
+            time.sleep(_BATCH_GET_BACKOFF_SECONDS * 2 ** attempt)
+    return {'Items': items, 'UnprocessedIds': tuple(key['id'] for key in request_items['coupons']['Keys'])}
+
+
+@timed
+def dynamodb_query_coupons(exclusive_start_key, limit, active_at=None):
+    # With active_at, only the coupons active at that epoch second are listed, in order of their end.
+    if _FIXED_KEY_SHARD_COUNT == 1:
+        return _query_fixed_key(_FIXED_KEY_VALUE, exclusive_start_key, limit, active_at)
+    return _query_sharded_fixed_keys(exclusive_start_key, limit, active_at)
 
 
+@timed
 def dynamodb_delete_coupon(_id):
-    return _dynamodb_coupons_table().delete_item(Key={'id': _id})
+    return _dynamodb_coupons_table().delete_item(Key={'id': _id}, ReturnValues='ALL_OLD')
+
+
+@timed
+def dynamodb_scan_coupons():
+    items = []
+    scan_kwargs = {}
+    while True:
+        scan_result = _dynamodb_coupons_table().scan(**scan_kwargs)
+        items.extend(scan_result['Items'])
+        if 'LastEvaluatedKey' not in scan_result:
+            return items
+        scan_kwargs['ExclusiveStartKey'] = scan_result['LastEvaluatedKey']
+
+
+@timed
+def dynamodb_backfill_coupon_shards():
+    moved_count = 0
+    scan_kwargs = {'ProjectionExpression': 'id, fixed_key'}
+    while True:
+        scan_result = _dynamodb_coupons_table().scan(**scan_kwargs)
+        for item in scan_result['Items']:
+            if item.get('fixed_key') != _fixed_key_value(item):
+                _dynamodb_coupons_table().update_item(
+                    Key={'id': item['id']},
+                    UpdateExpression='set fixed_key = :fixed_key',
+                    ConditionExpression=Attr('id').exists(),
+                    ExpressionAttributeValues={':fixed_key': _fixed_key_value(item)},
+                )
+                moved_count += 1
+        if 'LastEvaluatedKey' not in scan_result:
+            return moved_count
+        scan_kwargs['ExclusiveStartKey'] = scan_result['LastEvaluatedKey']
+
+
+@timed
+def dynamodb_backfill_coupon_validity():
+    updated_count = 0
+    scan_kwargs = {'ProjectionExpression': 'id, valid_from, valid_until, active_until'}
+    while True:
+        scan_result = _dynamodb_coupons_table().scan(**scan_kwargs)
+        for item in scan_result['Items']:
+            if 'active_until' not in item:
+                attributes = _validity_attributes(item)
+                _dynamodb_coupons_table().update_item(
+                    Key={'id': item['id']},
+                    UpdateExpression='set ' + ', '.join(f"{name} = :{name}" for name in attributes),
+                    ConditionExpression=Attr('id').exists(),
+                    ExpressionAttributeValues={f":{name}": value for name, value in attributes.items()},
+                )
+                updated_count += 1
+        if 'LastEvaluatedKey' not in scan_result:
+            return updated_count
+        scan_kwargs['ExclusiveStartKey'] = scan_result['LastEvaluatedKey']
+
+
+def dynamodb_strip_index_attributes(item):
+    return {key: value for key, value in item.items() if key not in _INDEX_ATTRIBUTE_NAMES}
+
+
+def dynamodb_expired_coupons(records):
+    # (sequence number, coupon) of the coupons TTL deleted, out of stream records carrying the old image of each item.
+    deserializer = TypeDeserializer()
+    return [
+        (record['dynamodb']['SequenceNumber'],
+         dynamodb_strip_index_attributes({name: deserializer.deserialize(value)
+                                          for name, value in record['dynamodb']['OldImage'].items()}))
+        for record in records
+        if record['eventName'] == 'REMOVE' and record.get('userIdentity', {}).get('principalId') == _TTL_PRINCIPAL_ID
+    ]
+
+
+def dynamodb_coupon_changes(records):
+    # {id: (version, coupon)} for the latest record of each coupon, coupon being None once it was deleted. The
+    # version is the record's sequence number, which grows with every change the stream delivers for an item.
+    deserializer = TypeDeserializer()
+    changes = {}
+    for record in records:
+        _id = deserializer.deserialize(record['dynamodb']['Keys']['id'])
+        version = record['dynamodb']['SequenceNumber']
+        if _id in changes and not is_newer_coupon_version(version, changes[_id][0]):
+            continue
+        changes[_id] = (version, dynamodb_strip_index_attributes({
+            name: deserializer.deserialize(value) for name, value in record['dynamodb']['NewImage'].items()
+        }) if record['eventName'] != 'REMOVE' else None)
+    return changes
+
+
+def is_newer_coupon_version(version, current_version):
+    # Sequence numbers are decimal strings of varying length, too long for a JSON number.
+    return current_version is None or int(version) > int(current_version)
+
+
+def _with_index_attributes(item):
+    return {**item, 'fixed_key': _fixed_key_value(item), **_validity_attributes(item)}
+
+
+def _validity_attributes(item):
+    attributes = {'active_until': _OPEN_ENDED_ACTIVE_UNTIL}
+    if 'valid_from' in item:
+        attributes['active_from'] = parse_coupon_time(item['valid_from'])
+    if 'valid_until' in item:
+        attributes['active_until'] = parse_coupon_time(item['valid_until'])
+        attributes['expires_at'] = attributes['active_until'] + _EXPIRED_RETENTION_SECONDS
+    return attributes
+
+
+def _with_validity_updates(attributes, removed_names):
+    attributes = {**attributes, **{name: value for name, value in _validity_attributes(attributes).items()
+                                   if name != 'active_until' or 'valid_until' in attributes}}
+    if 'valid_from' in removed_names:
+        removed_names = (*removed_names, 'active_from')
+    if 'valid_until' in removed_names:
+        (attributes['active_until'], removed_names) = (_OPEN_ENDED_ACTIVE_UNTIL, (*removed_names, 'expires_at'))
+    return attributes, removed_names
+
+
+def _validity_condition(attributes, removed_names):
+    # Only a change to one end of the validity period needs the other end, which is read from the stored coupon.
+    if 'valid_from' in attributes and 'valid_until' not in attributes and 'valid_until' not in removed_names:
+        return Attr('active_until').not_exists() | Attr('active_until').gt(attributes['active_from'])
+    if 'valid_until' in attributes and 'valid_from' not in attributes and 'valid_from' not in removed_names:
+        return Attr('active_from').not_exists() | Attr('active_from').lt(attributes['active_until'])
+    return None
+
+
+def _fixed_key_value(item):
+    if _FIXED_KEY_SHARD_COUNT == 1:
+        return _FIXED_KEY_VALUE
+    return f"{_FIXED_KEY_VALUE}#{int(item['id']) % _FIXED_KEY_SHARD_COUNT}"
+
+
+def _query_fixed_key(fixed_key_value, exclusive_start_key, limit, active_at=None):
+    if active_at is None:
+        return _dynamodb_coupons_table().query(
+            IndexName='fixed_key-id-index',
+            KeyConditionExpression=Key('fixed_key').eq(fixed_key_value),
+            Limit=limit,
+            **({'ExclusiveStartKey': exclusive_start_key} if exclusive_start_key is not None else {}),
+        )
+    # Coupons that have ended are never read. The few yet to start are read and filtered out after Limit has
+    # counted them, so the index is read on until the page is full again.
+    items = []
+    while True:
+        query_result = _dynamodb_coupons_table().query(
+            IndexName='fixed_key-active_until-index',
+            KeyConditionExpression=Key('fixed_key').eq(fixed_key_value) & Key('active_until').gt(active_at),
+            FilterExpression=Attr('active_from').not_exists() | Attr('active_from').lte(active_at),
+            Limit=limit - len(items),
+            **({'ExclusiveStartKey': exclusive_start_key} if exclusive_start_key is not None else {}),
+        )
+        items.extend(query_result['Items'])
+        exclusive_start_key = query_result.get('LastEvaluatedKey')
+        if exclusive_start_key is None or len(items) >= limit:
+            return {'Items': items, **({'LastEvaluatedKey': exclusive_start_key}
+                                       if exclusive_start_key is not None else {})}
+
+
+def _query_sharded_fixed_keys(exclusive_start_key, limit, active_at):
+    # Each shard is read from the cursor onwards and the shards are merged in index order, so the cursor only
+    # needs the sort keys of the last returned item. Cursors of the single-partition mode are accepted for the
+    # same reason.
+    cursor_names = ('id',) if active_at is None else ('active_until', 'id')
+    futures = tuple(
+        submit_task(_query_fixed_key, f"{_FIXED_KEY_VALUE}#{shard}",
+                    {**{name: exclusive_start_key[name] for name in cursor_names},
+                     'fixed_key': f"{_FIXED_KEY_VALUE}#{shard}"}
+                    if exclusive_start_key is not None else None, limit, active_at)
+        for shard in range(_FIXED_KEY_SHARD_COUNT)
+    )
+    shard_results = tuple(future.result() for future in futures)
+    items = list(itertools.islice(heapq.merge(*(shard_result['Items'] for shard_result in shard_results),
+                                              key=lambda item: tuple(item[name] for name in cursor_names)), limit))
+    has_more = (sum(len(shard_result['Items']) for shard_result in shard_results) > len(items)
+                or any('LastEvaluatedKey' in shard_result for shard_result in shard_results))
+    return {
+        'Items': items,
+        **({'LastEvaluatedKey': {name: items[-1][name] for name in cursor_names}} if has_more and items else {}),
+    }
 
 
 @functools.lru_cache()
 def _dynamodb_coupons_table():
-    return boto3.resource('dynamodb').Table('coupons')
+    return _dynamodb_resource().Table('coupons')
+
+
+def _dynamodb_resource():
+    return dynamodb_resource()
 
 
 class Test(unittest.TestCase):
@@ -43,23 +335,402 @@ class Test(unittest.TestCase):
     def test_dynamodb_put_coupon(self, mock_dynamodb_coupons_table):
         mock_dynamodb_coupons_table.return_value = MagicMock(put_item=MagicMock())
         dynamodb_put_coupon({'key': 'value'})
-        mock_dynamodb_coupons_table().put_item.assert_called_once_with(Item={'key': 'value', 'fixed_key': 'fixed_key'})
+        mock_dynamodb_coupons_table().put_item.assert_called_once_with(Item={
+            'key': 'value', 'fixed_key': 'fixed_key', 'active_until': 253402300799,
+        })
+        mock_dynamodb_coupons_table().put_item.reset_mock()
+        dynamodb_put_coupon({'key': 'value', 'valid_from': '2026-01-01T00:00:00Z',
+                             'valid_until': '2026-02-01T00:00:00Z'})
+        mock_dynamodb_coupons_table().put_item.assert_called_once_with(Item={
+            'key': 'value',
+            'valid_from': '2026-01-01T00:00:00Z',
+            'valid_until': '2026-02-01T00:00:00Z',
+            'fixed_key': 'fixed_key',
+            'active_from': 1767225600,
+            'active_until': 1769904000,
+            'expires_at': 1769904000 + 30 * 24 * 60 * 60,
+        })
+
+    @mock.patch('dynamodb_coupons.time.sleep')
+    @mock.patch('dynamodb_coupons._dynamodb_resource')
+    def test_dynamodb_batch_put_coupons(self, mock_dynamodb_resource, mock_sleep):
+        items = tuple({'id': str(_id).zfill(7)} for _id in range(1, 28))
+
+        def put_request(item):
+            return {'PutRequest': {'Item': {**item, 'fixed_key': 'fixed_key', 'active_until': 253402300799}}}
+
+        mock_dynamodb_resource.return_value = MagicMock(batch_write_item=MagicMock(side_effect=[
+            {'UnprocessedItems': {'coupons': [put_request(items[1])]}},
+            {'UnprocessedItems': {}},
+            ClientError({'Error': {'Code': 'InternalServerError'}}, 'BatchWriteItem'),
+        ]))
+        self.assertEqual([items[25], items[26]], dynamodb_batch_put_coupons(items))
+        mock_dynamodb_resource().batch_write_item.assert_has_calls([
+            mock.call(RequestItems={'coupons': [put_request(item) for item in items[:25]]}),
+            mock.call(RequestItems={'coupons': [put_request(items[1])]}),
+            mock.call(RequestItems={'coupons': [put_request(item) for item in items[25:]]}),
+        ])
+        mock_sleep.assert_called_once_with(0.05)
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_replace_coupon(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(put_item=MagicMock(return_value={
+            'Attributes': {'id': '0000001'},
+        }))
+        self.assertEqual({'Attributes': {'id': '0000001'}}, dynamodb_replace_coupon({'id': '0000001'}))
+        mock_dynamodb_coupons_table().put_item.assert_called_once_with(
+            Item={'id': '0000001', 'fixed_key': 'fixed_key', 'active_until': 253402300799},
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+        )
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_update_coupon(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(update_item=MagicMock(return_value={
+            'Attributes': {'id': '0000001', 'title': 'old'},
+        }))
+        self.assertEqual({'Attributes': {'id': '0000001', 'title': 'old'}},
+                         dynamodb_update_coupon('0000001', {'title': 'title', 'image_s3_key': 'image/key'}))
+        mock_dynamodb_coupons_table().update_item.assert_called_once_with(
+            Key={'id': '0000001'},
+            UpdateExpression='set #a0 = :a0, #a1 = :a1',
+            ExpressionAttributeNames={'#a0': 'title', '#a1': 'image_s3_key'},
+            ExpressionAttributeValues={':a0': 'title', ':a1': 'image/key'},
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+        mock_dynamodb_coupons_table().update_item.reset_mock()
+        dynamodb_update_coupon('0000001', {'image_s3_key': 'image/key'}, ('thumbnail_s3_key',))
+        mock_dynamodb_coupons_table().update_item.assert_called_once_with(
+            Key={'id': '0000001'},
+            UpdateExpression='set #a0 = :a0 remove #r0',
+            ExpressionAttributeNames={'#a0': 'image_s3_key', '#r0': 'thumbnail_s3_key'},
+            ExpressionAttributeValues={':a0': 'image/key'},
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_update_coupon_validity(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(update_item=MagicMock())
+        dynamodb_update_coupon('0000001', {'valid_until': '2026-02-01T00:00:00Z'}, ('valid_from',))
+        mock_dynamodb_coupons_table().update_item.assert_called_once_with(
+            Key={'id': '0000001'},
+            UpdateExpression='set #a0 = :a0, #a1 = :a1, #a2 = :a2 remove #r0, #r1',
+            ExpressionAttributeNames={'#a0': 'valid_until', '#a1': 'active_until', '#a2': 'expires_at',
+                                      '#r0': 'valid_from', '#r1': 'active_from'},
+            ExpressionAttributeValues={':a0': '2026-02-01T00:00:00Z', ':a1': 1769904000,
+                                       ':a2': 1769904000 + 30 * 24 * 60 * 60},
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+        mock_dynamodb_coupons_table().update_item.reset_mock()
+        dynamodb_update_coupon('0000001', {'valid_from': '2026-01-01T00:00:00Z'}, ('valid_until',))
+        mock_dynamodb_coupons_table().update_item.assert_called_once_with(
+            Key={'id': '0000001'},
+            UpdateExpression='set #a0 = :a0, #a1 = :a1, #a2 = :a2 remove #r0, #r1',
+            ExpressionAttributeNames={'#a0': 'valid_from', '#a1': 'active_from', '#a2': 'active_until',
+                                      '#r0': 'valid_until', '#r1': 'expires_at'},
+            ExpressionAttributeValues={':a0': '2026-01-01T00:00:00Z', ':a1': 1767225600, ':a2': 253402300799},
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+        mock_dynamodb_coupons_table().update_item.reset_mock()
+        dynamodb_update_coupon('0000001', {}, ('valid_from',))
+        mock_dynamodb_coupons_table().update_item.assert_called_once_with(
+            Key={'id': '0000001'},
+            UpdateExpression='remove #r0, #r1',
+            ExpressionAttributeNames={'#r0': 'valid_from', '#r1': 'active_from'},
+            ConditionExpression=Attr('id').exists(),
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+        mock_dynamodb_coupons_table().update_item.reset_mock()
+        dynamodb_update_coupon('0000001', {'valid_from': '2026-01-01T00:00:00Z'})
+        self.assertEqual(
+            Attr('id').exists() & (Attr('active_until').not_exists() | Attr('active_until').gt(1767225600)),
+            mock_dynamodb_coupons_table().update_item.call_args.kwargs['ConditionExpression'])
+        mock_dynamodb_coupons_table().update_item.reset_mock()
+        dynamodb_update_coupon('0000001', {'valid_until': '2026-02-01T00:00:00Z'})
+        self.assertEqual(
+            Attr('id').exists() & (Attr('active_from').not_exists() | Attr('active_from').lt(1769904000)),
+            mock_dynamodb_coupons_table().update_item.call_args.kwargs['ConditionExpression'])
+
+    def test_dynamodb_strip_index_attributes(self):
+        self.assertEqual({'id': '0000001', 'valid_until': '2026-02-01T00:00:00Z'}, dynamodb_strip_index_attributes({
+            'id': '0000001', 'valid_until': '2026-02-01T00:00:00Z', 'fixed_key': 'fixed_key',
+            'active_until': 1769904000, 'expires_at': 1772496000,
+        }))
+
+    def test_dynamodb_expired_coupons(self):
+        old_image = {
+            'id': {'S': '0000001'},
+            'image_s3_key': {'S': 'image/key'},
+            'fixed_key': {'S': 'fixed_key'},
+            'active_until': {'N': '1769904000'},
+            'expires_at': {'N': '1772496000'},
+        }
+        ttl_identity = {'type': 'Service', 'principalId': 'dynamodb.amazonaws.com'}
+        self.assertEqual([('100', {'id': '0000001', 'image_s3_key': 'image/key'})], dynamodb_expired_coupons([
+            {'eventName': 'REMOVE', 'userIdentity': ttl_identity,
+             'dynamodb': {'SequenceNumber': '100', 'OldImage': old_image}},
+            {'eventName': 'REMOVE', 'dynamodb': {'SequenceNumber': '200', 'OldImage': old_image}},
+            {'eventName': 'MODIFY',
+             'dynamodb': {'SequenceNumber': '300', 'OldImage': old_image, 'NewImage': old_image}},
+        ]))
+
+    def test_dynamodb_coupon_changes(self):
+        image = {'id': {'S': '0000001'}, 'title': {'S': 'title'}, 'fixed_key': {'S': 'fixed_key'}}
+        self.assertEqual({
+            '0000001': ('300', {'id': '0000001', 'title': 'title'}),
+            '0000002': ('1000', None),
+        }, dynamodb_coupon_changes([
+            {'eventName': 'INSERT', 'dynamodb': {'Keys': {'id': {'S': '0000001'}}, 'SequenceNumber': '100',
+                                                 'NewImage': {**image, 'title': {'S': 'old'}}}},
+            {'eventName': 'INSERT', 'dynamodb': {'Keys': {'id': {'S': '0000002'}}, 'SequenceNumber': '200',
+                                                 'NewImage': {**image, 'id': {'S': '0000002'}}}},
+            {'eventName': 'MODIFY', 'dynamodb': {'Keys': {'id': {'S': '0000001'}}, 'SequenceNumber': '300',
+                                                 'NewImage': image, 'OldImage': image}},
+            {'eventName': 'REMOVE', 'dynamodb': {'Keys': {'id': {'S': '0000002'}}, 'SequenceNumber': '1000',
+                                                 'OldImage': image}},
+        ]))
+        self.assertTrue(is_newer_coupon_version('1000', '300'))
+        self.assertFalse(is_newer_coupon_version('300', '300'))
+        self.assertTrue(is_newer_coupon_version('300', None))
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_update_coupon_not_found(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(update_item=MagicMock(side_effect=ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem',
+        )))
+        self.assertEqual({}, dynamodb_update_coupon('0000001', {'title': 'title'}))
+        mock_dynamodb_coupons_table().update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}, 'Item': {'id': {'S': '0000001'}}}, 'UpdateItem',
+        )
+        self.assertEqual({'Item': {'id': {'S': '0000001'}}},
+                         dynamodb_update_coupon('0000001', {'valid_from': '2026-01-01T00:00:00Z'}))
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_replace_coupon_not_found(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(put_item=MagicMock(side_effect=ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem',
+        )))
+        self.assertEqual({}, dynamodb_replace_coupon({'id': '0000001'}))
+
+    @mock.patch('dynamodb_coupons._FIXED_KEY_SHARD_COUNT', 2)
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_put_coupon_sharded(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(put_item=MagicMock())
+        dynamodb_put_coupon({'id': '0000003'})
+        mock_dynamodb_coupons_table().put_item.assert_called_once_with(
+            Item={'id': '0000003', 'fixed_key': 'fixed_key#1', 'active_until': 253402300799},
+        )
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_delete_coupon(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(delete_item=MagicMock())
+        dynamodb_delete_coupon('0000001')
+        mock_dynamodb_coupons_table().delete_item.assert_called_once_with(Key={'id': '0000001'},
+                                                                          ReturnValues='ALL_OLD')
+
+    @mock.patch('dynamodb_coupons.time.sleep')
+    @mock.patch('dynamodb_coupons._dynamodb_resource')
+    def test_dynamodb_batch_get_coupons(self, mock_dynamodb_resource, mock_sleep):
+        mock_dynamodb_resource.return_value = MagicMock(batch_get_item=MagicMock(side_effect=[
+            {
+                'Responses': {'coupons': [{'id': '0000001'}]},
+                'UnprocessedKeys': {'coupons': {'Keys': [{'id': '0000002'}]}},
+            },
+            {'Responses': {'coupons': [{'id': '0000002'}]}, 'UnprocessedKeys': {}},
+        ]))
+        self.assertEqual({'Items': [{'id': '0000001'}, {'id': '0000002'}]},
+                         dynamodb_batch_get_coupons(('0000001', '0000002')))
+        mock_dynamodb_resource().batch_get_item.assert_has_calls([
+            mock.call(RequestItems={'coupons': {'Keys': [{'id': '0000001'}, {'id': '0000002'}]}}),
+            mock.call(RequestItems={'coupons': {'Keys': [{'id': '0000002'}]}}),
+        ])
+        mock_sleep.assert_called_once_with(0.05)
+
+    @mock.patch('dynamodb_coupons.time.sleep')
+    @mock.patch('dynamodb_coupons._dynamodb_resource')
+    def test_dynamodb_batch_get_coupons_unprocessed(self, mock_dynamodb_resource, mock_sleep):
+        unprocessed_keys = {'coupons': {'Keys': [{'id': '0000001'}]}}
+        mock_dynamodb_resource.return_value = MagicMock(batch_get_item=MagicMock(side_effect=[
+            {'Responses': {'coupons': [{'id': '0000002'}]}, 'UnprocessedKeys': unprocessed_keys},
+            *[{'Responses': {}, 'UnprocessedKeys': unprocessed_keys}] * 4,
+        ]))
+        self.assertEqual({'Items': [{'id': '0000002'}], 'UnprocessedIds': ('0000001',)},
+                         dynamodb_batch_get_coupons(('0000001', '0000002')))
+        self.assertEqual(5, mock_dynamodb_resource().batch_get_item.call_count)
+        self.assertEqual(4, mock_sleep.call_count)
 
     @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
     def test_dynamodb_query_coupons(self, mock_dynamodb_coupons_table):
         mock_dynamodb_coupons_table.return_value = MagicMock(query=MagicMock())
-        dynamodb_query_coupons({'key': 'value'})
-        dynamodb_query_coupons(None)
+        dynamodb_query_coupons({'key': 'value'}, 20)
+        dynamodb_query_coupons(None, 20)
         mock_dynamodb_coupons_table().query.assert_has_calls([
             mock.call(
                 IndexName='fixed_key-id-index',
                 KeyConditionExpression=Key('fixed_key').eq(_FIXED_KEY_VALUE),
-                Limit=_QUERY_LIMIT,
+                Limit=20,
                 ExclusiveStartKey={'key': 'value'},
             ),
             mock.call(
                 IndexName='fixed_key-id-index',
                 KeyConditionExpression=Key('fixed_key').eq(_FIXED_KEY_VALUE),
-                Limit=_QUERY_LIMIT,
+                Limit=20,
+            ),
+        ])
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_query_coupons_active(self, mock_dynamodb_coupons_table):
+        # The first page lost one coupon yet to start to the filter, so the rest of the page is read after it.
+        mock_dynamodb_coupons_table.return_value = MagicMock(query=MagicMock(side_effect=[
+            {'Items': [{'id': '0000001'}], 'LastEvaluatedKey': {'id': '0000002'}},
+            {'Items': [{'id': '0000003'}], 'LastEvaluatedKey': {'id': '0000003'}},
+        ]))
+        self.assertEqual({'Items': [{'id': '0000001'}, {'id': '0000003'}], 'LastEvaluatedKey': {'id': '0000003'}},
+                         dynamodb_query_coupons(None, 2, 1767225600))
+        mock_dynamodb_coupons_table().query.assert_has_calls([
+            mock.call(
+                IndexName='fixed_key-active_until-index',
+                KeyConditionExpression=Key('fixed_key').eq(_FIXED_KEY_VALUE) & Key('active_until').gt(1767225600),
+                FilterExpression=Attr('active_from').not_exists() | Attr('active_from').lte(1767225600),
+                Limit=2,
+            ),
+            mock.call(
+                IndexName='fixed_key-active_until-index',
+                KeyConditionExpression=Key('fixed_key').eq(_FIXED_KEY_VALUE) & Key('active_until').gt(1767225600),
+                FilterExpression=Attr('active_from').not_exists() | Attr('active_from').lte(1767225600),
+                Limit=1,
+                ExclusiveStartKey={'id': '0000002'},
+            ),
+        ])
+        mock_dynamodb_coupons_table().query.side_effect = [{'Items': []}]
+        self.assertEqual({'Items': []}, dynamodb_query_coupons(None, 2, 1767225600))
+
+    @mock.patch('dynamodb_coupons._FIXED_KEY_SHARD_COUNT', 2)
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_query_coupons_active_sharded(self, mock_dynamodb_coupons_table):
+        shard_items = {
+            'fixed_key#0': [{'id': '0000002', 'active_until': 20}, {'id': '0000004', 'active_until': 30}],
+            'fixed_key#1': [{'id': '0000003', 'active_until': 20}, {'id': '0000001', 'active_until': 40}],
+        }
+
+        def query(**kwargs):
+            return {'Items': shard_items[kwargs['KeyConditionExpression'].get_expression()['values'][0]
+                                         .get_expression()['values'][1]]}
+
+        mock_dynamodb_coupons_table.return_value = MagicMock(query=MagicMock(side_effect=query))
+        self.assertEqual({
+            'Items': [{'id': '0000002', 'active_until': 20}, {'id': '0000003', 'active_until': 20}],
+            'LastEvaluatedKey': {'active_until': 20, 'id': '0000003'},
+        }, dynamodb_query_coupons({'active_until': 10, 'id': '0000005', 'fixed_key': 'fixed_key'}, 2, 15))
+        mock_dynamodb_coupons_table().query.assert_any_call(
+            IndexName='fixed_key-active_until-index',
+            KeyConditionExpression=Key('fixed_key').eq('fixed_key#1') & Key('active_until').gt(15),
+            FilterExpression=Attr('active_from').not_exists() | Attr('active_from').lte(15),
+            Limit=2,
+            ExclusiveStartKey={'active_until': 10, 'id': '0000005', 'fixed_key': 'fixed_key#1'},
+        )
+
+    @mock.patch('dynamodb_coupons._FIXED_KEY_SHARD_COUNT', 2)
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_query_coupons_sharded(self, mock_dynamodb_coupons_table):
+        shard_items = {
+            'fixed_key#0': [{'id': '0000002'}, {'id': '0000004'}],
+            'fixed_key#1': [{'id': '0000001'}, {'id': '0000003'}, {'id': '0000005'}],
+        }
+
+        def query(**kwargs):
+            return {'Items': shard_items[kwargs['KeyConditionExpression'].get_expression()['values'][1]]}
+
+        mock_dynamodb_coupons_table.return_value = MagicMock(query=MagicMock(side_effect=query))
+        self.assertEqual({
+            'Items': [{'id': '0000001'}, {'id': '0000002'}, {'id': '0000003'}],
+            'LastEvaluatedKey': {'id': '0000003'},
+        }, dynamodb_query_coupons({'id': '0000000', 'fixed_key': 'fixed_key'}, 3))
+        mock_dynamodb_coupons_table().query.assert_has_calls([
+            mock.call(
+                IndexName='fixed_key-id-index',
+                KeyConditionExpression=Key('fixed_key').eq('fixed_key#0'),
+                Limit=3,
+                ExclusiveStartKey={'id': '0000000', 'fixed_key': 'fixed_key#0'},
+            ),
+            mock.call(
+                IndexName='fixed_key-id-index',
+                KeyConditionExpression=Key('fixed_key').eq('fixed_key#1'),
+                Limit=3,
+                ExclusiveStartKey={'id': '0000000', 'fixed_key': 'fixed_key#1'},
+            ),
+        ], any_order=True)
+        shard_items['fixed_key#1'] = [{'id': '0000005'}]
+        shard_items['fixed_key#0'] = [{'id': '0000004'}]
+        self.assertEqual({'Items': [{'id': '0000004'}, {'id': '0000005'}]},
+                         dynamodb_query_coupons({'id': '0000003'}, 3))
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_scan_coupons(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(scan=MagicMock(side_effect=[
+            {'Items': [{'id': '0000001'}], 'LastEvaluatedKey': {'id': '0000001'}},
+            {'Items': [{'id': '0000002'}]},
+        ]))
+        self.assertEqual([{'id': '0000001'}, {'id': '0000002'}], dynamodb_scan_coupons())
+        mock_dynamodb_coupons_table().scan.assert_has_calls([
+            mock.call(), mock.call(ExclusiveStartKey={'id': '0000001'}),
+        ])
+
+    @mock.patch('dynamodb_coupons._FIXED_KEY_SHARD_COUNT', 2)
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_backfill_coupon_shards(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(
+            scan=MagicMock(side_effect=[
+                {'Items': [{'id': '0000001', 'fixed_key': 'fixed_key'}], 'LastEvaluatedKey': {'id': '0000001'}},
+                {'Items': [{'id': '0000002', 'fixed_key': 'fixed_key#0'}]},
+            ]),
+            update_item=MagicMock(),
+        )
+        self.assertEqual(1, dynamodb_backfill_coupon_shards())
+        mock_dynamodb_coupons_table().scan.assert_has_calls([
+            mock.call(ProjectionExpression='id, fixed_key'),
+            mock.call(ProjectionExpression='id, fixed_key', ExclusiveStartKey={'id': '0000001'}),
+        ])
+        mock_dynamodb_coupons_table().update_item.assert_called_once_with(
+            Key={'id': '0000001'},
+            UpdateExpression='set fixed_key = :fixed_key',
+            ConditionExpression=Attr('id').exists(),
+            ExpressionAttributeValues={':fixed_key': 'fixed_key#1'},
+        )
+
+    @mock.patch('dynamodb_coupons._dynamodb_coupons_table')
+    def test_dynamodb_backfill_coupon_validity(self, mock_dynamodb_coupons_table):
+        mock_dynamodb_coupons_table.return_value = MagicMock(
+            scan=MagicMock(return_value={'Items': [
+                {'id': '0000001'},
+                {'id': '0000002', 'valid_until': '2026-02-01T00:00:00Z'},
+                {'id': '0000003', 'active_until': 253402300799},
+            ]}),
+            update_item=MagicMock(),
+        )
+        self.assertEqual(2, dynamodb_backfill_coupon_validity())
+        mock_dynamodb_coupons_table().scan.assert_called_once_with(
+            ProjectionExpression='id, valid_from, valid_until, active_until')
+        mock_dynamodb_coupons_table().update_item.assert_has_calls([
+            mock.call(
+                Key={'id': '0000001'},
+                UpdateExpression='set active_until = :active_until',
+                ConditionExpression=Attr('id').exists(),
+                ExpressionAttributeValues={':active_until': 253402300799},
+            ),
+            mock.call(
+                Key={'id': '0000002'},
+                UpdateExpression='set active_until = :active_until, expires_at = :expires_at',
+                ConditionExpression=Attr('id').exists(),
+                ExpressionAttributeValues={':active_until': 1769904000, ':expires_at': 1769904000 + 30 * 24 * 60 * 60},
             ),
         ])
@@ -0,0 +1,305 @@
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+import dynamodb_coupons
+from background_tasks import defer_task, wait_deferred_tasks
+from dynamodb_atomic_counts import dynamodb_increment_atomic_count, dynamodb_get_atomic_count
+from expiring_cache import ExpiringLruCache
+from metrics import timed
+
+
+# Every write that changed a coupon bumps the catalog version in atomic_counts once, a bulk write included. Cache
+# keys include the version, so a container sees writes made by other containers at most
+# _CATALOG_VERSION_CHECK_SECONDS later. TTL deletions bump nothing, so an expired coupon is served for up to
+# _CACHE_TTL_SECONDS after DynamoDB deleted it.
+_CATALOG_VERSION_KEY = 'catalog_version'
+_CATALOG_VERSION_CHECK_SECONDS = 10
+_CACHE_TTL_SECONDS = 300
+_ITEM_CACHE_SIZE = 1024
+_PAGE_CACHE_SIZE = 128
+# Active listings are evaluated at the start of the current minute, so that their pages can be cached.
+_ACTIVE_AT_STEP_SECONDS = 60
+
+_catalog_version_cache = ExpiringLruCache(1)
+_item_cache = ExpiringLruCache(_ITEM_CACHE_SIZE)
+_page_cache = ExpiringLruCache(_PAGE_CACHE_SIZE)
+# Pages being prefetched, so that a request for one waits for it instead of querying again.
+_prefetch_futures = {}
+_prefetch_lock = threading.Lock()
+
+
+@timed
+def dynamodb_put_coupon(item):
+    result = dynamodb_coupons.dynamodb_put_coupon(item)
+    _invalidate()
+    return result
+
+
+@timed
+def dynamodb_batch_put_coupons(items):
+    result = dynamodb_coupons.dynamodb_batch_put_coupons(items)
+    if len(result) < len(items):
+        _invalidate()
+    return result
+
+
+@timed
+def dynamodb_replace_coupon(item):
+    result = dynamodb_coupons.dynamodb_replace_coupon(item)
+    if 'Attributes' in result:
+        _invalidate()
+    return result
+
+
+@timed
+def dynamodb_update_coupon(_id, attributes, removed_names=()):
+    result = dynamodb_coupons.dynamodb_update_coupon(_id, attributes, removed_names)
+    if 'Attributes' in result:
+        _invalidate()
+    return result
+
+
+@timed
+def dynamodb_get_coupon(_id):
+    cache_key = (_catalog_version(), _id)
+    result = _item_cache.get(cache_key)
+    if result is None:
+        get_coupon_result = dynamodb_coupons.dynamodb_get_coupon(_id)
+        result = {'Item': get_coupon_result['Item']} if 'Item' in get_coupon_result else {}
+        _item_cache.put(cache_key, result, time.time() + _CACHE_TTL_SECONDS)
+    return result
+
+
+@timed
+def dynamodb_batch_get_coupons(ids):
+    version = _catalog_version()
+    cached_results = {_id: _item_cache.get((version, _id)) for _id in ids}
+    missing_ids = tuple(_id for _id, result in cached_results.items() if result is None)
+    unprocessed_ids = ()
+    if missing_ids:
+        batch_get_result = dynamodb_coupons.dynamodb_batch_get_coupons(missing_ids)
+        fetched_items = {item['id']: item for item in batch_get_result['Items']}
+        unprocessed_ids = batch_get_result.get('UnprocessedIds', ())
+        for _id in missing_ids:
+            if _id in unprocessed_ids:
+                continue
+            result = {'Item': fetched_items[_id]} if _id in fetched_items else {}
+            _item_cache.put((version, _id), result, time.time() + _CACHE_TTL_SECONDS)
+            cached_results[_id] = result
+    return {
+        'Items': [result['Item'] for result in cached_results.values() if result is not None and 'Item' in result],
+        **({'UnprocessedIds': unprocessed_ids} if unprocessed_ids else {}),
+    }
+
+
+@timed
+def dynamodb_query_coupons(exclusive_start_key, limit, active=False):
+    active_at = _active_at() if active else None
+    cache_key = _page_cache_key(exclusive_start_key, limit, active_at)
+    result = _page_cache.get(cache_key)
+    if result is not None:
+        return result
+    with _prefetch_lock:
+        future = _prefetch_futures.get(cache_key)
+    if future is not None and future.exception() is None:
+        return future.result()
+    return _query_page(cache_key, exclusive_start_key, limit, active_at)
+
+
+def dynamodb_prefetch_coupons(exclusive_start_key, limit, active=False):
+    # Returns without waiting, and the invocation waits for the page before it returns, as a frozen container would
+    # finish it in a later invocation. Only one page is prefetched at a time, which bounds the executor threads that
+    # sharded queries keep blocked on their own shard queries.
+    active_at = _active_at() if active else None
+    cache_key = _page_cache_key(exclusive_start_key, limit, active_at)
+    with _prefetch_lock:
+        if _prefetch_futures or cache_key in _page_cache:
+            return
+        _prefetch_futures[cache_key] = defer_task(_prefetch_page, cache_key, exclusive_start_key, limit, active_at)
+
+
+@timed
+def dynamodb_delete_coupon(_id):
+    result = dynamodb_coupons.dynamodb_delete_coupon(_id)
+    if 'Attributes' in result:
+        _invalidate()
+    return result
+
+
+def dynamodb_coupons_cache_stats():
+    return {'items': _item_cache.stats(), 'pages': _page_cache.stats()}
+
+
+def _page_cache_key(exclusive_start_key, limit, active_at):
+    return _catalog_version(), json.dumps(exclusive_start_key, sort_keys=True, default=str), limit, active_at
+
+
+def _active_at():
+    return int(time.time()) // _ACTIVE_AT_STEP_SECONDS * _ACTIVE_AT_STEP_SECONDS
+
+
+def _query_page(cache_key, exclusive_start_key, limit, active_at):
+    query_coupons_result = dynamodb_coupons.dynamodb_query_coupons(exclusive_start_key, limit, active_at)
+    result = {key: query_coupons_result[key] for key in ('Items', 'LastEvaluatedKey') if key in query_coupons_result}
+    _page_cache.put(cache_key, result, time.time() + _CACHE_TTL_SECONDS)
+    return result
+
+
+def _prefetch_page(cache_key, exclusive_start_key, limit, active_at):
+    try:
+        return _query_page(cache_key, exclusive_start_key, limit, active_at)
+    finally:
+        with _prefetch_lock:
+            del _prefetch_futures[cache_key]
+
+
+def _catalog_version():
+    version = _catalog_version_cache.get(_CATALOG_VERSION_KEY)
+    if version is None:
+        version = dynamodb_get_atomic_count(_CATALOG_VERSION_KEY)
+        _catalog_version_cache.put(_CATALOG_VERSION_KEY, version, time.time() + _CATALOG_VERSION_CHECK_SECONDS)
+    return version
+
+
+def _invalidate():
+    version = dynamodb_increment_atomic_count(_CATALOG_VERSION_KEY)
+    _catalog_version_cache.put(_CATALOG_VERSION_KEY, version, time.time() + _CATALOG_VERSION_CHECK_SECONDS)
+    _item_cache.clear()
+    _page_cache.clear()
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        for cache in (_catalog_version_cache, _item_cache, _page_cache):
+            cache.clear()
+
+    @mock.patch('dynamodb_coupons_cache.dynamodb_get_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_get_coupon')
+    def test_dynamodb_get_coupon(self, mock_dynamodb_get_coupon, mock_dynamodb_get_atomic_count):
+        mock_dynamodb_get_atomic_count.return_value = 1
+        mock_dynamodb_get_coupon.return_value = {'Item': {'id': '0000001'}, 'ResponseMetadata': {}}
+        self.assertEqual({'Item': {'id': '0000001'}}, dynamodb_get_coupon('0000001'))
+        self.assertEqual({'Item': {'id': '0000001'}}, dynamodb_get_coupon('0000001'))
+        mock_dynamodb_get_coupon.assert_called_once_with('0000001')
+        mock_dynamodb_get_atomic_count.assert_called_once_with('catalog_version')
+
+    @mock.patch('dynamodb_coupons_cache.dynamodb_get_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_get_coupon')
+    @mock.patch('dynamodb_coupons.dynamodb_batch_get_coupons')
+    def test_dynamodb_batch_get_coupons(self, mock_dynamodb_batch_get_coupons, mock_dynamodb_get_coupon,
+                                        mock_dynamodb_get_atomic_count):
+        mock_dynamodb_get_atomic_count.return_value = 1
+        mock_dynamodb_get_coupon.return_value = {'Item': {'id': '0000001'}}
+        mock_dynamodb_batch_get_coupons.return_value = {'Items': [{'id': '0000002'}], 'UnprocessedIds': ('0000004',)}
+        dynamodb_get_coupon('0000001')
+        self.assertEqual({'Items': [{'id': '0000001'}, {'id': '0000002'}], 'UnprocessedIds': ('0000004',)},
+                         dynamodb_batch_get_coupons(('0000001', '0000002', '0000003', '0000004')))
+        mock_dynamodb_batch_get_coupons.assert_called_once_with(('0000002', '0000003', '0000004'))
+        mock_dynamodb_batch_get_coupons.return_value = {'Items': [{'id': '0000004'}]}
+        self.assertEqual({'Items': [{'id': '0000002'}, {'id': '0000004'}]},
+                         dynamodb_batch_get_coupons(('0000002', '0000003', '0000004')))
+        mock_dynamodb_batch_get_coupons.assert_called_with(('0000004',))
+
+    @mock.patch('dynamodb_coupons_cache.dynamodb_get_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_query_coupons')
+    def test_dynamodb_query_coupons(self, mock_dynamodb_query_coupons, mock_dynamodb_get_atomic_count):
+        mock_dynamodb_get_atomic_count.return_value = 1
+        mock_dynamodb_query_coupons.return_value = {'Items': [], 'LastEvaluatedKey': {'id': '0000020'}}
+        self.assertEqual({'Items': [], 'LastEvaluatedKey': {'id': '0000020'}}, dynamodb_query_coupons(None, 20))
+        dynamodb_query_coupons(None, 20)
+        dynamodb_query_coupons({'id': '0000020'}, 20)
+        dynamodb_query_coupons({'id': '0000020'}, 50)
+        mock_dynamodb_query_coupons.assert_has_calls([
+            mock.call(None, 20, None), mock.call({'id': '0000020'}, 20, None), mock.call({'id': '0000020'}, 50, None),
+        ])
+        self.assertEqual(3, mock_dynamodb_query_coupons.call_count)
+
+    @mock.patch('dynamodb_coupons_cache.time.time')
+    @mock.patch('dynamodb_coupons_cache.dynamodb_get_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_query_coupons')
+    def test_dynamodb_query_coupons_active(self, mock_dynamodb_query_coupons, mock_dynamodb_get_atomic_count,
+                                           mock_time):
+        mock_dynamodb_get_atomic_count.return_value = 1
+        mock_dynamodb_query_coupons.return_value = {'Items': []}
+        for now in (1767225600, 1767225659, 1767225660):
+            mock_time.return_value = now
+            dynamodb_query_coupons(None, 20, active=True)
+        dynamodb_query_coupons(None, 20)
+        mock_dynamodb_query_coupons.assert_has_calls([
+            mock.call(None, 20, 1767225600), mock.call(None, 20, 1767225660), mock.call(None, 20, None),
+        ])
+        self.assertEqual(3, mock_dynamodb_query_coupons.call_count)
+
+    @mock.patch('dynamodb_coupons_cache.dynamodb_get_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_query_coupons')
+    def test_dynamodb_prefetch_coupons(self, mock_dynamodb_query_coupons, mock_dynamodb_get_atomic_count):
+        mock_dynamodb_get_atomic_count.return_value = 1
+        started = threading.Event()
+        release = threading.Event()
+
+        def query_coupons(exclusive_start_key, limit, active_at):
+            started.set()
+            release.wait(5)
+            return {'Items': [{'id': '0000021'}]}
+
+        mock_dynamodb_query_coupons.side_effect = query_coupons
+        dynamodb_prefetch_coupons({'id': '0000020'}, 20)
+        started.wait(5)
+        dynamodb_prefetch_coupons({'id': '0000020'}, 20)
+        dynamodb_prefetch_coupons({'id': '0000040'}, 20)
+        release.set()
+        # The invocation waits for the prefetch, which leaves the page cached.
+        wait_deferred_tasks()
+        self.assertEqual({}, _prefetch_futures)
+        self.assertEqual({'Items': [{'id': '0000021'}]}, dynamodb_query_coupons({'id': '0000020'}, 20))
+        mock_dynamodb_query_coupons.assert_called_once_with({'id': '0000020'}, 20, None)
+        dynamodb_prefetch_coupons({'id': '0000020'}, 20)
+        self.assertEqual(1, mock_dynamodb_query_coupons.call_count)
+
+    @mock.patch('dynamodb_coupons_cache.dynamodb_increment_atomic_count')
+    @mock.patch('dynamodb_coupons_cache.dynamodb_get_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_get_coupon')
+    @mock.patch('dynamodb_coupons.dynamodb_put_coupon')
+    @mock.patch('dynamodb_coupons.dynamodb_delete_coupon')
+    def test_invalidate(self, mock_dynamodb_delete_coupon, mock_dynamodb_put_coupon, mock_dynamodb_get_coupon,
+                        mock_dynamodb_get_atomic_count, mock_dynamodb_increment_atomic_count):
+        mock_dynamodb_get_atomic_count.return_value = 1
+        mock_dynamodb_increment_atomic_count.side_effect = [2, 3]
+        mock_dynamodb_get_coupon.return_value = {'Item': {'id': '0000001'}}
+        mock_dynamodb_delete_coupon.return_value = {'Attributes': {'id': '0000001'}}
+        dynamodb_get_coupon('0000001')
+        dynamodb_put_coupon({'id': '0000001'})
+        dynamodb_get_coupon('0000001')
+        dynamodb_delete_coupon('0000001')
+        dynamodb_get_coupon('0000001')
+        self.assertEqual(3, mock_dynamodb_get_coupon.call_count)
+        mock_dynamodb_put_coupon.assert_called_once_with({'id': '0000001'})
+        mock_dynamodb_delete_coupon.assert_called_once_with('0000001')
+        mock_dynamodb_get_atomic_count.assert_called_once_with('catalog_version')
+        mock_dynamodb_increment_atomic_count.assert_has_calls([mock.call('catalog_version')] * 2)
+
+    @mock.patch('dynamodb_coupons_cache.dynamodb_increment_atomic_count')
+    @mock.patch('dynamodb_coupons.dynamodb_update_coupon')
+    @mock.patch('dynamodb_coupons.dynamodb_replace_coupon')
+    @mock.patch('dynamodb_coupons.dynamodb_delete_coupon')
+    @mock.patch('dynamodb_coupons.dynamodb_batch_put_coupons')
+    def test_invalidate_unchanged(self, mock_dynamodb_batch_put_coupons, mock_dynamodb_delete_coupon,
+                                  mock_dynamodb_replace_coupon, mock_dynamodb_update_coupon,
+                                  mock_dynamodb_increment_atomic_count):
+        mock_dynamodb_increment_atomic_count.return_value = 2
+        mock_dynamodb_batch_put_coupons.return_value = [{'id': '0000001'}, {'id': '0000002'}]
+        mock_dynamodb_delete_coupon.return_value = {}
+        mock_dynamodb_replace_coupon.return_value = {}
+        mock_dynamodb_update_coupon.return_value = {'Item': {'id': {'S': '0000001'}}}
+        dynamodb_batch_put_coupons([{'id': '0000001'}, {'id': '0000002'}])
+        dynamodb_delete_coupon('0000001')
+        dynamodb_replace_coupon({'id': '0000001'})
+        dynamodb_update_coupon('0000001', {'valid_from': '2026-01-01T00:00:00Z'})
+        mock_dynamodb_increment_atomic_count.assert_not_called()
+        mock_dynamodb_batch_put_coupons.return_value = [{'id': '0000002'}]
+        dynamodb_batch_put_coupons([{'id': '0000001'}, {'id': '0000002'}])
+        mock_dynamodb_increment_atomic_count.assert_called_once_with('catalog_version')
@@ -0,0 +1,87 @@
+import collections
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+class ExpiringLruCache:
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        # Neither counted nor refreshed, so that checking ahead of time does not distort the statistics or eviction.
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def put(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries)}
+
+
+def epoch_end(epoch_seconds):
+    return (int(time.time() // epoch_seconds) + 1) * epoch_seconds
+
+
+class Test(unittest.TestCase):
+
+    @mock.patch('expiring_cache.time.time')
+    def test_get_put(self, mock_time):
+        mock_time.return_value = 100
+        cache = ExpiringLruCache(2)
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', 'value', 200)
+        self.assertIn('key', cache)
+        self.assertEqual('value', cache.get('key'))
+        mock_time.return_value = 200
+        self.assertNotIn('key', cache)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual({'hits': 1, 'misses': 2, 'size': 0}, cache.stats())
+
+    @mock.patch('expiring_cache.time.time')
+    def test_lru_eviction(self, mock_time):
+        mock_time.return_value = 100
+        cache = ExpiringLruCache(2)
+        cache.put('key_0', 'value_0', 200)
+        cache.put('key_1', 'value_1', 200)
+        cache.get('key_0')
+        cache.put('key_2', 'value_2', 200)
+        self.assertEqual('value_0', cache.get('key_0'))
+        self.assertIsNone(cache.get('key_1'))
+        self.assertEqual('value_2', cache.get('key_2'))
+
+    @mock.patch('expiring_cache.time.time')
+    def test_epoch_end(self, mock_time):
+        mock_time.return_value = 1799.5
+        self.assertEqual(1800, epoch_end(1800))
+        mock_time.return_value = 1800
+        self.assertEqual(3600, epoch_end(1800))
@@ -0,0 +1,138 @@
+import importlib.util
+import io
+import os
+import unittest
+from unittest import mock
+
+
+_MAX_WIDTH = int(os.environ.get('COUPON_IMAGE_MAX_WIDTH', '1200'))
+_MAX_HEIGHT = int(os.environ.get('COUPON_IMAGE_MAX_HEIGHT', '1200'))
+# 0 disables thumbnails.
+_THUMBNAIL_SIZE = int(os.environ.get('COUPON_THUMBNAIL_SIZE', '320'))
+# Decoded images take about 4 bytes a pixel, and Pillow only refuses above 179M pixels, which a compressed PNG of a
+# few hundred KiB can reach, so larger images are turned away from their header instead.
+_MAX_PIXELS = 4096 * 4096
+_WEBP_QUALITY = 80
+_WEBP_CONTENT_TYPE = 'image/webp'
+# Pillow is looked up without importing it, which takes tens of milliseconds, so that only invocations that
+# process an image pay for the import rather than every cold start.
+_PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+
+def image_pipeline_id():
+    # Identifies what process_image does with the current settings, or None when it leaves images as they are.
+    if not _PILLOW_AVAILABLE:
+        return None
+    return f"webp{_WEBP_QUALITY}:{_MAX_WIDTH}x{_MAX_HEIGHT}:{_THUMBNAIL_SIZE}"
+
+
+def thumbnails_enabled():
+    return _PILLOW_AVAILABLE and _THUMBNAIL_SIZE > 0
+
+
+def is_within_pixel_limit(body):
+    # Images Pillow cannot open are stored as they are, so only the ones it would decode are limited.
+    if not _PILLOW_AVAILABLE:
+        return True
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(body)) as image:
+            return image.width * image.height <= _MAX_PIXELS
+    except Image.DecompressionBombError:
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+def process_image(body, content_type):
+    # Returns the image to store and its thumbnail, each as (body, content_type). The thumbnail is None only when
+    # disabled. An image that cannot be decoded is its own thumbnail, and is kept when re-encoding does not pay off.
+    if not _PILLOW_AVAILABLE:
+        return (body, content_type), None
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(io.BytesIO(body)) as image:
+            if image.width * image.height > _MAX_PIXELS:
+                raise ValueError(f"{image.width}x{image.height} is over the pixel limit")
+            # Only the first frame survives re-encoding, so animations are stored as they are.
+            animated = getattr(image, 'is_animated', False)
+            # Lets JPEG decode at a reduced scale when the image is far larger than it will be stored.
+            image.draft('RGB', (_MAX_WIDTH, _MAX_HEIGHT))
+            image = ImageOps.exif_transpose(image)
+            resized = image.width > _MAX_WIDTH or image.height > _MAX_HEIGHT
+            image.thumbnail((_MAX_WIDTH, _MAX_HEIGHT))
+            optimized_body = _encode_webp(image) if not animated else body
+            thumbnail = None
+            if thumbnails_enabled():
+                image.thumbnail((_THUMBNAIL_SIZE, _THUMBNAIL_SIZE))
+                thumbnail = (_encode_webp(image), _WEBP_CONTENT_TYPE)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return (body, content_type), (body, content_type) if thumbnails_enabled() else None
+    if animated or (not resized and len(optimized_body) >= len(body)):
+        return (body, content_type), thumbnail
+    return (optimized_body, _WEBP_CONTENT_TYPE), thumbnail
+
+
+def _encode_webp(image):
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    output = io.BytesIO()
+    image.save(output, 'WEBP', quality=_WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        if not _PILLOW_AVAILABLE:
+            self.skipTest('Pillow is not installed')
+
+    @staticmethod
+    def _png(width, height):
+        from PIL import Image
+        output = io.BytesIO()
+        Image.linear_gradient('L').resize((width, height)).convert('RGB').save(output, 'PNG')
+        return output.getvalue()
+
+    def test_process_image(self):
+        from PIL import Image
+        body = self._png(2400, 600)
+        ((optimized_body, content_type), (thumbnail_body, thumbnail_content_type)) = process_image(body, 'image/png')
+        self.assertEqual('image/webp', content_type)
+        with Image.open(io.BytesIO(optimized_body)) as image:
+            self.assertEqual((1200, 300), image.size)
+        self.assertEqual('image/webp', thumbnail_content_type)
+        with Image.open(io.BytesIO(thumbnail_body)) as image:
+            self.assertEqual((320, 80), image.size)
+
+    def test_process_image_animated(self):
+        from PIL import Image
+        output = io.BytesIO()
+        frames = [Image.new('RGB', (8, 8), color) for color in ('red', 'blue')]
+        frames[0].save(output, 'GIF', save_all=True, append_images=frames[1:])
+        body = output.getvalue()
+        ((optimized_body, content_type), (_, thumbnail_content_type)) = process_image(body, 'image/gif')
+        self.assertEqual((body, 'image/gif'), (optimized_body, content_type))
+        self.assertEqual('image/webp', thumbnail_content_type)
+
+    def test_process_image_larger(self):
+        body = self._png(4, 4)
+        with mock.patch('image_processing._encode_webp', return_value=body + b'\x00'):
+            self.assertEqual((body, 'image/png'), process_image(body, 'image/png')[0])
+
+    def test_process_image_too_large(self):
+        from PIL import Image
+        output = io.BytesIO()
+        Image.new('1', (4097, 4096)).save(output, 'PNG')
+        body = output.getvalue()
+        self.assertFalse(is_within_pixel_limit(body))
+        self.assertTrue(is_within_pixel_limit(self._png(4096, 1)))
+        self.assertTrue(is_within_pixel_limit(b'\x89PNG\r\n\x1a\nbroken'))
+        with mock.patch('PIL.Image.Image.load', side_effect=AssertionError('decoded')):
+            self.assertEqual((body, 'image/png'), process_image(body, 'image/png')[0])
+
+    def test_process_image_undecodable(self):
+        body = b'\x89PNG\r\n\x1a\nbroken'
+        self.assertEqual(((body, 'image/png'), (body, 'image/png')), process_image(body, 'image/png'))
+        with mock.patch('image_processing._THUMBNAIL_SIZE', 0):
+            self.assertEqual(((body, 'image/png'), None), process_image(body, 'image/png'))
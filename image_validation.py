@@ -0,0 +1,87 @@
+import base64
+import binascii
+import unittest
+
+
+_SIGNATURES = {
+    'image/png': ((0, b'\x89PNG\r\n\x1a\n'),),
+    'image/jpeg': ((0, b'\xff\xd8\xff'),),
+    'image/gif': ((0, b'GIF8'),),
+    'image/webp': ((0, b'RIFF'), (8, b'WEBP')),
+}
+# Enough base64 characters to decode the longest signature above.
+_SIGNATURE_ENCODED_LENGTH = 16
+_DATA_URL_PREFIX = 'data:'
+_DATA_URL_BASE64_SUFFIX = ';base64'
+_DATA_URL_HEADER_MAX_LENGTH = 64
+
+
+def is_supported_image_type(content_type):
+    return content_type in _SIGNATURES
+
+
+def matches_image_type(mime_type, body):
+    return is_supported_image_type(mime_type) and _matches_signature(mime_type, body)
+
+
+def decode_image_data_url(name, source, max_bytes):
+    # The header is located with bounded searches and the size and signature are checked before the payload
+    # is decoded, so an oversized or mislabelled image is rejected without copying it.
+    comma_index = source.find(',', 0, _DATA_URL_HEADER_MAX_LENGTH)
+    if (comma_index == -1 or not source.startswith(_DATA_URL_PREFIX)
+            or not source.endswith(_DATA_URL_BASE64_SUFFIX, 0, comma_index)):
+        return (f"invalid.{name}",), None, None
+    mime_type = source[len(_DATA_URL_PREFIX):comma_index - len(_DATA_URL_BASE64_SUFFIX)]
+    if not is_supported_image_type(mime_type):
+        return (f"invalid.{name}_type",), None, None
+    # Padding makes the encoded length overstate the decoded one by up to two bytes.
+    if (len(source) - comma_index - 1) // 4 * 3 - 2 > max_bytes:
+        return (f"invalid.{name}_size",), None, None
+    try:
+        head = base64.b64decode(source[comma_index + 1:comma_index + 1 + _SIGNATURE_ENCODED_LENGTH], validate=True)
+        if not _matches_signature(mime_type, head):
+            return (f"invalid.{name}_type",), None, None
+        body = base64.b64decode(source[comma_index + 1:], validate=True)
+    except binascii.Error:
+        return (f"invalid.{name}",), None, None
+    if len(body) > max_bytes:
+        return (f"invalid.{name}_size",), None, None
+    return (), mime_type, body
+
+
+def _matches_signature(mime_type, head):
+    return all(head.startswith(signature, offset) for offset, signature in _SIGNATURES[mime_type])
+
+
+class Test(unittest.TestCase):
+
+    @staticmethod
+    def _data_url(mime_type, body):
+        return f"data:{mime_type};base64,{base64.b64encode(body).decode()}"
+
+    def test_decode_image_data_url(self):
+        for mime_type, body in (('image/png', b'\x89PNG\r\n\x1a\n' + b'\x00' * 8),
+                                ('image/jpeg', b'\xff\xd8\xff\xe0' + b'\x00' * 8),
+                                ('image/gif', b'GIF89a' + b'\x00' * 8),
+                                ('image/webp', b'RIFF\x00\x00\x00\x00WEBPVP8 ')):
+            self.assertEqual(((), mime_type, body), decode_image_data_url('image', self._data_url(mime_type, body), 64))
+
+    def test_decode_image_data_url_invalid(self):
+        png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 8
+        for source, message in (
+                ('invalid', 'invalid.image'),
+                ('image/png;base64,iVBORw0KGgo=', 'invalid.image'),
+                ('data:image/png,iVBORw0KGgo=', 'invalid.image'),
+                ('data:image/png;base64,!!!!', 'invalid.image'),
+                (f"data:image/png;{'x' * 64};base64,iVBORw0KGgo=", 'invalid.image'),
+                (self._data_url('image/svg+xml', b'<svg/>'), 'invalid.image_type'),
+                (self._data_url('image/jpeg', png), 'invalid.image_type'),
+                (self._data_url('image/png', png * 8), 'invalid.image_size'),
+        ):
+            self.assertEqual(((message,), None, None), decode_image_data_url('image', source, 64))
+
+    def test_matches_image_type(self):
+        png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 8
+        self.assertTrue(matches_image_type('image/png', png))
+        self.assertFalse(matches_image_type('image/jpeg', png))
+        self.assertFalse(matches_image_type('image/svg+xml', b'<svg/>'))
@@ -0,0 +1,66 @@
+import decimal
+import json
+import unittest
+from unittest import mock
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default).decode()
+    return json.dumps(value, ensure_ascii=False, default=_default)
+
+
+def encode_json_array(fragments):
+    # Fragments are already encoded values, so a list body is spliced together instead of encoded again.
+    # The separator follows the encoder in use so that both ways produce the same text.
+    return '[' + (',' if orjson is not None else ', ').join(fragments) + ']'
+
+
+def iter_json_array(fragments):
+    # Same text as encode_json_array, produced piece by piece as the fragments are.
+    separator = ',' if orjson is not None else ', '
+    yield '['
+    for index, fragment in enumerate(fragments):
+        if index:
+            yield separator
+        yield fragment
+    yield ']'
+
+
+def _default(value):
+    # DynamoDB returns every number as Decimal.
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class Test(unittest.TestCase):
+
+    def test_encode_json(self):
+        value = {'title': 'クーポン', 'count': decimal.Decimal('1'), 'rate': decimal.Decimal('0.5'), 'ids': ('1',)}
+        self.assertEqual(value | {'count': 1, 'rate': 0.5, 'ids': ['1']}, json.loads(encode_json(value)))
+        with mock.patch('json_encoding.orjson', None):
+            self.assertEqual('{"title": "クーポン", "count": 1, "rate": 0.5, "ids": ["1"]}', encode_json(value))
+        with self.assertRaises(TypeError):
+            encode_json(object())
+
+    def test_encode_json_array(self):
+        fragments = (encode_json({'id': '1'}), encode_json({'id': '2'}))
+        self.assertEqual(encode_json(({'id': '1'}, {'id': '2'})), encode_json_array(fragments))
+        self.assertEqual('[]', encode_json_array(()))
+        with mock.patch('json_encoding.orjson', None):
+            fragments = (encode_json({'id': '1'}), encode_json({'id': '2'}))
+            self.assertEqual(encode_json(({'id': '1'}, {'id': '2'})), encode_json_array(fragments))
+
+    def test_iter_json_array(self):
+        fragments = (encode_json({'id': '1'}), encode_json({'id': '2'}))
+        self.assertEqual(encode_json_array(fragments), ''.join(iter_json_array(iter(fragments))))
+        self.assertEqual('[]', ''.join(iter_json_array(())))
+        with mock.patch('json_encoding.orjson', None):
+            fragments = (encode_json({'id': '1'}), encode_json({'id': '2'}))
+            self.assertEqual(encode_json_array(fragments), ''.join(iter_json_array(fragments)))
@@ -1,28 +1,80 @@
+import base64
+import binascii
 import json
 import re
 import unittest
 
 from unittest import mock
-from coupon_action import create_coupon, read_coupon, update_coupon, delete_coupon, query_coupons
-from request_check import check_request_exists_keys, check_request_str_values
-from api_gateway_response import build_bad_request_response, build_not_found_response
+from coupon_action import (create_coupon, issue_coupon_image_uploads, bulk_create_coupons, read_coupon,
+                           batch_read_coupons, update_coupon, patch_coupon, delete_coupon, query_coupons,
+                           read_coupon_catalog, search_coupons, expire_coupons, apply_coupon_changes)
+from dynamodb_coupons import dynamodb_expired_coupons, dynamodb_coupon_changes
+from request_check import check_request_exists_keys, check_request_str_values, check_request_list_of_dicts
+from api_gateway_response import (build_ok_response, build_bad_request_response, build_not_found_response,
+                                  build_payload_too_large_response, compress_response)
+from background_tasks import wait_deferred_tasks
+from qr_codes import qr_code_generation_enabled
+from metrics import timed, emit_metrics
 
 
 _ID_PATTERN = re.compile('\d+')
+_BULK_CREATE_LIMIT = 500
+_BATCH_READ_LIMIT = 100
+_QUERY_LIMIT_MAX = 100
+_IMAGE_NAMES = ('image', 'qr_code_image')
+_VALIDITY_NAMES = ('valid_from', 'valid_until')
+# Checked before the body is parsed. Inline images are limited again, after decoding, in coupon_action.
+_BODY_MAX_LENGTH = 4 * 1024 * 1024
 
 
 def lambda_handler(event, context):
-    return next(call(event) for match, call in _route() if match(event))
+    (route, call) = _match_route(event)
+    response = None
+    try:
+        response = call(event) if not _exceeds_body_limit(event) else build_payload_too_large_response('body_too_large')
+        response = compress_response(response, _pick_header(event, 'Accept-Encoding'))
+    finally:
+        # Tasks deferred before a failure still finish within this invocation, not in a frozen container.
+        wait_deferred_tasks()
+        emit_metrics(route, response)
+    return response
+
+
+def stream_handler(event, context):
+    # Invoked by the coupons table's stream with every change to it, TTL deletions arriving as REMOVE records.
+    # Applying the changes is safe to repeat, so its failure fails the whole batch. Expiring is retried from the
+    # first coupon that failed, reported as a batch item failure.
+    response = None
+    try:
+        failed_sequence_number = expire_coupons(dynamodb_expired_coupons(event['Records']))
+        apply_coupon_changes(dynamodb_coupon_changes(event['Records']))
+        response = build_ok_response(None)
+    finally:
+        wait_deferred_tasks()
+        emit_metrics('coupon_stream', response)
+    return {'batchItemFailures': [{'itemIdentifier': failed_sequence_number}]
+            if failed_sequence_number is not None else []}
+
+
+@timed
+def _match_route(event):
+    return next((route, call) for route, match, call in _route() if match(event))
 
 
 def _route():
     return (
-        (_match_create_coupon, _call_create_coupon),
-        (_match_read_coupon, _call_read_coupon),
-        (_match_update_coupon, _call_update_coupon),
-        (_match_delete_coupon, _call_delete_coupon),
-        (_match_query_coupons, _call_query_coupons),
-        (lambda _: True, lambda _: build_not_found_response('route_not_found')),
+        ('issue_coupon_image_uploads', _match_issue_coupon_image_uploads, _call_issue_coupon_image_uploads),
+        ('bulk_create_coupons', _match_bulk_create_coupons, _call_bulk_create_coupons),
+        ('create_coupon', _match_create_coupon, _call_create_coupon),
+        ('read_coupon', _match_read_coupon, _call_read_coupon),
+        ('batch_read_coupons', _match_batch_read_coupons, _call_batch_read_coupons),
+        ('update_coupon', _match_update_coupon, _call_update_coupon),
+        ('patch_coupon', _match_patch_coupon, _call_patch_coupon),
+        ('delete_coupon', _match_delete_coupon, _call_delete_coupon),
+        ('read_coupon_catalog', _match_read_coupon_catalog, _call_read_coupon_catalog),
+        ('search_coupons', _match_search_coupons, _call_search_coupons),
+        ('query_coupons', _match_query_coupons, _call_query_coupons),
+        ('route_not_found', lambda _: True, lambda _: build_not_found_response('route_not_found')),
     )
 
 
@@ -30,56 +82,176 @@ def _match_create_coupon(event):
     return event['httpMethod'] == 'POST' and _allowed_destructive_action(event)
 
 
+def _match_issue_coupon_image_uploads(event):
+    return _match_create_coupon(event) and _has_path_name(event, 'uploads')
+
+
+def _match_bulk_create_coupons(event):
+    if not _match_create_coupon(event) or type(event['body']) is not str:
+        return False
+    try:
+        return _decode_body(event).lstrip()[:1] in ('[', b'[')
+    except binascii.Error:
+        return False
+
+
 def _match_read_coupon(event):
     return event['httpMethod'] == 'GET' and _has_valid_path_id(event)
 
 
+def _match_batch_read_coupons(event):
+    return (
+            event['httpMethod'] == 'GET'
+            and type(event.get('queryStringParameters')) is dict
+            and 'ids' in event['queryStringParameters']
+    )
+
+
 def _match_update_coupon(event):
     return event['httpMethod'] == 'PUT' and _has_valid_path_id(event) and _allowed_destructive_action(event)
 
 
+def _match_patch_coupon(event):
+    return event['httpMethod'] == 'PATCH' and _has_valid_path_id(event) and _allowed_destructive_action(event)
+
+
 def _match_delete_coupon(event):
     return event['httpMethod'] == 'DELETE' and _has_valid_path_id(event) and _allowed_destructive_action(event)
 
 
+def _match_read_coupon_catalog(event):
+    return event['httpMethod'] == 'GET' and _has_path_name(event, 'catalog')
+
+
+def _match_search_coupons(event):
+    return event['httpMethod'] == 'GET' and _has_path_name(event, 'search')
+
+
 def _match_query_coupons(event):
     return event['httpMethod'] == 'GET'
 
 
 def _call_create_coupon(event):
-    body = json.loads(event['body'])
-    if not check_request_exists_keys(body, 'title', 'description', 'image', 'qr_code_image'):
+    body = _load_body(event)
+    if not _has_coupon_keys(body):
+        return build_bad_request_response('not_exists_key')
+    if not _has_str_coupon_values(body):
+        return build_bad_request_response('invalid_type')
+    return create_coupon(**_pick_coupon(body))
+
+
+def _call_issue_coupon_image_uploads(event):
+    body = _load_body(event)
+    if not check_request_exists_keys(body, 'image_content_type', 'qr_code_image_content_type'):
+        return build_bad_request_response('not_exists_key')
+    if not check_request_str_values(body, 'image_content_type', 'qr_code_image_content_type'):
+        return build_bad_request_response('invalid_type')
+    return issue_coupon_image_uploads(body['image_content_type'], body['qr_code_image_content_type'])
+
+
+def _call_bulk_create_coupons(event):
+    body = _load_body(event)
+    if not 1 <= len(body) <= _BULK_CREATE_LIMIT:
+        return build_bad_request_response('invalid_length')
+    if not check_request_list_of_dicts(body):
+        return build_bad_request_response('invalid_type')
+    if not all(_has_coupon_keys(coupon) for coupon in body):
         return build_bad_request_response('not_exists_key')
-    if not check_request_str_values(body, 'title', 'description', 'image', 'qr_code_image'):
+    if not all(_has_str_coupon_values(coupon) for coupon in body):
         return build_bad_request_response('invalid_type')
-    return create_coupon(body['title'], body['description'], body['image'], body['qr_code_image'])
+    return bulk_create_coupons([_pick_coupon(coupon) for coupon in body])
 
 
 def _call_read_coupon(event):
-    return read_coupon(_pick_path_id(event))
+    return read_coupon(_pick_path_id(event), _pick_header(event, 'If-None-Match'))
+
+
+def _call_batch_read_coupons(event):
+    ids = event['queryStringParameters']['ids'].split(',')
+    if not 1 <= len(ids) <= _BATCH_READ_LIMIT:
+        return build_bad_request_response('invalid_length')
+    if not all(_ID_PATTERN.fullmatch(_id) for _id in ids):
+        return build_bad_request_response('invalid_id')
+    return batch_read_coupons(tuple(ids))
 
 
 def _call_update_coupon(event):
-    body = json.loads(event['body'])
-    if not check_request_exists_keys(body, 'title', 'description', 'image', 'qr_code_image'):
+    body = _load_body(event)
+    if not _has_coupon_keys(body):
+        return build_bad_request_response('not_exists_key')
+    if not _has_str_coupon_values(body):
+        return build_bad_request_response('invalid_type')
+    return update_coupon(_pick_path_id(event), **_pick_coupon(body))
+
+
+def _call_patch_coupon(event):
+    body = _load_body(event)
+    fields = _pick_coupon_fields(body) if type(body) is dict else {}
+    if not fields:
         return build_bad_request_response('not_exists_key')
-    if not check_request_str_values(body, 'title', 'description', 'image', 'qr_code_image'):
+    if not all(type(value) is str for value in fields.values()):
         return build_bad_request_response('invalid_type')
-    return update_coupon(_pick_path_id(event), body['title'], body['description'], body['image'], body['qr_code_image'])
+    return patch_coupon(_pick_path_id(event), _pick_image_sources(fields))
 
 
 def _call_delete_coupon(event):
     return delete_coupon(_pick_path_id(event))
 
 
+def _call_read_coupon_catalog(event):
+    return read_coupon_catalog(_pick_header(event, 'If-None-Match'))
+
+
+def _call_search_coupons(event):
+    query = _pick_query_string_parameter(event, 'q')
+    if query is None:
+        return build_bad_request_response('not_exists_key')
+    limit = _pick_query_string_parameter(event, 'limit')
+    if limit is not None and not _is_valid_limit(limit):
+        return build_bad_request_response('invalid_limit')
+    last_evaluated_key = _pick_header(event, 'Last-Evaluated-Key')
+    last_evaluated_key = json.loads(last_evaluated_key) if last_evaluated_key is not None else {'offset': 0}
+    offset = last_evaluated_key.get('offset') if type(last_evaluated_key) is dict else None
+    if type(offset) is not int or offset < 0:
+        return build_bad_request_response('invalid_last_evaluated_key')
+    return search_coupons(
+        query,
+        offset,
+        _pick_header(event, 'If-None-Match'),
+        **({'limit': int(limit)} if limit is not None else {}),
+    )
+
+
 def _call_query_coupons(event):
-    headers = event['headers']
+    last_evaluated_key = _pick_header(event, 'Last-Evaluated-Key')
+    limit = _pick_query_string_parameter(event, 'limit')
+    if limit is not None and not _is_valid_limit(limit):
+        return build_bad_request_response('invalid_limit')
+    active = _pick_query_string_parameter(event, 'active')
+    if active not in (None, 'true', 'false'):
+        return build_bad_request_response('invalid_active')
     return query_coupons(
-        json.loads(headers['Last-Evaluated-Key']) if type(headers) is dict and 'Last-Evaluated-Key' in headers
-        else None,
+        json.loads(last_evaluated_key) if last_evaluated_key is not None else None,
+        _pick_header(event, 'If-None-Match'),
+        **({'limit': int(limit)} if limit is not None else {}),
+        **({'active': True} if active == 'true' else {}),
     )
 
 
+def _exceeds_body_limit(event):
+    return type(event.get('body')) is str and len(event['body']) > _BODY_MAX_LENGTH
+
+
+def _load_body(event):
+    return json.loads(_decode_body(event))
+
+
+def _decode_body(event):
+    # Binary media types make API Gateway hand over request bodies base64 encoded as well.
+    body = event['body']
+    return base64.b64decode(body) if event.get('isBase64Encoded') else body
+
+
 def _has_valid_path_id(event):
     return (
             'pathParameters' in event
@@ -90,10 +262,67 @@ def _has_valid_path_id(event):
     )
 
 
+def _pick_query_string_parameter(event, name):
+    query_string_parameters = event.get('queryStringParameters')
+    return query_string_parameters.get(name) if type(query_string_parameters) is dict else None
+
+
+def _is_valid_limit(limit):
+    return _ID_PATTERN.fullmatch(limit) and 1 <= int(limit) <= _QUERY_LIMIT_MAX
+
+
+def _has_path_name(event, name):
+    return type(event.get('pathParameters')) is dict and event['pathParameters'].get('id') == name
+
+
 def _pick_path_id(event):
     return event['pathParameters']['id']
 
 
+def _has_coupon_keys(body):
+    # Each image is sent either inline as a data URI or as the key of an object uploaded with a presigned POST.
+    # The QR code may be omitted when it can be generated from the coupon ID.
+    required_names = _IMAGE_NAMES if not qr_code_generation_enabled() else ('image',)
+    return (
+            check_request_exists_keys(body, 'title', 'description')
+            and all(name in body or f"{name}_upload_key" in body for name in required_names)
+    )
+
+
+def _has_str_coupon_values(body):
+    return (
+            check_request_str_values(body, 'title', 'description')
+            and all(type(body[name] if name in body else body[f"{name}_upload_key"]) is str for name in _IMAGE_NAMES
+                    if name in body or f"{name}_upload_key" in body)
+            and all(type(body[name]) is str for name in _VALIDITY_NAMES if name in body)
+    )
+
+
+def _pick_coupon(body):
+    return _pick_image_sources(_pick_coupon_fields(body))
+
+
+def _pick_coupon_fields(body):
+    names = ('title', 'description', *_IMAGE_NAMES, *(f"{name}_upload_key" for name in _IMAGE_NAMES),
+             *_VALIDITY_NAMES)
+    return {name: body[name] for name in names if name in body}
+
+
+def _pick_image_sources(fields):
+    return {
+        **{name: value for name, value in fields.items() if not name.endswith('_upload_key')},
+        **{name: {'upload_key': fields[f"{name}_upload_key"]} for name in _IMAGE_NAMES
+           if name not in fields and f"{name}_upload_key" in fields},
+    }
+
+
+def _pick_header(event, name):
+    headers = event.get('headers')
+    if type(headers) is not dict:
+        return None
+    return next((value for key, value in headers.items() if key.lower() == name.lower()), None)
+
+
 def _extract_last_evaluated_key(event):
     headers = event['headers']
     if type(headers) is dict and 'Last-Evaluated-Key' in headers:
@@ -122,7 +351,7 @@ class Test(unittest.TestCase):
 
     @mock.patch('lambda_handler.create_coupon')
     def test_create_coupon(self, mock_create_coupon):
-        mock_create_coupon.return_value = 'coupon'
+        mock_create_coupon.return_value = build_ok_response('coupon')
         response = lambda_handler({
             'httpMethod': 'POST',
             'body': json.dumps({
@@ -133,8 +362,61 @@ class Test(unittest.TestCase):
             }),
             **self._with_test_api_key_id(),
         }, {})
-        self.assertEqual('coupon', response)
-        mock_create_coupon.assert_called_once_with('title', 'description', 'image', 'qr_code_image')
+        self.assertEqual(build_ok_response('coupon'), response)
+        mock_create_coupon.assert_called_once_with(title='title', description='description', image='image',
+                                                   qr_code_image='qr_code_image')
+
+    @mock.patch('lambda_handler.create_coupon')
+    def test_create_coupon_uploaded_images(self, mock_create_coupon):
+        lambda_handler({
+            'httpMethod': 'POST',
+            'body': json.dumps({
+                'title': 'title',
+                'description': 'description',
+                'image_upload_key': 'image/key',
+                'qr_code_image': 'qr_code_image',
+            }),
+            **self._with_test_api_key_id(),
+        }, {})
+        mock_create_coupon.assert_called_once_with(title='title', description='description',
+                                                   image={'upload_key': 'image/key'}, qr_code_image='qr_code_image')
+
+    @mock.patch('lambda_handler.create_coupon')
+    @mock.patch('lambda_handler.qr_code_generation_enabled')
+    def test_create_coupon_generated_qr_code_image(self, mock_qr_code_generation_enabled, mock_create_coupon):
+        event = {
+            'httpMethod': 'POST',
+            'body': json.dumps({'title': 'title', 'description': 'description', 'image': 'image'}),
+            **self._with_test_api_key_id(),
+        }
+        mock_qr_code_generation_enabled.return_value = True
+        lambda_handler(event, {})
+        mock_create_coupon.assert_called_once_with(title='title', description='description', image='image')
+        mock_qr_code_generation_enabled.return_value = False
+        self.assertEqual(build_bad_request_response('not_exists_key'), lambda_handler(event, {}))
+
+    @mock.patch('lambda_handler.issue_coupon_image_uploads')
+    def test_issue_coupon_image_uploads(self, mock_issue_coupon_image_uploads):
+        mock_issue_coupon_image_uploads.return_value = build_ok_response('uploads')
+        response = lambda_handler({
+            'httpMethod': 'POST',
+            'pathParameters': {'id': 'uploads'},
+            'body': json.dumps({'image_content_type': 'image/png', 'qr_code_image_content_type': 'image/png'}),
+            **self._with_test_api_key_id(),
+        }, {})
+        self.assertEqual(build_ok_response('uploads'), response)
+        mock_issue_coupon_image_uploads.assert_called_once_with('image/png', 'image/png')
+
+    def test_issue_coupon_image_uploads_bad_request(self):
+        self.assertEqual(
+            build_bad_request_response('invalid_type'),
+            lambda_handler({
+                'httpMethod': 'POST',
+                'pathParameters': {'id': 'uploads'},
+                'body': json.dumps({'image_content_type': 'image/png', 'qr_code_image_content_type': None}),
+                **self._with_test_api_key_id(),
+            }, {}),
+        )
 
     def test_create_coupon_bad_request(self):
         self.assertEqual(
@@ -155,19 +437,126 @@ class Test(unittest.TestCase):
             }, {}),
         )
 
+    @mock.patch('lambda_handler.create_coupon')
+    def test_create_coupon_validity(self, mock_create_coupon):
+        body = {'title': 'title', 'description': 'description', 'image': 'image', 'qr_code_image': 'qr_code_image'}
+        lambda_handler({
+            'httpMethod': 'POST',
+            'body': json.dumps({**body, 'valid_from': '2026-01-01T00:00:00Z', 'valid_until': '2026-02-01T00:00:00Z'}),
+            **self._with_test_api_key_id(),
+        }, {})
+        mock_create_coupon.assert_called_once_with(**body, valid_from='2026-01-01T00:00:00Z',
+                                                   valid_until='2026-02-01T00:00:00Z')
+        self.assertEqual(build_bad_request_response('invalid_type'), lambda_handler({
+            'httpMethod': 'POST',
+            'body': json.dumps({**body, 'valid_until': 1769904000}),
+            **self._with_test_api_key_id(),
+        }, {}))
+
+    @mock.patch('lambda_handler.bulk_create_coupons')
+    def test_bulk_create_coupons(self, mock_bulk_create_coupons):
+        mock_bulk_create_coupons.return_value = build_ok_response('coupons')
+        coupons = [{
+            'title': 'title',
+            'description': 'description',
+            'image': 'image',
+            'qr_code_image': 'qr_code_image',
+        }]
+        response = lambda_handler({
+            'httpMethod': 'POST',
+            'body': json.dumps(coupons),
+            **self._with_test_api_key_id(),
+        }, {})
+        self.assertEqual(build_ok_response('coupons'), response)
+        mock_bulk_create_coupons.assert_called_once_with(coupons)
+        mock_bulk_create_coupons.reset_mock()
+        response = lambda_handler({
+            'httpMethod': 'POST',
+            'body': base64.b64encode(f" {json.dumps(coupons)}".encode()).decode(),
+            'isBase64Encoded': True,
+            **self._with_test_api_key_id(),
+        }, {})
+        self.assertEqual(build_ok_response('coupons'), response)
+        mock_bulk_create_coupons.assert_called_once_with(coupons)
+
+    def test_bulk_create_coupons_bad_request(self):
+        self.assertEqual(
+            build_bad_request_response('invalid_length'),
+            lambda_handler({'httpMethod': 'POST', 'body': '[]', **self._with_test_api_key_id()}, {}),
+        )
+        self.assertEqual(
+            build_bad_request_response('invalid_type'),
+            lambda_handler({'httpMethod': 'POST', 'body': '[null]', **self._with_test_api_key_id()}, {}),
+        )
+        self.assertEqual(
+            build_bad_request_response('not_exists_key'),
+            lambda_handler({'httpMethod': 'POST', 'body': '[{}]', **self._with_test_api_key_id()}, {}),
+        )
+        self.assertEqual(
+            build_bad_request_response('invalid_type'),
+            lambda_handler({
+                'httpMethod': 'POST',
+                'body': json.dumps([{
+                    'title': None,
+                    'description': '',
+                    'image': '',
+                    'qr_code_image': '',
+                }]),
+                **self._with_test_api_key_id(),
+            }, {}),
+        )
+
     @mock.patch('lambda_handler.read_coupon')
     def test_read_coupon(self, mock_read_coupon):
-        mock_read_coupon.return_value = 'coupon'
+        mock_read_coupon.return_value = build_ok_response('coupon')
         response = lambda_handler({
             'httpMethod': 'GET',
             'pathParameters': {'id': '0000001'},
         }, {})
-        self.assertEqual('coupon', response)
-        mock_read_coupon.assert_called_once_with('0000001')
+        self.assertEqual(build_ok_response('coupon'), response)
+        mock_read_coupon.assert_called_once_with('0000001', None)
+
+    @mock.patch('lambda_handler.read_coupon')
+    def test_read_coupon_if_none_match(self, mock_read_coupon):
+        lambda_handler({
+            'httpMethod': 'GET',
+            'pathParameters': {'id': '0000001'},
+            'headers': {'if-none-match': 'W/"etag"'},
+        }, {})
+        mock_read_coupon.assert_called_once_with('0000001', 'W/"etag"')
+
+    @mock.patch('lambda_handler.batch_read_coupons')
+    def test_batch_read_coupons(self, mock_batch_read_coupons):
+        mock_batch_read_coupons.return_value = build_ok_response('coupons')
+        response = lambda_handler({
+            'httpMethod': 'GET',
+            'pathParameters': None,
+            'queryStringParameters': {'ids': '0000001,0000002'},
+        }, {})
+        self.assertEqual(build_ok_response('coupons'), response)
+        mock_batch_read_coupons.assert_called_once_with(('0000001', '0000002'))
+
+    def test_batch_read_coupons_bad_request(self):
+        self.assertEqual(
+            build_bad_request_response('invalid_length'),
+            lambda_handler({
+                'httpMethod': 'GET',
+                'pathParameters': None,
+                'queryStringParameters': {'ids': ','.join(['0000001'] * 101)},
+            }, {}),
+        )
+        self.assertEqual(
+            build_bad_request_response('invalid_id'),
+            lambda_handler({
+                'httpMethod': 'GET',
+                'pathParameters': None,
+                'queryStringParameters': {'ids': '0000001,'},
+            }, {}),
+        )
 
     @mock.patch('lambda_handler.update_coupon')
     def test_update_coupon(self, mock_update_coupon):
-        mock_update_coupon.return_value = 'coupon'
+        mock_update_coupon.return_value = build_ok_response('coupon')
         response = lambda_handler({
             'httpMethod': 'PUT',
             'pathParameters': {'id': '0000001'},
@@ -179,8 +568,9 @@ class Test(unittest.TestCase):
             }),
             **self._with_test_api_key_id(),
         }, {})
-        self.assertEqual('coupon', response)
-        mock_update_coupon.assert_called_once_with('0000001', 'title', 'description', 'image', 'qr_code_image')
+        self.assertEqual(build_ok_response('coupon'), response)
+        mock_update_coupon.assert_called_once_with('0000001', title='title', description='description', image='image',
+                                                   qr_code_image='qr_code_image')
 
     def test_update_coupon_bad_request(self):
         self.assertEqual(
@@ -205,34 +595,155 @@ class Test(unittest.TestCase):
 
     @mock.patch('lambda_handler.delete_coupon')
     def test_delete_coupon(self, mock_delete_coupon):
-        mock_delete_coupon.return_value = 'coupon'
+        mock_delete_coupon.return_value = build_ok_response('coupon')
         response = lambda_handler({
             'httpMethod': 'DELETE',
             'pathParameters': {'id': '0000001'},
             **self._with_test_api_key_id(),
         }, {})
-        self.assertEqual('coupon', response)
+        self.assertEqual(build_ok_response('coupon'), response)
         mock_delete_coupon.assert_called_once_with('0000001')
 
     @mock.patch('lambda_handler.query_coupons')
     def test_query_coupons(self, mock_query_coupons):
-        mock_query_coupons.return_value = 'coupons'
+        mock_query_coupons.return_value = build_ok_response('coupons')
         response = lambda_handler({
             'httpMethod': 'GET',
             'pathParameters': None,
             'headers': {'Last-Evaluated-Key': '{"key": "value"}'},
         }, {})
-        self.assertEqual('coupons', response)
-        mock_query_coupons.assert_called_once_with({'key': 'value'})
+        self.assertEqual(build_ok_response('coupons'), response)
+        mock_query_coupons.assert_called_once_with({'key': 'value'}, None)
 
     @mock.patch('lambda_handler.query_coupons')
     def test_query_coupons_no_last_evaluated_key(self, mock_query_coupons):
         lambda_handler({
             'httpMethod': 'GET',
             'pathParameters': None,
-            'headers': {},
+            'headers': {'If-None-Match': 'W/"etag"'},
         }, {})
-        mock_query_coupons.assert_called_once_with(None)
+        mock_query_coupons.assert_called_once_with(None, 'W/"etag"')
+
+    @mock.patch('lambda_handler.query_coupons')
+    def test_query_coupons_limit(self, mock_query_coupons):
+        event = {'httpMethod': 'GET', 'pathParameters': None, 'headers': None}
+        lambda_handler({**event, 'queryStringParameters': {'limit': '100'}}, {})
+        mock_query_coupons.assert_called_once_with(None, None, limit=100)
+        for limit in ('0', '101', '-1', 'ten'):
+            self.assertEqual(build_bad_request_response('invalid_limit'),
+                             lambda_handler({**event, 'queryStringParameters': {'limit': limit}}, {}))
+
+    @mock.patch('lambda_handler.query_coupons')
+    def test_query_coupons_active(self, mock_query_coupons):
+        event = {'httpMethod': 'GET', 'pathParameters': None, 'headers': None}
+        lambda_handler({**event, 'queryStringParameters': {'active': 'true'}}, {})
+        mock_query_coupons.assert_called_once_with(None, None, active=True)
+        lambda_handler({**event, 'queryStringParameters': {'active': 'false'}}, {})
+        mock_query_coupons.assert_called_with(None, None)
+        self.assertEqual(build_bad_request_response('invalid_active'),
+                         lambda_handler({**event, 'queryStringParameters': {'active': '1'}}, {}))
+
+    @mock.patch('lambda_handler.read_coupon_catalog')
+    def test_read_coupon_catalog(self, mock_read_coupon_catalog):
+        mock_read_coupon_catalog.return_value = build_ok_response('coupons')
+        response = lambda_handler({
+            'httpMethod': 'GET',
+            'pathParameters': {'id': 'catalog'},
+            'headers': {'If-None-Match': 'W/"etag"'},
+        }, {})
+        self.assertEqual(build_ok_response('coupons'), response)
+        mock_read_coupon_catalog.assert_called_once_with('W/"etag"')
+
+    @mock.patch('lambda_handler.search_coupons')
+    def test_search_coupons(self, mock_search_coupons):
+        mock_search_coupons.return_value = build_ok_response('coupons')
+        event = {'httpMethod': 'GET', 'pathParameters': {'id': 'search'}, 'headers': None}
+        response = lambda_handler({**event, 'queryStringParameters': {'q': '全商品'}}, {})
+        self.assertEqual(build_ok_response('coupons'), response)
+        mock_search_coupons.assert_called_once_with('全商品', 0, None)
+        lambda_handler({
+            **event,
+            'queryStringParameters': {'q': '全商品', 'limit': '10'},
+            'headers': {'Last-Evaluated-Key': '{"offset": 10}', 'If-None-Match': 'W/"etag"'},
+        }, {})
+        mock_search_coupons.assert_called_with('全商品', 10, 'W/"etag"', limit=10)
+        for parameters, headers, message in (
+                (None, None, 'not_exists_key'),
+                ({'q': '全商品', 'limit': '0'}, None, 'invalid_limit'),
+                ({'q': '全商品'}, {'Last-Evaluated-Key': '{"offset": -1}'}, 'invalid_last_evaluated_key'),
+                ({'q': '全商品'}, {'Last-Evaluated-Key': '{}'}, 'invalid_last_evaluated_key'),
+                ({'q': '全商品'}, {'Last-Evaluated-Key': '[10]'}, 'invalid_last_evaluated_key'),
+        ):
+            self.assertEqual(build_bad_request_response(message), lambda_handler(
+                {**event, 'queryStringParameters': parameters, 'headers': headers}, {}))
+
+    @mock.patch('lambda_handler.emit_metrics')
+    @mock.patch('lambda_handler.wait_deferred_tasks')
+    @mock.patch('lambda_handler.read_coupon')
+    def test_lambda_handler_failed(self, mock_read_coupon, mock_wait_deferred_tasks, mock_emit_metrics):
+        mock_read_coupon.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            lambda_handler({'httpMethod': 'GET', 'pathParameters': {'id': '0000001'}, 'headers': None}, {})
+        mock_wait_deferred_tasks.assert_called_once_with()
+        mock_emit_metrics.assert_called_once_with('read_coupon', None)
+
+    @mock.patch('lambda_handler.query_coupons')
+    def test_query_coupons_compressed(self, mock_query_coupons):
+        mock_query_coupons.return_value = build_ok_response(['クーポン' * 300])
+        response = lambda_handler({
+            'httpMethod': 'GET',
+            'pathParameters': None,
+            'headers': {'Accept-Encoding': 'gzip'},
+        }, {})
+        self.assertEqual('gzip', response['headers']['Content-Encoding'])
+        self.assertTrue(response['isBase64Encoded'])
+
+    @mock.patch('lambda_handler.patch_coupon')
+    def test_patch_coupon(self, mock_patch_coupon):
+        mock_patch_coupon.return_value = build_ok_response('coupon')
+        response = lambda_handler({
+            'httpMethod': 'PATCH',
+            'pathParameters': {'id': '0000001'},
+            'body': json.dumps({'title': 'title', 'qr_code_image_upload_key': 'qr_code_image/key', 'id': 'ignored'}),
+            **self._with_test_api_key_id(),
+        }, {})
+        self.assertEqual(build_ok_response('coupon'), response)
+        mock_patch_coupon.assert_called_once_with('0000001', {'title': 'title',
+                                                              'qr_code_image': {'upload_key': 'qr_code_image/key'}})
+
+    def test_patch_coupon_bad_request(self):
+        for body, message in (('{}', 'not_exists_key'), ('[]', 'not_exists_key'),
+                              ('{"description": null}', 'invalid_type')):
+            self.assertEqual(
+                build_bad_request_response(message),
+                lambda_handler({
+                    'httpMethod': 'PATCH',
+                    'pathParameters': {'id': '0000001'},
+                    'body': body,
+                    **self._with_test_api_key_id(),
+                }, {}),
+            )
+
+    @mock.patch('lambda_handler._BODY_MAX_LENGTH', 16)
+    @mock.patch('lambda_handler.create_coupon')
+    def test_body_too_large(self, mock_create_coupon):
+        self.assertEqual(
+            build_payload_too_large_response('body_too_large'),
+            lambda_handler({'httpMethod': 'POST', 'body': '{"title": "' + 'x' * 16 + '"}',
+                            **self._with_test_api_key_id()}, {}),
+        )
+        mock_create_coupon.assert_not_called()
+
+    @mock.patch('lambda_handler.patch_coupon')
+    def test_base64_encoded_body(self, mock_patch_coupon):
+        lambda_handler({
+            'httpMethod': 'PATCH',
+            'pathParameters': {'id': '0000001'},
+            'body': base64.b64encode(json.dumps({'title': 'タイトル'}).encode()).decode(),
+            'isBase64Encoded': True,
+            **self._with_test_api_key_id(),
+        }, {})
+        mock_patch_coupon.assert_called_once_with('0000001', {'title': 'タイトル'})
 
     def test_route_not_found(self):
         self.assertEqual(
@@ -240,6 +751,12 @@ class Test(unittest.TestCase):
             lambda_handler({'httpMethod': 'X', 'body': '{}', **self._with_test_api_key_id()}, {}),
         )
 
+    def test_pick_header(self):
+        self.assertEqual('value', _pick_header({'headers': {'X-Name': 'value'}}, 'x-name'))
+        self.assertIsNone(_pick_header({'headers': {}}, 'X-Name'))
+        self.assertIsNone(_pick_header({'headers': None}, 'X-Name'))
+        self.assertIsNone(_pick_header({}, 'X-Name'))
+
     def test_has_valid_path_id(self):
         self.assertTrue(_has_valid_path_id({'pathParameters': {'id': '0000001'}}))
         self.assertFalse(_has_valid_path_id({}))
@@ -282,3 +799,26 @@ class Test(unittest.TestCase):
             lambda_handler({'httpMethod': 'DELETE', 'body': '{}', 'pathParameters': {'id': '0000001'},
                             **with_denied_api_key}, {}),
         )
+
+    @mock.patch('lambda_handler.emit_metrics')
+    @mock.patch('lambda_handler.apply_coupon_changes')
+    @mock.patch('lambda_handler.dynamodb_coupon_changes')
+    @mock.patch('lambda_handler.expire_coupons')
+    @mock.patch('lambda_handler.dynamodb_expired_coupons')
+    def test_stream_handler(self, mock_dynamodb_expired_coupons, mock_expire_coupons, mock_dynamodb_coupon_changes,
+                            mock_apply_coupon_changes, mock_emit_metrics):
+        mock_dynamodb_expired_coupons.return_value = [('100', {'id': '0000001'})]
+        mock_expire_coupons.return_value = None
+        mock_dynamodb_coupon_changes.return_value = {'0000001': ('100', None)}
+        self.assertEqual({'batchItemFailures': []}, stream_handler({'Records': ['record']}, {}))
+        mock_dynamodb_expired_coupons.assert_called_once_with(['record'])
+        mock_expire_coupons.assert_called_once_with([('100', {'id': '0000001'})])
+        mock_dynamodb_coupon_changes.assert_called_once_with(['record'])
+        mock_apply_coupon_changes.assert_called_once_with({'0000001': ('100', None)})
+        mock_emit_metrics.assert_called_once_with('coupon_stream', build_ok_response(None))
+        mock_expire_coupons.return_value = '100'
+        self.assertEqual({'batchItemFailures': [{'itemIdentifier': '100'}]},
+                         stream_handler({'Records': ['record']}, {}))
+        mock_apply_coupon_changes.side_effect = RuntimeError('failed')
+        with self.assertRaises(RuntimeError):
+            stream_handler({'Records': ['record']}, {})
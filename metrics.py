@@ -0,0 +1,160 @@
+import collections
+import contextlib
+import functools
+import io
+import json
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+# Read once at import time: when disabled, timed returns the function itself and costs nothing per call.
+_ENABLED = os.environ.get('COUPON_METRICS_ENABLED', '') == 'true'
+_NAMESPACE = 'ShopCouponDeliverer'
+
+# Spans are self-time: the time a function spent outside the timed functions it called on the same thread, so
+# that nested spans add up to the invocation instead of counting the same milliseconds several times.
+_spans = collections.defaultdict(float)
+_properties = {}
+_lock = threading.Lock()
+_cold_start = True
+# Counts emitted invocations. A span that started in an earlier one, such as a background task that outlived it, is
+# dropped rather than added to the invocation it happens to finish in.
+_generation = 0
+# Per thread, the time spent in timed callees of each timed function on the stack.
+_local = threading.local()
+
+
+def timed(function):
+    return _timed(function) if _ENABLED else function
+
+
+def set_metric_property(name, value):
+    if _ENABLED:
+        _properties[name] = value
+
+
+def emit_metrics(route, response):
+    global _cold_start, _generation
+    if not _ENABLED:
+        return
+    with _lock:
+        spans = dict(_spans)
+        properties = dict(_properties)
+        _spans.clear()
+        _properties.clear()
+        _generation += 1
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': _NAMESPACE,
+                'Dimensions': [['route']],
+                'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in spans],
+            }],
+        },
+        'route': route,
+        # API Gateway answers an invocation that raised, which leaves no response, with 502.
+        'status_code': response['statusCode'] if response is not None else 502,
+        'cold_start': _cold_start,
+        **properties,
+        **{name: round(milliseconds, 3) for name, milliseconds in spans.items()},
+    }, separators=(',', ':')))
+    _cold_start = False
+
+
+def _timed(function):
+    name = f"{function.__module__}.{function.__name__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        callee_times = _local.__dict__.setdefault('callee_times', [])
+        generation = _generation
+        callee_times.append(0.0)
+        started_at = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            self_time = elapsed - callee_times.pop()
+            if callee_times:
+                callee_times[-1] += elapsed
+            with _lock:
+                if generation == _generation:
+                    _spans[name] += self_time * 1000
+    return wrapper
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        _spans.clear()
+        _properties.clear()
+
+    def test_timed_disabled(self):
+        def function():
+            pass
+        self.assertIs(function, timed(function))
+
+    @mock.patch('metrics._ENABLED', True)
+    @mock.patch('metrics._cold_start', True)
+    @mock.patch('metrics.time.perf_counter')
+    @mock.patch('metrics.time.time')
+    def test_emit_metrics(self, mock_time, mock_perf_counter):
+        mock_time.return_value = 1
+        mock_perf_counter.side_effect = [1, 1.5, 2, 2.25]
+        function = _timed(lambda: 'result')
+        self.assertEqual('result', function())
+        self.assertEqual('result', function())
+        set_metric_property('item_count', 20)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            emit_metrics('read_coupon', {'statusCode': 200})
+        self.assertEqual({
+            '_aws': {
+                'Timestamp': 1000,
+                'CloudWatchMetrics': [{
+                    'Namespace': 'ShopCouponDeliverer',
+                    'Dimensions': [['route']],
+                    'Metrics': [{'Name': 'metrics.<lambda>', 'Unit': 'Milliseconds'}],
+                }],
+            },
+            'route': 'read_coupon',
+            'status_code': 200,
+            'cold_start': True,
+            'item_count': 20,
+            'metrics.<lambda>': 750.0,
+        }, json.loads(output.getvalue()))
+        self.assertFalse(_cold_start)
+        self.assertEqual({}, _spans)
+        self.assertEqual({}, _properties)
+
+    @mock.patch('metrics._ENABLED', True)
+    @mock.patch('metrics.time.perf_counter')
+    def test_timed_self_time(self, mock_perf_counter):
+        mock_perf_counter.side_effect = [0, 1, 3, 10]
+
+        @_timed
+        def inner():
+            return 'inner'
+
+        @_timed
+        def outer():
+            return inner()
+
+        self.assertEqual('inner', outer())
+        self.assertEqual({'metrics.inner': 2000.0, 'metrics.outer': 8000.0}, dict(_spans))
+
+    @mock.patch('metrics._ENABLED', True)
+    @mock.patch('metrics.time.perf_counter')
+    def test_timed_previous_invocation(self, mock_perf_counter):
+        mock_perf_counter.side_effect = [0, 1]
+
+        def function():
+            with contextlib.redirect_stdout(io.StringIO()):
+                emit_metrics('read_coupon', None)
+
+        _timed(function)()
+        self.assertEqual({}, dict(_spans))
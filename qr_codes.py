@@ -0,0 +1,47 @@
+import importlib.util
+import io
+import os
+import unittest
+from unittest import mock
+
+
+# Generation is opted into instead of following whether qrcode happens to be packaged, and is imported only by the
+# writes that generate a code. Enabling it without the package fails the cold start rather than those writes.
+_ENABLED = os.environ.get('COUPON_QR_CODE_GENERATION_ENABLED', '') == 'true'
+if _ENABLED and importlib.util.find_spec('qrcode') is None:
+    raise ImportError('COUPON_QR_CODE_GENERATION_ENABLED is true but the qrcode package is missing')
+# What the generated QR code encodes, e.g. https://shop.example.com/coupons/{id} for a redemption URL.
+_CONTENT_TEMPLATE = os.environ.get('COUPON_QR_CODE_CONTENT', '{id}')
+_BOX_SIZE = 8
+_BORDER = 4
+
+
+def qr_code_generation_enabled():
+    return _ENABLED
+
+
+def make_coupon_qr_code_content(_id):
+    return _CONTENT_TEMPLATE.replace('{id}', _id)
+
+
+def generate_qr_code_png(content):
+    import qrcode
+    code = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=_BOX_SIZE, border=_BORDER)
+    code.add_data(content)
+    code.make(fit=True)
+    output = io.BytesIO()
+    code.make_image().save(output)
+    return output.getvalue()
+
+
+class Test(unittest.TestCase):
+
+    def test_make_coupon_qr_code_content(self):
+        self.assertEqual('0000001', make_coupon_qr_code_content('0000001'))
+        with mock.patch('qr_codes._CONTENT_TEMPLATE', 'https://shop.example.com/coupons/{id}?ref=qr'):
+            self.assertEqual('https://shop.example.com/coupons/0000001?ref=qr', make_coupon_qr_code_content('0000001'))
+
+    def test_generate_qr_code_png(self):
+        if importlib.util.find_spec('qrcode') is None:
+            self.skipTest('qrcode is not installed')
+        self.assertTrue(generate_qr_code_png('0000001').startswith(b'\x89PNG\r\n\x1a\n'))
@@ -0,0 +1,5 @@
+from coupon_catalog import rebuild_coupon_catalog
+
+
+if __name__ == '__main__':
+    print(f"wrote {rebuild_coupon_catalog()} coupons to the catalog")
@@ -0,0 +1,5 @@
+from coupon_search import rebuild_coupon_search_index
+
+
+if __name__ == '__main__':
+    print(f"indexed {rebuild_coupon_search_index()} coupons")
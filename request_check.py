@@ -9,6 +9,10 @@ def check_request_str_values(target, *keys):
     return _check_request_values(lambda value: type(value) is str, target, *keys)
 
 
+def check_request_list_of_dicts(target):
+    return type(target) is list and all(type(value) is dict for value in target)
+
+
 def _check_request_values(cond, target, *keys):
     return all(cond(target[key]) for key in keys)
 
@@ -22,3 +26,8 @@ class Test(unittest.TestCase):
     def test_check_request_str_values(self):
         self.assertTrue(check_request_str_values({'key': 'value'}, 'key'))
         self.assertFalse(check_request_str_values({'key': None}, 'key'))
+
+    def test_check_request_list_of_dicts(self):
+        self.assertTrue(check_request_list_of_dicts([{}]))
+        self.assertFalse(check_request_list_of_dicts({}))
+        self.assertFalse(check_request_list_of_dicts([None]))
@@ -1,36 +1,232 @@
-import base64
 import functools
+import time
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
 
-import boto3
+from botocore.exceptions import ClientError
 
+from aws_resources import s3_resource, s3_client
+from expiring_cache import ExpiringLruCache, epoch_end
+from metrics import timed
 
+
+_BUCKET_NAME = 'shop-coupon-deliverer.coupons'
+_URL_EXPIRES_IN = 3600
+# URLs are reused until the end of the epoch they were signed in, so they always have at least
+# _URL_EXPIRES_IN - _URL_EPOCH_SECONDS seconds of validity left when handed out.
+_URL_EPOCH_SECONDS = 1800
+_URL_CACHE_SIZE = 1024
+_UPLOAD_EXPIRES_IN = 600
+_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+_CATALOG_KEY = 'catalog/coupons.json.gz'
+_SEARCH_INDEX_KEY = 'search/index.json.gz'
+
+_url_cache = ExpiringLruCache(_URL_CACHE_SIZE)
+
+
+@timed
 def s3_put_coupon_image(key, body, content_type):
-    binary_image = base64.b64decode(body)
-    return _s3_coupons_bucket().put_object(Key=key, Body=binary_image, ContentType=content_type)
+    return _s3_coupons_bucket().put_object(Key=key, Body=body, ContentType=content_type)
 
 
-def s3_delete_coupon_image(key):
-    return _s3_coupons_bucket().delete_objects(Delete={'Objects': [{'Key': key}]})
+@timed
+def s3_delete_coupon_images(keys):
+    return _s3_coupons_bucket().delete_objects(Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
 
 
-def s3_generate_coupon_url(key):
-    return _s3_client().generate_presigned_url(
-        ClientMethod='get_object',
-        HttpMethod='GET',
-        ExpiresIn=3600,
-        Params={
-            'Bucket': 'shop-coupon-deliverer.coupons',
-            'Key': key,
-        }
+@timed
+def s3_generate_coupon_image_upload(key, content_type):
+    return _s3_client().generate_presigned_post(
+        Bucket=_BUCKET_NAME,
+        Key=key,
+        Fields={'Content-Type': content_type},
+        Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, _UPLOAD_MAX_BYTES]],
+        ExpiresIn=_UPLOAD_EXPIRES_IN,
     )
 
 
-@functools.lru_cache()
+@timed
+def s3_get_uploaded_coupon_image(key):
+    # Returns (body, content_type), or None if nothing was uploaded under the key.
+    try:
+        result = _s3_client().get_object(Bucket=_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        return None
+    return result['Body'].read(), result['ContentType']
+
+
+@timed
+def s3_get_coupon_catalog(if_none_match=None):
+    return _get_snapshot(_CATALOG_KEY, if_none_match)
+
+
+@timed
+def s3_put_coupon_catalog(body, if_match):
+    return _put_snapshot(_CATALOG_KEY, body, if_match)
+
+
+@timed
+def s3_get_coupon_search_index(if_none_match=None):
+    return _get_snapshot(_SEARCH_INDEX_KEY, if_none_match)
+
+
+@timed
+def s3_put_coupon_search_index(body, if_match):
+    return _put_snapshot(_SEARCH_INDEX_KEY, body, if_match)
+
+
+@timed
+def s3_generate_coupon_url(key):
+    url = _url_cache.get(key)
+    if url is None:
+        url = _s3_client().generate_presigned_url(
+            ClientMethod='get_object',
+            HttpMethod='GET',
+            ExpiresIn=_URL_EXPIRES_IN,
+            Params={
+                'Bucket': _BUCKET_NAME,
+                'Key': key,
+            }
+        )
+        _url_cache.put(key, url, s3_coupon_url_epoch_end())
+    return url
+
+
+def s3_coupon_url_epoch():
+    return int(time.time() // _URL_EPOCH_SECONDS)
+
+
+def s3_coupon_url_epoch_end():
+    return epoch_end(_URL_EPOCH_SECONDS)
+
+
+def s3_coupon_url_cache_stats():
+    return _url_cache.stats()
+
+
+def _get_snapshot(key, if_none_match):
+    # Returns {'ETag', 'Body'}, {'ETag'} alone when the object still matches if_none_match, or None if there is none.
+    try:
+        result = _s3_client().get_object(Bucket=_BUCKET_NAME, Key=key,
+                                         **({'IfNoneMatch': if_none_match} if if_none_match is not None else {}))
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            return {'ETag': if_none_match}
+        if code in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return {'ETag': result['ETag'], 'Body': result['Body'].read()}
+
+
+def _put_snapshot(key, body, if_match):
+    # Writes only over the version read as if_match, or only where there is none when it is None.
+    # Returns the new ETag, or None when another writer got there first.
+    try:
+        result = _s3_client().put_object(
+            Bucket=_BUCKET_NAME,
+            Key=key,
+            Body=body,
+            ContentType='application/json',
+            ContentEncoding='gzip',
+            **({'IfMatch': if_match} if if_match is not None else {'IfNoneMatch': '*'}),
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('412', 'PreconditionFailed', '409', 'ConditionalRequestConflict'):
+            raise
+        return None
+    return result['ETag']
+
+
 def _s3_client():
-    return boto3.client('s3')
+    return s3_client()
 
 
 @functools.lru_cache()
 def _s3_coupons_bucket():
-    return boto3.resource('s3').Bucket('shop-coupon-deliverer.coupons')
+    return s3_resource().Bucket(_BUCKET_NAME)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        _url_cache.clear()
+
+    @mock.patch('expiring_cache.time.time')
+    @mock.patch('s3_coupons._s3_client')
+    def test_s3_generate_coupon_url(self, mock_s3_client, mock_time):
+        mock_s3_client.return_value = MagicMock(generate_presigned_url=MagicMock(side_effect=['url_0', 'url_1']))
+        mock_time.return_value = 1800
+        self.assertEqual('url_0', s3_generate_coupon_url('key'))
+        mock_time.return_value = 3599
+        self.assertEqual('url_0', s3_generate_coupon_url('key'))
+        mock_time.return_value = 3600
+        self.assertEqual('url_1', s3_generate_coupon_url('key'))
+        mock_s3_client().generate_presigned_url.assert_called_with(
+            ClientMethod='get_object',
+            HttpMethod='GET',
+            ExpiresIn=3600,
+            Params={'Bucket': 'shop-coupon-deliverer.coupons', 'Key': 'key'},
+        )
+        self.assertEqual(2, mock_s3_client().generate_presigned_url.call_count)
+
+    @mock.patch('s3_coupons._s3_client')
+    def test_s3_generate_coupon_image_upload(self, mock_s3_client):
+        mock_s3_client.return_value = MagicMock(generate_presigned_post=MagicMock(return_value={'url': 'url'}))
+        self.assertEqual({'url': 'url'}, s3_generate_coupon_image_upload('uploads/image/key', 'image/png'))
+        mock_s3_client().generate_presigned_post.assert_called_once_with(
+            Bucket='shop-coupon-deliverer.coupons',
+            Key='uploads/image/key',
+            Fields={'Content-Type': 'image/png'},
+            Conditions=[{'Content-Type': 'image/png'}, ['content-length-range', 1, 5 * 1024 * 1024]],
+            ExpiresIn=600,
+        )
+
+    @mock.patch('s3_coupons._s3_client')
+    def test_s3_get_uploaded_coupon_image(self, mock_s3_client):
+        mock_s3_client.return_value = MagicMock(get_object=MagicMock(return_value={
+            'ContentType': 'image/png', 'Body': MagicMock(read=MagicMock(return_value=b'image')),
+        }))
+        self.assertEqual((b'image', 'image/png'), s3_get_uploaded_coupon_image('uploads/image/key'))
+        mock_s3_client().get_object.assert_called_once_with(Bucket='shop-coupon-deliverer.coupons',
+                                                            Key='uploads/image/key')
+        mock_s3_client().get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertIsNone(s3_get_uploaded_coupon_image('uploads/image/key'))
+        mock_s3_client().get_object.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetObject')
+        with self.assertRaises(ClientError):
+            s3_get_uploaded_coupon_image('uploads/image/key')
+
+    @mock.patch('s3_coupons._s3_client')
+    def test_s3_get_coupon_catalog(self, mock_s3_client):
+        mock_s3_client.return_value = MagicMock(get_object=MagicMock(return_value={
+            'ETag': '"etag"', 'Body': MagicMock(read=MagicMock(return_value=b'catalog')),
+        }))
+        self.assertEqual({'ETag': '"etag"', 'Body': b'catalog'}, s3_get_coupon_catalog())
+        mock_s3_client().get_object.assert_called_once_with(Bucket='shop-coupon-deliverer.coupons',
+                                                            Key='catalog/coupons.json.gz')
+        mock_s3_client().get_object.side_effect = ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        self.assertEqual({'ETag': '"etag"'}, s3_get_coupon_catalog('"etag"'))
+        mock_s3_client().get_object.assert_called_with(Bucket='shop-coupon-deliverer.coupons',
+                                                       Key='catalog/coupons.json.gz', IfNoneMatch='"etag"')
+        mock_s3_client().get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertIsNone(s3_get_coupon_catalog())
 
+    @mock.patch('s3_coupons._s3_client')
+    def test_s3_put_coupon_catalog(self, mock_s3_client):
+        mock_s3_client.return_value = MagicMock(put_object=MagicMock(return_value={'ETag': '"new"'}))
+        self.assertEqual('"new"', s3_put_coupon_catalog(b'catalog', '"old"'))
+        self.assertEqual('"new"', s3_put_coupon_catalog(b'catalog', None))
+        mock_s3_client().put_object.assert_has_calls([
+            mock.call(Bucket='shop-coupon-deliverer.coupons', Key='catalog/coupons.json.gz', Body=b'catalog',
+                      ContentType='application/json', ContentEncoding='gzip', IfMatch='"old"'),
+            mock.call(Bucket='shop-coupon-deliverer.coupons', Key='catalog/coupons.json.gz', Body=b'catalog',
+                      ContentType='application/json', ContentEncoding='gzip', IfNoneMatch='*'),
+        ])
+        mock_s3_client().put_object.side_effect = ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.assertIsNone(s3_put_coupon_catalog(b'catalog', '"old"'))
+        mock_s3_client().put_object.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+        with self.assertRaises(ClientError):
+            s3_put_coupon_catalog(b'catalog', '"old"')